@@ -0,0 +1,280 @@
+import array
+import numpy as np
+import excel_lang
+import excel_store
+
+
+'''
+Compiles every formula of a workbook, in one pass, into a single flat table
+of nodes held in arrays, in place of a nested tuple tree per formula.
+
+A node is an opcode, one integer argument and a run of operands, the indices
+of its child nodes. What the argument means depends on the opcode:
+	NUMBER, STRING, BOOL      an index into the constant pool
+	RELCELL                   an index into the reference arrays
+	RELCELLRANGE              the index of the first of two references
+	NAME, FUNC                the id of the name in names
+	BINOP, UNOP               the index of the operator in OPERATORS
+	CELL, CELLRANGE, ...      the A1 text, in the constant pool
+Children are always added before their parents, so every operand index is
+lower than the node reading it and a pass over the nodes in order sees
+each one after its operands. Brackets (SUBEXP) are left out, they only
+group.
+
+Formulas are in R1C1 form, so the same text means the same calculation in
+any cell. Each distinct text is compiled once and every cell holding it
+shares its root node.
+
+The table is written into the workbook cache (see excel_cache) and mapped
+back with it, so a CellGraph built over a cached workbook turns the table's
+nodes back into trees (see formulaTree) and never runs the parser, except
+for formulas set after the table was compiled.
+'''
+
+OPNAMES = ('NUMBER', 'STRING', 'BOOL', 'RELCELL', 'RELCELLRANGE', 'NAME', 'FUNC',
+	'BINOP', 'UNOP', 'ARRAY_FN', 'CELL', 'CELLRANGE', 'COLRANGE', 'ROWRANGE')
+OPCODES = dict((name, op) for op, name in enumerate(OPNAMES))
+NUMBER, STRING, BOOL, RELCELL, RELCELLRANGE, NAME, FUNC, BINOP, UNOP, ARRAY_FN, \
+	CELL, CELLRANGE, COLRANGE, ROWRANGE = range(len(OPNAMES))
+CONSTANTS = (NUMBER, STRING, BOOL, CELL, CELLRANGE, COLRANGE, ROWRANGE)
+
+OPERATORS = ('+', '-', '*', '/', '^', '=', '<>', '>', '<', '>=', '<=', '&')
+OPERATORIDS = dict((op, i) for i, op in enumerate(OPERATORS))
+
+# the array fields of a NodeTable and their array typecodes, as they are cached
+TYPECODES = {
+	'ops': 'b',
+	'args': 'i',
+	'firsts': 'i',
+	'counts': 'i',
+	'operands': 'i',
+	'refRows': 'i',
+	'refCols': 'i',
+	'refFlags': 'b',
+	'refSheets': 'i',
+	'formulaRoots': 'i',
+}
+
+# the bits of refFlags
+ROWABS = 1
+COLABS = 2
+
+
+class NodeTable():
+	'''The flat node table of a workbook's formulas, see the module docstring.
+	formulaRoots gives the root node of each formula of the workbook's intern
+	table, by id, or -1 for one that does not parse. cellRoots maps each
+	worksheet to an int32 array giving, for every slot of its SheetStore,
+	the root node of the cell's formula or -1.'''
+
+	def __init__(self):
+		self.ops = array.array('b')
+		self.args = array.array('i')
+		self.firsts = array.array('i')      # where a node's operands start in operands
+		self.counts = array.array('i')      # how many operands a node has
+		self.operands = array.array('i')
+		self.constants = []
+		self.constantIds = {}
+		self.names = excel_store.InternTable()
+		# the parts of each relative reference, see excel_lang.RelRef
+		self.refRows = array.array('i')
+		self.refCols = array.array('i')
+		self.refFlags = array.array('b')
+		self.refSheets = array.array('i')   # name id of the sheet, -1 for the cell's own
+		self.roots = {}                     # formula text -> root node
+		self.formulaRoots = array.array('i')
+		self.formulaTable = None            # the workbook's formula intern table
+		self.constantLoader = None
+		self.trees = {}                     # root node -> tree, see getTree
+		self.cellRoots = {}
+
+	@classmethod
+	def fromBuffers(cls, arrays, constantLoader, names, formulaTable, worksheets):
+		'''A read only table over arrays that already exist, memoryviews of a
+		memory mapped cache file say. The constants are only decoded, by
+		constantLoader, and the roots of the formulas looked up the first time
+		a tree is asked for.'''
+		table = cls()
+		for field in TYPECODES:
+			setattr(table, field, arrays[field])
+		table.constants = None
+		table.constantLoader = constantLoader
+		table.names = names
+		table.roots = None
+		table.formulaTable = formulaTable
+		table.cellRoots = CellRoots(table, worksheets)
+		return table
+
+	def __len__(self):
+		return len(self.ops)
+
+	def addNode(self, op, arg=0, operands=()):
+		node = len(self.ops)
+		self.ops.append(op)
+		self.args.append(arg)
+		self.firsts.append(len(self.operands))
+		self.counts.append(len(operands))
+		self.operands.extend(operands)
+		return node
+
+	def addConstant(self, value):
+		# keyed by type as well, or 1.0 and TRUE would share a slot
+		key = (type(value), value)
+		id = self.constantIds.get(key)
+		if id is None:
+			id = len(self.constants)
+			self.constantIds[key] = id
+			self.constants.append(value)
+		return id
+
+	def addRef(self, ref):
+		index = len(self.refRows)
+		self.refRows.append(ref.row)
+		self.refCols.append(ref.col)
+		self.refFlags.append((ROWABS if ref.rowAbs else 0) | (COLABS if ref.colAbs else 0))
+		self.refSheets.append(self.names.intern(ref.sheet) if ref.sheet else -1)
+		return index
+
+	def compileFormula(self, text):
+		'''The root node of a formula, compiling it the first time it is seen.'''
+		root = self.roots.get(text)
+		if root is None:
+			t = excel_lang.parseFormula(text)
+			if t[0] != 'FORMULA':
+				raise Exception("a formula must start with 'FORMULA', either the parser failed of it's an invalid cell")
+			root = self.roots[text] = self.compileTree(t[1][0])
+		return root
+
+	def compileTree(self, t):
+		'''Adds the nodes of a parsed formula tree, returning the root.'''
+		kind = t[0]
+		if kind == 'SUBEXP':
+			return self.compileTree(t[1][0])
+		elif kind == 'RELCELL':
+			return self.addNode(RELCELL, self.addRef(t[1]))
+		elif kind == 'RELCELLRANGE':
+			first = self.addRef(t[1])
+			self.addRef(t[2])
+			return self.addNode(RELCELLRANGE, first)
+		elif kind in ('NAME', 'FUNC'):
+			operands = [self.compileTree(a) for a in t[2]] if kind == 'FUNC' else ()
+			return self.addNode(OPCODES[kind], self.names.intern(t[1]), operands)
+		elif kind in ('BINOP', 'UNOP'):
+			return self.addNode(OPCODES[kind], OPERATORIDS[t[1]], [self.compileTree(a) for a in t[2]])
+		elif kind == 'ARRAY_FN':
+			return self.addNode(ARRAY_FN, 0, [self.compileTree(t[1][0])])
+		elif kind in OPCODES:
+			return self.addNode(OPCODES[kind], self.addConstant(t[1]))
+		raise Exception("ERROR: type " + str(kind) + " not supported yet!")
+
+	def getOperands(self, node):
+		first = self.firsts[node]
+		return self.operands[first:first + self.counts[node]]
+
+	def getConstants(self):
+		if self.constants is None:
+			self.constants = self.constantLoader()
+		return self.constants
+
+	def getConstant(self, node):
+		return self.getConstants()[self.args[node]]
+
+	def getRef(self, index):
+		'''A reference of the table back as an excel_lang.RelRef.'''
+		flags = self.refFlags[index]
+		sheet = self.refSheets[index]
+		return excel_lang.RelRef(self.refRows[index], self.refCols[index], bool(flags & ROWABS),
+			bool(flags & COLABS), self.names.lookup(sheet) if sheet >= 0 else None)
+
+	def getRoot(self, workbook, address):
+		'''The root node of the formula of the cell at an address, or -1.'''
+		sheet, row, col = address
+		store = workbook.getData()["worksheets"].get(sheet)
+		slot = store.findSlot(int(row), excel_store.name2col(col)) if store is not None else None
+		id = store.formulas[slot] if slot is not None else -1
+		return int(self.formulaRoots[id]) if 0 <= id < len(self.formulaRoots) else -1
+
+	def getTree(self, text):
+		'''The tree of a formula's body, as toTree gives it, or None if the text
+		was not compiled into the table.'''
+		if self.roots is None:
+			self.roots = dict(zip(self.formulaTable.getValues(), self.formulaRoots))
+		root = self.roots.get(text)
+		if root is None or root < 0:
+			return None
+		tree = self.trees.get(root)
+		if tree is None:
+			tree = self.trees[root] = self.toTree(root)
+		return tree
+
+	def toTree(self, node):
+		'''Turns a node back into a tree of tuples, in the shape the parser gives
+		(without the brackets), to check the table against.'''
+		op = self.ops[node]
+		arg = self.args[node]
+		kind = OPNAMES[op]
+		if op in CONSTANTS:
+			return (kind, self.getConstants()[arg])
+		elif op == RELCELL:
+			return (kind, self.getRef(arg))
+		elif op == RELCELLRANGE:
+			return (kind, self.getRef(arg), self.getRef(arg + 1))
+		elif op == NAME:
+			return (kind, self.names.lookup(arg))
+		operands = tuple(self.toTree(o) for o in self.getOperands(node))
+		if op == FUNC:
+			return (kind, self.names.lookup(arg), operands)
+		elif op in (BINOP, UNOP):
+			return (kind, OPERATORS[arg], operands)
+		return (kind, operands)
+
+	def stats(self):
+		return {'nodes': len(self), 'formulas': len(self.formulaRoots), 'constants': len(self.getConstants()),
+			'references': len(self.refRows), 'operands': len(self.operands)}
+
+
+class CellRoots(dict):
+	'''The cellRoots of a NodeTable, each sheet's array worked out from the
+	formula ids of its store the first time it is asked for.'''
+
+	def __init__(self, table, worksheets):
+		dict.__init__(self)
+		self.table = table
+		self.worksheets = worksheets
+
+	def __missing__(self, sheet):
+		ids = np.frombuffer(self.worksheets[sheet].formulas, dtype=np.int32)
+		roots = np.frombuffer(self.table.formulaRoots, dtype=np.int32)
+		known = (ids >= 0) & (ids < len(roots))
+		self[sheet] = np.where(known, roots[np.where(known, ids, 0)] if len(roots) else -1, -1).astype(np.int32)
+		return self[sheet]
+
+
+def compileWorkbook(workbook):
+	'''Compiles every formula of a workbook into one NodeTable, with the root of
+	each cell's formula in its cellRoots.'''
+	table = NodeTable()
+	data = workbook.getData()
+	table.formulaTable = data["formulas"]
+	# each distinct formula text is interned once per workbook already
+	for text in data["formulas"].getValues():
+		try:
+			table.formulaRoots.append(table.compileFormula(text))
+		except Exception:
+			# left for the parser to report, if the formula is ever evaluated
+			table.formulaRoots.append(-1)
+	table.cellRoots = CellRoots(table, data["worksheets"])
+	return table
+
+
+def formulaTree(workbook, text):
+	'''The parsed body of a formula, from the NodeTable cached with the workbook
+	when it has one that holds the text, otherwise from the parser.'''
+	table = workbook.getData().get("nodeTable")
+	tree = table.getTree(text) if table is not None else None
+	if tree is None:
+		t = excel_lang.parseFormula(text)
+		if t[0] != 'FORMULA':
+			raise Exception("a formula must start with 'FORMULA', either the parser failed of it's an invalid cell")
+		tree = t[1][0]
+	return tree
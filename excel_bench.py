@@ -0,0 +1,207 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import xml.sax
+import numpy as np
+import excel_cache
+import excel_graph
+import excel_grid
+import excel_lang
+import excel_opt
+import excel_parse
+import excel_stats
+import excel_store
+import excel_synth
+
+
+'''
+Times each phase of getting from a workbook to its values, on a synthetic
+workbook from excel_synth, so that versions can be compared.
+
+The phases are
+	saxLoad       loading the XML through ExcelHandler and xml.sax
+	load          loading the XML through FastExcelLoader, the default
+	parallelLoad  loading the worksheets in a pool of --workers processes
+	cacheWrite    writing the workbook cache
+	cacheLoad     opening the workbook again from the cache
+	parse         parsing every distinct formula, with an empty parse cache
+	graph         building the CellGraph, the formulas already parsed
+	optimize      folding constants and sharing subexpressions, see excel_opt
+	evaluate      evaluating the last column of every sheet over the scenarios,
+	              with the first column of the first sheet as the inputs
+Each phase is run repeat times and the fastest time kept. A run is written as
+one JSON object per line, with the workbook shape, the phase times, counts and
+where it ran. The time to import each module in IMPORTBUDGETS, in a fresh
+interpreter, is measured too and checked against its budget. With --stats
+the runs are instrumented, see excel_stats, and the counters are added to
+the result (the instrumentation itself then adds to the times).
+'''
+
+# the most a module may take to import, in seconds, so that short command line
+# runs and worker processes start quickly
+IMPORTBUDGETS = {
+	'excel_lang': 0.02,
+}
+
+PHASES = ('saxLoad', 'load', 'parallelLoad', 'cacheWrite', 'cacheLoad', 'parse', 'graph', 'optimize', 'evaluate')
+
+
+class PhaseTimer():
+	'''Keeps the fastest time of each phase over any number of runs.'''
+
+	def __init__(self):
+		self.seconds = {}
+
+	def time(self, phase, fn, *args):
+		start = time.perf_counter()
+		result = fn(*args)
+		seconds = time.perf_counter() - start
+		if phase not in self.seconds or seconds < self.seconds[phase]:
+			self.seconds[phase] = seconds
+		return result
+
+
+def saxLoad(fileName):
+	handler = excel_parse.ExcelHandler()
+	with open(fileName, 'rb') as source:
+		xml.sax.parse(source, handler)
+	return handler.getWorkbook()
+
+
+def parseAll(workbook):
+	excel_lang.formulaCache.clear()
+	formulas = workbook.getData()['formulas'].getValues()
+	for formula in formulas:
+		excel_lang.parseFormula(formula)
+	return len(formulas)
+
+
+def evaluate(workbook, graph, shape, scenarios, seed):
+	rows, cols = shape['rows'], shape['cols']
+	rnd = np.random.default_rng(seed)
+	inputs = dict((('Sheet1', str(row), 'A'), rnd.random(scenarios)) for row in range(1, rows + 1))
+	outputs = [(excel_synth.sheetName(sheet), str(row), excel_store.col2Name(cols - 1))
+		for sheet in range(shape['sheets']) for row in range(1, rows + 1)]
+	evaluator = excel_grid.IncrementalEvaluator(workbook, outputs, inputs, graph=graph)
+	return len(evaluator.needed)
+
+
+def importTime(module, runs=5):
+	'''The fastest time to import a module in a fresh interpreter, leaving out
+	the start up of the interpreter itself.'''
+	code = ("import sys, time; sys.path.insert(0, %r); start = time.perf_counter(); import %s; "
+		"print(time.perf_counter() - start)") % (os.path.dirname(os.path.abspath(__file__)), module)
+	return min(float(subprocess.check_output([sys.executable, '-c', code])) for run in range(runs))
+
+
+def importTimes():
+	return dict((module, {'seconds': importTime(module), 'budget': budget})
+		for module, budget in IMPORTBUDGETS.items())
+
+
+def overBudget(result):
+	return [module for module, timing in result['imports'].items() if timing['seconds'] > timing['budget']]
+
+
+def gitRevision():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+			cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def runBenchmark(shape, scenarios=100, repeat=1, phases=PHASES, workDir=None, workers=None, stats=False):
+	'''Generates a workbook of the given shape (see excel_synth.generateWorkbook)
+	and times the phases on it. Returns the result as a dict.'''
+	if stats:
+		excel_stats.enable()
+	ownDir = workDir is None
+	workDir = workDir or tempfile.mkdtemp(prefix='xlbench')
+	try:
+		fileName = os.path.join(workDir, 'bench.xml')
+		cacheDir = os.path.join(workDir, 'cache')
+		workbook = excel_synth.generateWorkbook(fileName, **shape)
+		timer = PhaseTimer()
+		counts = {'cells': workbook['cells'], 'formulas': workbook['formulas'], 'bytes': os.path.getsize(fileName)}
+
+		for run in range(repeat):
+			if 'saxLoad' in phases:
+				timer.time('saxLoad', saxLoad, fileName)
+			wb = timer.time('load', excel_parse.loadWorkbook, fileName)
+			if 'parallelLoad' in phases:
+				timer.time('parallelLoad', excel_parse.loadWorkbookParallel, fileName, workers)
+			if 'cacheLoad' in phases:
+				timer.time('cacheWrite', excel_cache.openWorkbook, fileName, True, cacheDir)
+				timer.time('cacheLoad', excel_cache.openWorkbook, fileName, False, cacheDir)
+			counts['distinctFormulas'] = timer.time('parse', parseAll, wb)
+			graph = timer.time('graph', excel_graph.CellGraph, wb)
+			counts['nodes'] = len(graph)
+			counts['removed'] = timer.time('optimize', excel_opt.optimizeGraph, graph)['removed']
+			if 'evaluate' in phases:
+				counts['evaluated'] = timer.time('evaluate', evaluate, wb, graph, shape, scenarios, shape['seed'])
+	finally:
+		if ownDir:
+			shutil.rmtree(workDir, ignore_errors=True)
+		collected = excel_stats.disable() if stats else None
+
+	return {
+		'revision': gitRevision(),
+		'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+		'machine': platform.machine(),
+		'shape': shape,
+		'scenarios': scenarios,
+		'repeat': repeat,
+		'workers': workers or os.cpu_count(),
+		'seconds': dict((phase, timer.seconds[phase]) for phase in PHASES if phase in timer.seconds),
+		'counts': counts,
+		'imports': importTimes(),
+		'peakMemory': excel_parse.peakMemory(),
+		'stats': collected.report() if collected is not None else None,
+	}
+
+
+def report(result, out=sys.stderr):
+	counts = result['counts']
+	print("%d cells, %d formulas (%d distinct), %d nodes, %d formula nodes optimised away" % (counts['cells'],
+		counts['formulas'], counts['distinctFormulas'], counts['nodes'], counts['removed']), file=out)
+	for phase, seconds in result['seconds'].items():
+		print("  %-12s %9.4fs" % (phase, seconds), file=out)
+	for module, timing in result['imports'].items():
+		print("  import %-12s %9.4fs (budget %.4fs)%s" % (module, timing['seconds'], timing['budget'],
+			" OVER BUDGET" if timing['seconds'] > timing['budget'] else ""), file=out)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Times loading, parsing and evaluating a synthetic workbook.")
+	excel_synth.addArguments(parser)
+	parser.add_argument('--scenarios', type=int, default=100, help="scenario values per input")
+	parser.add_argument('--repeat', type=int, default=1, help="runs per phase, the fastest is kept")
+	parser.add_argument('--skip', action='append', default=[], choices=('saxLoad', 'parallelLoad', 'cacheLoad', 'evaluate'),
+		help="leave a slow phase out")
+	parser.add_argument('--workers', type=int, default=None, help="processes for parallelLoad, one per core by default")
+	parser.add_argument('--check-imports', dest='checkImports', action='store_true',
+		help="exit with an error if a module takes longer to import than its budget")
+	parser.add_argument('--stats', action='store_true', help="instrument the runs and add the counters to the result")
+	parser.add_argument('--output', default='-', help="a file to append the JSON result to, - for stdout")
+	args = parser.parse_args()
+
+	result = runBenchmark(excel_synth.shapeOf(args), args.scenarios, args.repeat,
+		[phase for phase in PHASES if phase not in args.skip], workers=args.workers, stats=args.stats)
+	report(result)
+	line = json.dumps(result, sort_keys=True)
+	if args.output == '-':
+		print(line)
+	else:
+		with open(args.output, 'a') as f:
+			f.write(line + '\n')
+	if args.checkImports and overBudget(result):
+		sys.exit(1)
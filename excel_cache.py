@@ -0,0 +1,252 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import excel_ast
+import excel_parse
+import excel_stats
+import excel_store
+
+
+'''
+An on-disk cache of loaded workbooks, in place of pickling the whole ExcelWB.
+
+A cache file is only used when its format version matches and it was written
+from the same source file (path, size, mtime and, when the mtime has moved, a
+hash of the content). The per cell arrays of each worksheet are written out
+sorted by row and column, so that reading a cache back only maps the file into
+memory; pages of a worksheet are read when its cells are first looked at, and
+processes reading the same cache share those pages.
+
+The layout of a cache file is
+	MAGIC, then the format version and the header length as '<IQ'
+	a JSON header describing the source, names and where everything lives
+	the intern tables as JSON lists and the sheet arrays, 8 byte aligned
+	the excel_ast.NodeTable of every formula, its arrays and, as JSON, its
+	constants and names
+'''
+
+
+MAGIC = b'XLCACHE\x00'
+VERSION = 3     # 3: names local to a sheet
+PREAMBLE = struct.Struct('<IQ')
+CACHEDIR = '.xlcache'
+# room left at the end of a header for it to be rewritten a little longer
+HEADERSLACK = 64
+
+
+def sourceKey(sourceFileName, contentHash=True):
+	'''Identifies the exact source file a cache was written from.'''
+	st = os.stat(sourceFileName)
+	key = {
+		'path': os.path.abspath(sourceFileName),
+		'size': st.st_size,
+		'mtime': st.st_mtime_ns,
+	}
+	if contentHash:
+		key['sha1'] = hashFile(sourceFileName)
+	return key
+
+
+def hashFile(fileName):
+	digest = hashlib.sha1()
+	with open(fileName, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+def cachePath(sourceFileName, cacheDir=CACHEDIR):
+	'''Where the cache of a source file lives, one file per source path.'''
+	name = hashlib.sha1(os.path.abspath(sourceFileName).encode('utf-8')).hexdigest()[:16]
+	return os.path.join(cacheDir, name + '.xlc')
+
+
+def writeCache(workbook, sourceFileName, cacheFileName):
+	'''Writes the workbook out in the cache format, replacing any older cache
+	in one step so that a reader never sees a half written file.'''
+	data = workbook.getData()
+	sections = []
+	offset = 0
+
+	def addSection(payload):
+		nonlocal offset
+		start = offset
+		sections.append(payload)
+		offset += len(payload)
+		pad = -offset % 8
+		if pad:
+			sections.append(b'\0' * pad)
+			offset += pad
+		return start
+
+	tables = {}
+	for table in ('datatypes', 'strings', 'formulas'):
+		payload = json.dumps(data[table].getValues()).encode('utf-8')
+		tables[table] = [addSection(payload), len(payload)]
+
+	sheets = []
+	for name, store in data['worksheets'].items():
+		sortedArrays = store.sortedArrays()
+		arrays = {}
+		for field in excel_store.ARRAYFIELDS:
+			arrays[field] = addSection(sortedArrays[field].tobytes())
+		sheets.append({'name': name, 'count': len(store), 'arrays': arrays})
+
+	# the formulas compiled once here, so that no later load has to parse them
+	table = data.get('nodeTable')
+	if table is None or len(table.formulaRoots) != len(data['formulas']):
+		table = excel_ast.compileWorkbook(workbook)
+	nodeTable = {'arrays': {}}
+	for field in excel_ast.TYPECODES:
+		values = getattr(table, field)
+		nodeTable['arrays'][field] = [addSection(bytes(memoryview(values).cast('B'))), len(values)]
+	for field, values in (('constants', table.getConstants()), ('names', table.names.getValues())):
+		payload = json.dumps(values).encode('utf-8')
+		nodeTable[field] = [addSection(payload), len(payload)]
+	data['nodeTable'] = table
+
+	header = {
+		'source': sourceKey(sourceFileName),
+		'byteorder': sys.byteorder,
+		'fileName': workbook.getFileName(),
+		'namedCells': data['namedCells'],
+		'namedRanges': data['namedRanges'],
+		'tables': tables,
+		'sheets': sheets,
+		'nodeTable': nodeTable,
+	}
+	headerBytes = json.dumps(header).encode('utf-8') + b' ' * HEADERSLACK
+	headerBytes += b' ' * (-(len(MAGIC) + PREAMBLE.size + len(headerBytes)) % 8)
+
+	# the section offsets are relative to the end of the header, which is only
+	# known now, so they are stored that way and added to base when read
+	os.makedirs(os.path.dirname(cacheFileName) or '.', exist_ok=True)
+	tmpFileName = cacheFileName + '.tmp' + str(os.getpid())
+	with open(tmpFileName, 'wb') as f:
+		f.write(MAGIC)
+		f.write(PREAMBLE.pack(VERSION, len(headerBytes)))
+		f.write(headerBytes)
+		for payload in sections:
+			f.write(payload)
+	os.replace(tmpFileName, cacheFileName)
+
+
+def readHeader(cacheFileName):
+	'''Returns (header, base offset) of a cache file, or None if the file is
+	not a cache of the current format version.'''
+	try:
+		with open(cacheFileName, 'rb') as f:
+			preamble = f.read(len(MAGIC) + PREAMBLE.size)
+			if len(preamble) != len(MAGIC) + PREAMBLE.size or preamble[:len(MAGIC)] != MAGIC:
+				return None
+			version, headerLength = PREAMBLE.unpack(preamble[len(MAGIC):])
+			if version != VERSION:
+				return None
+			header = json.loads(f.read(headerLength).decode('utf-8'))
+	except (OSError, ValueError):
+		return None
+	if header.get('byteorder') != sys.byteorder:
+		return None
+	return header, len(MAGIC) + PREAMBLE.size + headerLength
+
+
+def isFresh(header, sourceFileName, cacheFileName=None):
+	'''Whether a cache header still describes the source file. The content is
+	only hashed when the size matches but the mtime does not, and if it is
+	the same the new mtime is written into the header of cacheFileName, so
+	that it is not hashed again on every open.'''
+	cached = header['source']
+	current = sourceKey(sourceFileName, contentHash=False)
+	if cached['path'] != current['path'] or cached['size'] != current['size']:
+		return False
+	if cached['mtime'] == current['mtime']:
+		return True
+	if cached['sha1'] != hashFile(sourceFileName):
+		return False
+	cached['mtime'] = current['mtime']
+	if cacheFileName is not None:
+		rewriteHeader(cacheFileName, header)
+	return True
+
+
+def rewriteHeader(cacheFileName, header):
+	'''Writes a changed header over the old one in place, when it fits in the
+	room the old one (and its padding) took up. If it does not, or the cache
+	cannot be written to, the old header is left, it is only slower.'''
+	headerBytes = json.dumps(header).encode('utf-8')
+	try:
+		with open(cacheFileName, 'r+b') as f:
+			preamble = f.read(len(MAGIC) + PREAMBLE.size)
+			version, headerLength = PREAMBLE.unpack(preamble[len(MAGIC):])
+			if preamble[:len(MAGIC)] != MAGIC or len(headerBytes) > headerLength:
+				return
+			f.write(headerBytes + b' ' * (headerLength - len(headerBytes)))
+	except OSError:
+		pass
+
+
+def readCache(cacheFileName, header, base):
+	'''Maps a cache file into memory and builds an ExcelWB over it. Nothing is
+	copied out of the map, the sheet arrays are memoryviews into it.'''
+	with open(cacheFileName, 'rb') as f:
+		mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+	view = memoryview(mapped)
+
+	wb = excel_parse.ExcelWB()
+	data = wb.getData()
+	wb.setFileName(header['fileName'])
+	data['namedCells'] = dict((name, [tuple(ref) for ref in refs]) for name, refs in header['namedCells'].items())
+	data['namedRanges'] = header['namedRanges']
+	wb.indexNames()
+	data['mapped'] = mapped     # keeps the map alive as long as the workbook
+
+	def tableLoader(start, length):
+		return lambda: json.loads(bytes(view[base + start:base + start + length]).decode('utf-8'))
+	for table, (start, length) in header['tables'].items():
+		data[table] = excel_store.InternTable(tableLoader(start, length))
+
+	for sheet in header['sheets']:
+		arrays = {}
+		for field, start in sheet['arrays'].items():
+			typecode = excel_store.TYPECODES[field]
+			size = struct.calcsize(typecode) * sheet['count']
+			arrays[field] = view[base + start:base + start + size].cast(typecode)
+		data['worksheets'][sheet['name']] = excel_store.SheetStore.fromBuffers(sheet['name'],
+			data['datatypes'], data['strings'], data['formulas'], arrays)
+
+	nodeTable = header['nodeTable']
+	arrays = {}
+	for field, (start, count) in nodeTable['arrays'].items():
+		typecode = excel_ast.TYPECODES[field]
+		arrays[field] = view[base + start:base + start + struct.calcsize(typecode) * count].cast(typecode)
+	data['nodeTable'] = excel_ast.NodeTable.fromBuffers(arrays, tableLoader(*nodeTable['constants']),
+		excel_store.InternTable(tableLoader(*nodeTable['names'])), data['formulas'], data['worksheets'])
+	return wb
+
+
+def openWorkbook(sourceFileName, refresh=False, cacheDir=CACHEDIR, workers=1):
+	'''Returns the workbook for an Excel 2003 XML or .xlsx file, from its cache
+	when that is still fresh, otherwise loading the file (with workers
+	processes, see excel_parse.loadWorkbook) and writing a new cache.'''
+	cacheFileName = cachePath(sourceFileName, cacheDir)
+	if not refresh:
+		found = readHeader(cacheFileName)
+		if found and isFresh(found[0], sourceFileName, cacheFileName):
+			stats = excel_stats.current
+			if stats is not None:
+				stats.count('cacheHits')
+				excel_stats.trace('cache', fileName=sourceFileName, hit=True)
+			with excel_stats.phase('cacheLoad'):
+				return readCache(cacheFileName, *found)
+
+	stats = excel_stats.current
+	if stats is not None:
+		stats.count('cacheMisses')
+		excel_stats.trace('cache', fileName=sourceFileName, hit=False)
+	wb = excel_parse.loadWorkbook(sourceFileName, workers)
+	with excel_stats.phase('cacheWrite'):
+		writeCache(wb, sourceFileName, cacheFileName)
+	return wb
@@ -0,0 +1,518 @@
+import re
+import numpy as np
+import excel_graph
+import excel_grid
+import excel_stats
+
+
+'''
+Compiles the calculation behind a set of output cells into a kernel.
+
+The cone of the outputs is lowered, in topological order, to straight-line
+code with one statement per cell, the way the old CODE: lines described it.
+The Python version is compiled in process into a NumPy function with a fixed
+signature (one array per input cell, one array back per output cell), so
+after compiling once a call does no tree walking, dict lookups or parsing.
+The same lowering can also be written out as the source of a CUDA-C kernel,
+one thread per scenario.
+
+Each cell's value is given a type while lowering, 'num', 'bool', 'text' or
+'any' when it can only be known at run time. Operations on numbers are
+written out as plain NumPy expressions, anything else goes through the
+helpers of excel_grid.
+'''
+
+# names the generated Python code can refer to
+RUNTIME = {
+	'np': np,
+	'_num': excel_grid.asNumber,
+	'_text': excel_grid.asText,
+	'_binop': excel_grid.binop,
+	'_round': excel_grid.excelRound,
+	'_agg': excel_grid.aggregate,
+	'_select': excel_grid.select,
+	'_iferror': excel_grid.iferror,
+	'_vlookup': excel_grid.lookup,
+}
+
+IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+PYOPS = {'+': '+', '-': '-', '*': '*', '/': '/', '=': '==', '<>': '!=',
+	'>': '>', '<': '<', '>=': '>=', '<=': '<='}
+
+NUMFOLDS = {'SUM': '+', 'MAX': 'np.maximum', 'MIN': 'np.minimum'}
+
+
+class CompiledKernel():
+	'''A compiled calculation, call it with one array (or scalar) per input in
+	the order of inputs, and it returns a tuple with one array per output.'''
+
+	def __init__(self, inputs, outputs, source, function, compiler):
+		self.inputs = inputs
+		self.outputs = outputs
+		self.source = source
+		self.function = function
+		self.compiler = compiler
+
+	def __call__(self, *args):
+		if len(args) != len(self.inputs):
+			raise Exception("kernel takes " + str(len(self.inputs)) + " inputs, " + str(len(args)) + " given")
+		return self.function(*args)
+
+	def call(self, inputs):
+		'''Calls the kernel with a dict of input arrays, keyed like the inputs
+		the kernel was compiled with.'''
+		return self.function(*[inputs[ref] for ref in self.inputs])
+
+	def coneSize(self):
+		'''The number of cells the kernel works with, inputs and outputs included.'''
+		return len(self.nodes)
+
+	def cudaSource(self, name='xlkernel'):
+		return self.compiler.cudaSource(self, name)
+
+	def writeCuda(self, fileName, name='xlkernel'):
+		'''Writes the CUDA-C source of the kernel out, as an artifact.'''
+		with open(fileName, 'w') as f:
+			f.write(self.cudaSource(name))
+
+
+class KernelCompiler():
+
+	def __init__(self, workbook, graph=None):
+		self.wb = workbook
+		# by default only the cones of the outputs compiled are ever read
+		self.graph = graph if graph is not None else excel_graph.CellGraph(workbook, [])
+
+	def compile(self, outputs, inputs=()):
+		'''Lowers the cone of the outputs, cutting it at the input cells, and
+		compiles it into a CompiledKernel.'''
+		graph = self.graph
+		inputs = list(inputs)
+		outputs = list(outputs)
+		inNodes = graph.addInputs([self.wb.resolveAddress(ref) for ref in inputs])
+		outNodes = graph.include(outputs)
+		nodes = graph.order(outNodes, inNodes)
+
+		self.names = {}
+		self.types = {}
+		self.blocks = {}        # name -> ConstantBlock for the 'any' aggregates, or LookupTable
+		self.ranges = {}
+		self.bound = dict.fromkeys(graph.addresses[n] for n in inNodes)
+		self.used = set()
+		self.sharedNames = {}   # expression id -> (name, type), see excel_opt
+		self.prelude = []       # statements the next cell needs first
+		for node in nodes:
+			self.names[node] = varName(graph.addresses[node], node)
+		# an input the outputs don't depend on is still a parameter, just never read
+		for node in inNodes:
+			if node not in self.names:
+				self.names[node] = varName(graph.addresses[node], node)
+				self.types[node] = 'num'
+
+		statements = []
+		params = [self.names[n] for n in inNodes]
+		for node in nodes:
+			if node in inNodes:
+				cell = graph.cells[node]
+				self.types[node] = 'text' if cell and cell.getDataType() == 'String' else 'num'
+				if self.types[node] == 'num':
+					statements.append((node, self.names[node] + " = np.asarray(" + self.names[node] + ", dtype=float)"))
+				continue
+			code, kind = self.lowerCell(node)
+			self.types[node] = kind
+			statements.extend((None, line) for line in self.prelude)
+			self.prelude = []
+			statements.append((node, self.names[node] + " = " + code))
+		kernelNodes = [n for n in nodes if self.isKept(n, inNodes, outNodes)]
+
+		lines = []
+		lines.append("def kernel(" + ", ".join(params) + "):")
+		lines.append("\twith np.errstate(all='ignore'):")
+		kept = [statement for node, statement in statements if node is None or self.isKept(node, inNodes, outNodes)]
+		for statement in releaseDead(kept, set(params) | set(self.names[n] for n in outNodes)):
+			lines.append("\t\t" + statement)
+		# every output is stretched out to the number of scenarios
+		lines.append("\t\tn = max([np.size(a) for a in (" + "".join(p + ", " for p in params) + ")] or [1])")
+		lines.append("\t\treturn (" + "".join("np.broadcast_to(np.asarray(" + self.names[n] + "), (n,)), " for n in outNodes) + ")")
+		source = "\n".join(lines) + "\n"
+
+		namespace = dict(RUNTIME)
+		namespace.update(self.blocks)
+		exec(compile(source, "<excel kernel>", "exec"), namespace)
+		kernel = CompiledKernel(inputs, outputs, source, namespace['kernel'], self)
+		kernel.nodes = kernelNodes
+		kernel.inNodes = inNodes
+		kernel.outNodes = outNodes
+		kernel.names = dict(self.names)
+		kernel.types = dict(self.types)
+		return kernel
+
+	def lowerCell(self, node):
+		'''Python code for the value of a cell, and its type.'''
+		graph = self.graph
+		if graph.trees[node] is not None:
+			return self.lower(graph.trees[node], graph.cells[node])
+		if graph.cells[node] is None:
+			return "0.0", 'num'     # an empty cell reads as zero
+		value = excel_grid.constantValue(graph.cells[node].getData())
+		return literal(value)
+
+	def lower(self, t, cell):
+		'''Python code for a node of a parsed formula, and its type.'''
+		kind = t[0]
+		if kind in ('NUMBER', 'STRING', 'BOOL'):
+			return literal(t[1] if kind != 'NUMBER' else float(t[1]))
+		elif kind == 'RELCELL':
+			return self.reference(cell.calcOffset(t[1]))
+		elif kind == 'NAME':
+			return self.reference(self.wb.resolveAddress(self.wb.scopedName(t[1], cell.sheet)))
+		elif kind == 'CELLREF':
+			return self.reference(t[1])
+		elif kind == 'SHARED':
+			# worked out once, into a variable of its own, before its first use
+			if t[1] not in self.sharedNames:
+				code, sharedKind = self.lower(self.graph.shared[t[1]], cell)
+				self.sharedNames[t[1]] = ("_s" + str(t[1]), sharedKind)
+				self.prelude.append("_s" + str(t[1]) + " = " + code)
+			return self.sharedNames[t[1]]
+		elif kind == 'SUBEXP':
+			return self.lower(t[1][0], cell)
+		elif kind == 'UNOP':
+			code, argKind = self.lower(t[2][0], cell)
+			return "(-" + numeric(code, argKind) + ")", 'num'
+		elif kind == 'BINOP':
+			return self.lowerBinop(t[1], self.lower(t[2][0], cell), self.lower(t[2][1], cell))
+		elif kind == 'FUNC':
+			return self.lowerFunction(t[1], t[2], cell)
+		raise Exception("ERROR: type " + str(kind) + " not supported yet!")
+
+	def isKept(self, node, inNodes, outNodes):
+		'''Constant cells only read inside a range are folded into the range's
+		block, so they need no statement of their own.'''
+		return self.graph.trees[node] is not None or node in inNodes or node in outNodes or node in self.used
+
+	def reference(self, address):
+		node = self.graph.index[address]
+		self.used.add(node)
+		return self.names[node], self.types[node]
+
+	def rangeParts(self, arg, cell):
+		'''The ConstantBlock of a range and the addresses of the cells in it that
+		are calculated or inputs, see excel_grid.splitRange.'''
+		bounds = excel_graph.rangeOf(self.wb, arg, cell)
+		if bounds not in self.ranges:
+			self.ranges[bounds] = excel_grid.splitRange(self.wb, bounds, self.bound)
+		return self.ranges[bounds]
+
+	def lowerBinop(self, op, left, right):
+		(a, aKind), (b, bKind) = left, right
+		if op == '&':
+			# an error joined to text stays an error, so this can be mixed
+			return "_binop('&', " + a + ", " + b + ")", 'any'
+		if op in excel_grid.COMPARISONS:
+			if aKind == bKind == 'bool':
+				return "(" + a + " " + PYOPS[op] + " " + b + ")", 'bool'
+			# a number may be an error, which a comparison gives back, text
+			# against text compares as text and text against a number may give
+			# an error, so all of it is left to run time
+			return "_binop(" + repr(op) + ", " + a + ", " + b + ")", 'bool' if aKind == bKind == 'text' else 'any'
+		if op in ('^', '/'):
+			# through numpy even for two literals, so 1/0 gives an error value
+			# rather than raising
+			return ("np.power(" if op == '^' else "np.divide(") + numeric(a, aKind) + ", " + numeric(b, bKind) + ")", 'num'
+		return "(" + numeric(a, aKind) + " " + PYOPS[op] + " " + numeric(b, bKind) + ")", 'num'
+
+	def lowerFunction(self, name, args, cell):
+		if name == 'PI':
+			return "np.pi", 'num'
+
+		if name == 'IF':
+			if len(args) != 3:
+				raise Exception("IF function requires exactly 3 arguments, " + str(len(args)) + " given")
+			cond, condKind = self.lower(args[0], cell)
+			(a, aKind), (b, bKind) = self.lower(args[1], cell), self.lower(args[2], cell)
+			if condKind == 'bool' and aKind == bKind != 'any':
+				return "np.where(" + cond + ", " + a + ", " + b + ")", aKind
+			# the condition may be an error, or the arms text and a number
+			return "_select(" + cond + ", " + a + ", " + b + ")", aKind if aKind == bKind else 'any'
+
+		if name == 'IFERROR':
+			if len(args) != 2:
+				raise Exception("IFERROR function requires exactly 2 arguments, " + str(len(args)) + " given")
+			(a, aKind), (b, bKind) = self.lower(args[0], cell), self.lower(args[1], cell)
+			return "_iferror(" + a + ", " + b + ")", aKind if aKind == bKind else 'any'
+
+		if name == 'ROUND':
+			if len(args) != 2:
+				raise Exception("ROUND function requires exactly 2 arguments, " + str(len(args)) + " given")
+			(a, aKind), (b, bKind) = self.lower(args[0], cell), self.lower(args[1], cell)
+			return "_round(" + a + ", " + b + ")", 'num'
+
+		if name == 'VLOOKUP':
+			if len(args) not in (3, 4):
+				raise Exception("VLOOKUP function requires 3 or 4 arguments, " + str(len(args)) + " given")
+			bounds = excel_graph.rangeOf(self.wb, args[1], cell)
+			if bounds is None:
+				raise Exception("VLOOKUP needs a range or a named range as its table, not " + str(args[1][0]))
+			# the table is indexed now, once, and handed to the kernel
+			table = excel_grid.lookupTable(self.wb, bounds, self.bound)
+			tableName = next((n for n, b in self.blocks.items() if b is table), None)
+			if tableName is None:
+				tableName = "_table" + str(len(self.blocks))
+				self.blocks[tableName] = table
+			dynamic = ", ".join(repr(position) + ": " + self.reference(address)[0]
+				for position, address in excel_grid.tableCells(table, self.bound))
+			key, col = self.lower(args[0], cell)[0], self.lower(args[2], cell)[0]
+			if len(args) == 3:
+				exact = "False"
+			elif args[3][0] in ('BOOL', 'NUMBER'):
+				exact = repr(not float(args[3][1]))
+			else:
+				exact = "np.all(_num(" + self.lower(args[3], cell)[0] + ") == 0)"
+			return "_vlookup(" + tableName + ", " + key + ", " + col + ", " + exact + ", {" + dynamic + "})", 'any'
+
+		if name in excel_grid.AGGREGATES:
+			blocks = []
+			values = []
+			for arg in args:
+				if excel_graph.rangeOf(self.wb, arg, cell) is not None:
+					block, addresses = self.rangeParts(arg, cell)
+					if block.count:
+						blocks.append(block)
+					values.extend(self.reference(a) for a in addresses)
+				else:
+					values.append(self.lower(arg, cell))
+			# text is skipped by the aggregates, which is known here unless a
+			# value can only be typed at run time
+			values = [v for v in values if v[1] != 'text']
+			if not values and not blocks:
+				return "0.0", 'num'
+			if any(kind == 'any' for code, kind in values):
+				names = []
+				for block in blocks:
+					names.append("_block" + str(len(self.blocks)))
+					self.blocks[names[-1]] = block
+				return "_agg(" + repr(name) + ", [" + ", ".join(names + [code for code, kind in values]) + "])", 'num'
+			# the constant part of each range is reduced now, once
+			codes = [numeric(code, kind) for code, kind in values]
+			if name == 'AVG':
+				count = sum(block.count for block in blocks) + len(codes)
+				codes = [pyNumber(block.reduce('SUM')) for block in blocks] + codes
+				return "(" + fold('+', codes) + " / " + str(float(count)) + ")", 'num'
+			codes = [pyNumber(block.reduce(name)) for block in blocks] + codes
+			return fold(NUMFOLDS[name], codes), 'num'
+
+		raise Exception("ERROR: " + name + " function not written yet!")
+
+	def cudaSource(self, kernel, name='xlkernel'):
+		'''The kernel as CUDA-C, one thread per scenario. Every value must be a
+		number (or boolean), text has no place on the device.'''
+		graph = self.graph
+		self.names = kernel.names
+		self.types = kernel.types
+		self.bound = dict.fromkeys(graph.addresses[n] for n in kernel.inNodes)
+		self.ranges = {}
+		self.sharedNames = {}
+		self.prelude = []
+		params = ["const double* __restrict__ in_" + kernel.names[n] for n in kernel.inNodes]
+		params += ["double* __restrict__ out_" + kernel.names[n] for n in kernel.outNodes]
+		params.append("const int n")
+		lines = [
+			"// generated from " + str(self.wb.getFileName()) + " for " + ", ".join(str(o) for o in kernel.outputs),
+			"#include <math.h>",
+			"",
+			"// IF and IFERROR, errors are NaN or inf as in excel_grid",
+			"__device__ inline double xl_select(double c, double a, double b) { return isfinite(c) ? (c != 0 ? a : b) : c; }",
+			"__device__ inline double xl_iferror(double a, double b) { return isfinite(a) ? a : b; }",
+			"// a comparison of an error is the error",
+			"__device__ inline double xl_compare(double a, double b, double r) { return isfinite(a) ? (isfinite(b) ? r : b) : a; }",
+			"",
+			'extern "C" __global__ void ' + name + "(" + ", ".join(params) + ")",
+			"{",
+			"\tconst int i = blockIdx.x * blockDim.x + threadIdx.x;",
+			"\tif (i >= n) return;",
+		]
+		for node in kernel.nodes:
+			if kernel.types[node] == 'text':
+				raise Exception("cell " + str(graph.addresses[node]) + " holds text and cannot be lowered to CUDA")
+			if node in kernel.inNodes:
+				code = "in_" + kernel.names[node] + "[i]"
+			elif graph.trees[node] is not None:
+				code = self.lowerC(graph.trees[node], graph.cells[node])
+			elif graph.cells[node] is None:
+				code = "0.0"
+			else:
+				code = cLiteral(excel_grid.constantValue(graph.cells[node].getData()), graph.addresses[node])
+			lines.extend("\t" + line for line in self.prelude)
+			self.prelude = []
+			lines.append("\tconst double " + kernel.names[node] + " = " + code + ";")
+		for node in kernel.outNodes:
+			lines.append("\tout_" + kernel.names[node] + "[i] = " + kernel.names[node] + ";")
+		lines.append("}")
+		return "\n".join(lines) + "\n"
+
+	def lowerC(self, t, cell):
+		'''C code for a node of a parsed formula, numbers only.'''
+		kind = t[0]
+		if kind in ('NUMBER', 'BOOL', 'STRING'):
+			return cLiteral(t[1], cell.getAddress())
+		elif kind == 'RELCELL':
+			return self.names[self.graph.index[cell.calcOffset(t[1])]]
+		elif kind == 'NAME':
+			return self.names[self.graph.index[self.wb.resolveAddress(self.wb.scopedName(t[1], cell.sheet))]]
+		elif kind == 'CELLREF':
+			return self.names[self.graph.index[t[1]]]
+		elif kind == 'SHARED':
+			if t[1] not in self.sharedNames:
+				self.prelude.append("const double _s" + str(t[1]) + " = " + self.lowerC(self.graph.shared[t[1]], cell) + ";")
+				self.sharedNames[t[1]] = "_s" + str(t[1])
+			return self.sharedNames[t[1]]
+		elif kind == 'SUBEXP':
+			return self.lowerC(t[1][0], cell)
+		elif kind == 'UNOP':
+			return "(-" + self.lowerC(t[2][0], cell) + ")"
+		elif kind == 'BINOP':
+			a, b = self.lowerC(t[2][0], cell), self.lowerC(t[2][1], cell)
+			if t[1] == '^':
+				return "pow(" + a + ", " + b + ")"
+			if t[1] == '&':
+				raise Exception("cell " + str(cell.getAddress()) + " joins text and cannot be lowered to CUDA")
+			if t[1] in excel_grid.COMPARISONS:
+				return "xl_compare(" + a + ", " + b + ", (" + a + " " + PYOPS[t[1]] + " " + b + "))"
+			return "(" + a + " " + PYOPS[t[1]] + " " + b + ")"
+		elif kind == 'FUNC':
+			name, args = t[1], t[2]
+			if name == 'PI':
+				return "M_PI"
+			if name == 'IF':
+				return "xl_select(" + ", ".join(self.lowerC(a, cell) for a in args) + ")"
+			if name == 'IFERROR':
+				return "xl_iferror(" + ", ".join(self.lowerC(a, cell) for a in args) + ")"
+			if name == 'ROUND':
+				# round() in C also takes halves away from zero
+				scale = "pow(10.0, " + self.lowerC(args[1], cell) + ")"
+				return "(round(" + self.lowerC(args[0], cell) + " * " + scale + ") / " + scale + ")"
+			if name == 'VLOOKUP':
+				raise Exception("cell " + str(cell.getAddress()) + " uses VLOOKUP, which cannot be lowered to CUDA")
+			if name in excel_grid.AGGREGATES:
+				blocks = []
+				codes = []
+				for arg in args:
+					if excel_graph.rangeOf(self.wb, arg, cell) is not None:
+						block, addresses = self.rangeParts(arg, cell)
+						if block.count:
+							blocks.append(block)
+						for a in addresses:
+							node = self.graph.index[a]
+							if self.types[node] != 'text':
+								codes.append(self.names[node])
+					else:
+						codes.append(self.lowerC(arg, cell))
+				if not codes and not blocks:
+					return "0.0"
+				if name == 'AVG':
+					count = sum(block.count for block in blocks) + len(codes)
+					codes = [cNumber(block.reduce('SUM')) for block in blocks] + codes
+					return "(" + fold('+', codes) + " / " + str(float(count)) + ")"
+				codes = [cNumber(block.reduce(name)) for block in blocks] + codes
+				return fold({'SUM': '+', 'MAX': 'fmax', 'MIN': 'fmin'}[name], codes)
+			raise Exception("ERROR: " + name + " function not written yet!")
+		raise Exception("ERROR: type " + str(kind) + " not supported yet!")
+
+
+def compileKernel(workbook, outputs, inputs=(), graph=None):
+	'''Compiles the outputs of a workbook into a CompiledKernel.'''
+	with excel_stats.phase('compile'):
+		kernel = KernelCompiler(workbook, graph).compile(outputs, inputs)
+	stats = excel_stats.current
+	if stats is not None:
+		stats.count('kernelsCompiled')
+	return kernel
+
+
+def releaseDead(statements, keep=()):
+	'''The statements, each a "name = code" assignment, with a del after the
+	last read of every variable but those in keep, so that a call holds on to
+	no more intermediate arrays than are still to be read and the memory of
+	one is reused for the next.'''
+	defined = [statement.split(' = ', 1)[0] for statement in statements]
+	lastRead = dict((name, i) for i, name in enumerate(defined))
+	for i, statement in enumerate(statements):
+		for name in IDENTIFIER.findall(statement.split(' = ', 1)[1]):
+			if name in lastRead:
+				lastRead[name] = i
+	dead = {}
+	for name, i in lastRead.items():
+		if name not in keep:
+			dead.setdefault(i, []).append(name)
+	released = []
+	for i, statement in enumerate(statements):
+		released.append(statement)
+		if i in dead:
+			released.append("del " + ", ".join(dead[i]))
+	return released
+
+
+def varName(address, node):
+	'''A variable name for a cell, Sheet1__D__2 as in the old CODE: lines.'''
+	name = address[0] + "__" + address[2] + "__" + str(address[1])
+	name = re.sub(r'\W', '_', name)
+	if not re.match(r'[A-Za-z_]', name):
+		name = "c" + str(node) + "_" + name
+	return name
+
+
+def literal(value):
+	'''Python code for a constant, and its type.'''
+	if isinstance(value, (bool, np.bool_)):
+		return repr(bool(value)), 'bool'
+	if isinstance(value, str):
+		return repr(value), 'text'
+	return pyNumber(value), 'num'
+
+
+def cLiteral(value, address):
+	if isinstance(value, (bool, np.bool_)):
+		return "1.0" if value else "0.0"
+	if isinstance(value, str):
+		raise Exception("cell " + str(address) + " holds text and cannot be lowered to CUDA")
+	return cNumber(value)
+
+
+def pyNumber(value):
+	'''Python code for a float, inf and NaN (errors) included.'''
+	value = float(value)
+	if np.isnan(value):
+		return "np.nan"
+	if np.isinf(value):
+		return "np.inf" if value > 0 else "(-np.inf)"
+	return repr(value)
+
+
+def cNumber(value):
+	'''C code for a double, inf and NaN (errors) included.'''
+	value = float(value)
+	if np.isnan(value):
+		return "NAN"
+	if np.isinf(value):
+		return "INFINITY" if value > 0 else "(-INFINITY)"
+	return repr(value)
+
+
+def numeric(code, kind):
+	'''Wraps the code of a value so that it reads as a number.'''
+	if kind == 'num':
+		return code
+	return "_num(" + code + ")"
+
+
+def fold(op, codes):
+	'''Folds a list of values with an infix operator or a two argument function.'''
+	acc = codes[0]
+	for code in codes[1:]:
+		if op.isalnum() or '.' in op:
+			acc = op + "(" + acc + ", " + code + ")"
+		else:
+			acc = "(" + acc + " " + op + " " + code + ")"
+	return acc
@@ -0,0 +1,419 @@
+import numpy as np
+import excel_ast
+import excel_stats
+import excel_store
+
+
+'''
+The dependency graph of a workbook.
+
+Every populated (or referenced) cell address is a node, numbered in the order
+it was added, except the constants of ranges: only the formulas in a range,
+and inputs bound in it, are nodes, the rest is read as one block. Given
+outputs, the graph holds only their cone of influence instead, the outputs and
+everything they read, directly or not, and no other cell of the workbook is
+looked at; more cells are brought in by include(). Formula cells are parsed
+once while the graph is built, and the cells each formula refers to become its
+deduplicated list of precedents. The evaluators and code generators walk the
+graph in topological order instead of re-walking the formula trees, so a
+shared precedent is only ever visited once.
+'''
+
+class CellGraph():
+
+	def __init__(self, workbook, outputs=None):
+		self.wb = workbook
+		self.outputs = None if outputs is None else [workbook.resolveAddress(o) for o in outputs]
+		self.index = {}         # address -> node id
+		self.addresses = []     # node id -> (sheet, row, col)
+		self.cells = []         # node id -> ExcelCell, None for an empty cell
+		self.trees = []         # node id -> parsed formula body, None for a constant
+		self.precedents = []    # node id -> list of node ids the node reads
+		self.ranges = []        # node id -> list of the bounds of the ranges it reads
+		self.readers = {}       # range bounds -> node ids of the formulas reading it
+		self.inputs = set()     # addresses bound as inputs, see addInputs
+		self.dependents = None  # node id -> list of node ids reading it, built when needed
+		self.position = None    # node id -> place in the topological order
+		self.shared = {}        # expression id -> tree, see excel_opt
+		self._orders = {}
+		with excel_stats.phase('graph'):
+			self.build()
+		stats = excel_stats.current
+		if stats is not None:
+			stats.count('graphNodes', len(self.addresses))
+
+	def build(self):
+		addresses = self.wb.getAddresses() if self.outputs is None else self.outputs
+		for address in list(addresses):
+			self.addNode(address)
+		# formulas add the cells they read to the end of the list as we go
+		node = 0
+		while node < len(self.addresses):
+			self.parseNode(node)
+			node += 1
+
+	def include(self, refs):
+		'''The node ids of cells (any reference resolveAddress takes), adding them
+		and their precedents if the graph does not hold them yet.'''
+		added = len(self.addresses)
+		nodes = [self.addNode(self.wb.resolveAddress(ref)) for ref in refs]
+		self.parseAdded(added)
+		if self.outputs is not None:
+			self.outputs.extend(self.addresses[n] for n in nodes if self.addresses[n] not in self.outputs)
+		return nodes
+
+	def isCone(self):
+		'''True for a graph of the cone of some outputs, not the whole workbook.'''
+		return self.outputs is not None
+
+	def parseNode(self, node):
+		'''Parses the formula of a node and sets its precedents.'''
+		cell = self.cells[node]
+		formula = cell.getFormula() if cell else None
+		if formula:
+			self.trees[node] = excel_ast.formulaTree(self.wb, formula)
+			addresses, ranges = references(self.trees[node], cell, self.wb)
+			# only the formulas of a range, and inputs bound in it, are nodes, its
+			# constants are read as one block by the evaluators
+			for bounds in ranges:
+				addresses.extend(formulaAddresses(self.wb, bounds))
+				addresses.extend(a for a in self.inputs if inBounds(bounds, a))
+			self.precedents[node] = list(dict.fromkeys(self.addNode(a) for a in addresses))
+		else:
+			self.trees[node] = None
+			ranges = []
+			self.precedents[node] = []
+		for bounds in self.ranges[node]:
+			self.readers[bounds].remove(node)
+		self.ranges[node] = list(dict.fromkeys(ranges))
+		for bounds in self.ranges[node]:
+			self.readers.setdefault(bounds, []).append(node)
+
+	def parseAdded(self, added):
+		'''Parses the nodes from added on, and any they bring in in turn, adding
+		their reverse edges if those have been built.'''
+		while added < len(self.addresses):
+			self.parseNode(added)
+			if self.dependents is not None:
+				for p in self.precedents[added]:
+					self.dependents[p].append(added)
+			added += 1
+
+	def updateNode(self, address):
+		'''Re-reads a cell after its formula has changed, fixing up the edges of
+		the graph. Returns the node id.'''
+		node = self.addNode(address)
+		old = self.precedents[node]
+		if self.wb.hasCell(address):
+			self.cells[node] = self.wb.getCell(address)
+		added = len(self.addresses)
+		self.parseNode(node)
+		# any cells the new formula brought in need parsing too
+		self.parseAdded(added)
+		if self.dependents is not None:
+			for p in old:
+				self.dependents[p].remove(node)
+			for p in self.precedents[node]:
+				self.dependents[p].append(node)
+		if self.trees[node] is not None:
+			# a formula in a range is read by whatever reads the range
+			self.linkReaders(node)
+		self._orders = {}
+		self.position = None
+		return node
+
+	def addInputs(self, addresses):
+		'''The node ids of cells bound as inputs, adding them if needed. An input
+		bound inside a range becomes a precedent of the formulas reading it, as
+		it is not a constant of the range's block any more.'''
+		nodes = []
+		for address in addresses:
+			node = self.addNode(address)
+			if address not in self.inputs:
+				self.inputs.add(address)
+				self.linkReaders(node)
+			nodes.append(node)
+		return nodes
+
+	def linkReaders(self, node):
+		'''Makes the node a precedent of every formula reading a range it is in.'''
+		address = self.addresses[node]
+		for reader in self.rangeReaders(address):
+			if node not in self.precedents[reader]:
+				self.precedents[reader].append(node)
+				if self.dependents is not None:
+					self.dependents[node].append(reader)
+				self._orders = {}
+				self.position = None
+
+	def rangeReaders(self, address):
+		'''The node ids of the formulas reading a range that holds the address.'''
+		readers = []
+		for bounds, nodes in self.readers.items():
+			if inBounds(bounds, address):
+				readers.extend(nodes)
+		return readers
+
+	def addNode(self, address):
+		'''Returns the id of the node for an address, adding it if needed.'''
+		node = self.index.get(address)
+		if node is None:
+			node = len(self.addresses)
+			self.index[address] = node
+			self.addresses.append(address)
+			self.cells.append(self.wb.getCell(address) if self.wb.hasCell(address) else None)
+			self.trees.append(None)
+			self.precedents.append([])
+			self.ranges.append([])
+			if self.dependents is not None:
+				self.dependents.append([])
+			self.position = None
+		return node
+
+	def nodeId(self, address):
+		return self.index[address]
+
+	def __len__(self):
+		return len(self.addresses)
+
+	def getDependents(self):
+		'''The reverse edge lists, from each node to the formulas that read it.'''
+		if self.dependents is None:
+			self.dependents = [[] for node in self.addresses]
+			for node, precedents in enumerate(self.precedents):
+				for p in precedents:
+					self.dependents[p].append(node)
+		return self.dependents
+
+	def dependentCone(self, nodes, stop=()):
+		'''The nodes together with every node that depends on them, directly or
+		not. Nodes in stop (other than the starting nodes) are included but
+		not followed.'''
+		dependents = self.getDependents()
+		roots = set(nodes)
+		cone = set(roots)
+		stack = list(cone)
+		while stack:
+			node = stack.pop()
+			if node in stop and node not in roots:
+				continue
+			for d in dependents[node]:
+				if d not in cone:
+					cone.add(d)
+					stack.append(d)
+		return cone
+
+	def sortTopologically(self, nodes):
+		'''Sorts a set of nodes into topological order, in time proportional to
+		the size of the set once the workbook's order has been found.'''
+		if self.position is None:
+			self.position = [0] * len(self.addresses)
+			for place, node in enumerate(self.topologicalOrder()):
+				self.position[node] = place
+		return sorted(nodes, key=self.position.__getitem__)
+
+	def topologicalOrder(self):
+		'''Every node of the workbook, each one after all of its precedents.'''
+		return self.order(range(len(self.addresses)))
+
+	def levels(self, nodes, stop=()):
+		'''Groups the formula nodes of a topologically ordered list into levels,
+		or wavefronts. A node's level is one more than the highest level of the
+		formulas it reads, so the nodes of a level never read each other and can
+		be evaluated in any order, or at the same time, once the levels before
+		it are done. Constants and nodes in stop are left out.'''
+		stop = frozenset(stop)
+		level = {}
+		levels = []
+		for node in nodes:
+			if node in stop or self.trees[node] is None:
+				continue
+			n = 0
+			for p in self.precedents[node]:
+				if p in level and level[p] >= n:
+					n = level[p] + 1
+			level[node] = n
+			if n == len(levels):
+				levels.append([])
+			levels[n].append(node)
+		return levels
+
+	def cycles(self, nodes=None):
+		'''Every circular reference among the nodes (all of them by default), as
+		a list of cycles, each the list of node ids of one strongly connected
+		group of cells (each reading the next, as far as it can be put that
+		way), or a single cell reading itself. This is Tarjan's
+		algorithm with an explicit stack, so any length of chain is fine.'''
+		nodes = range(len(self.addresses)) if nodes is None else nodes
+		index = {}      # node id -> the order it was reached in
+		low = {}
+		onStack = set()
+		group = []
+		found = []
+		for root in nodes:
+			if root in index:
+				continue
+			index[root] = low[root] = len(index)
+			group.append(root)
+			onStack.add(root)
+			stack = [(root, 0)]
+			while stack:
+				node, edge = stack[-1]
+				edges = self.precedents[node]
+				if edge < len(edges):
+					stack[-1] = (node, edge + 1)
+					nxt = edges[edge]
+					if nxt not in index:
+						index[nxt] = low[nxt] = len(index)
+						group.append(nxt)
+						onStack.add(nxt)
+						stack.append((nxt, 0))
+					elif nxt in onStack and index[nxt] < low[node]:
+						low[node] = index[nxt]
+					continue
+				stack.pop()
+				if stack and low[node] < low[stack[-1][0]]:
+					low[stack[-1][0]] = low[node]
+				if low[node] == index[node]:
+					members = []
+					while True:
+						member = group.pop()
+						onStack.discard(member)
+						members.append(member)
+						if member == node:
+							break
+					if len(members) > 1 or node in self.precedents[node]:
+						found.append(members[::-1])
+		return found
+
+	def describePath(self, path):
+		'''A path of node ids as text, Sheet1!B2 -> Sheet1!C2 -> ...'''
+		return " -> ".join(addressName(self.addresses[node]) for node in path)
+
+	def order(self, outputs, stop=()):
+		'''The node ids needed to calculate the outputs, each one after all of its
+		precedents. Nodes in stop (bound inputs, say) are included but their own
+		precedents are not followed. Orders are cached, so asking again is free.'''
+		outputs = tuple(outputs)
+		stop = frozenset(stop)
+		key = (outputs, stop)
+		if key in self._orders:
+			return self._orders[key]
+
+		# an iterative depth first search, writing out each node once all of its
+		# precedents have been written out
+		state = {}      # node id -> 1 while on the stack, 2 once written out
+		order = []
+		deepest = 0
+		for root in outputs:
+			if root in state:
+				continue
+			stack = [(root, 0)]
+			state[root] = 1
+			while stack:
+				node, edge = stack[-1]
+				edges = () if node in stop else self.precedents[node]
+				if edge < len(edges):
+					stack[-1] = (node, edge + 1)
+					nxt = edges[edge]
+					seen = state.get(nxt)
+					if seen is None:
+						state[nxt] = 1
+						stack.append((nxt, 0))
+						if len(stack) > deepest:
+							deepest = len(stack)
+					elif seen == 1:
+						# nxt is on the stack, the cycle is the path from there
+						path = [n for n, e in stack]
+						path = path[path.index(nxt):] + [nxt]
+						raise Exception("Circular reference: " + self.describePath(path))
+				else:
+					stack.pop()
+					state[node] = 2
+					order.append(node)
+
+		stats = excel_stats.current
+		if stats is not None:
+			stats.maximum('expansionDepth', deepest)
+		self._orders[key] = order
+		return order
+
+
+def references(tree, cell, workbook):
+	'''The cell addresses a parsed formula refers to, relative to its cell, and
+	the bounds of the ranges it refers to.'''
+	refs = []
+	ranges = []
+	stack = [tree]
+	while stack:
+		t = stack.pop()
+		kind = t[0]
+		if kind == 'RELCELL':
+			refs.append(cell.calcOffset(t[1]))
+		elif kind == 'RELCELLRANGE':
+			ranges.append(rangeBounds(cell, t[1], t[2]))
+		elif kind == 'NAME':
+			name = workbook.scopedName(t[1], cell.sheet)
+			bounds = namedRange(workbook, name)
+			if bounds is None:
+				refs.append(workbook.resolveAddress(name))
+			else:
+				ranges.append(bounds)
+		elif kind in ('BINOP', 'UNOP', 'FUNC'):
+			stack.extend(reversed(t[2]))
+		elif kind in ('SUBEXP', 'ARRAY_FN'):
+			stack.extend(reversed(t[1]))
+	return refs, ranges
+
+
+def rangeBounds(cell, fromRef, toRef):
+	'''The (sheet, row0, col0, row1, col1) corners of the rectangle between two
+	R1C1 references, with integer rows and 0-based columns.'''
+	sheet, fromRow, fromCol = cell.calcOffset(fromRef)
+	sheet, toRow, toCol = cell.calcOffset(toRef)
+	fromCol, toCol = cell.name2col(fromCol), cell.name2col(toCol)
+	return (sheet, min(int(fromRow), int(toRow)), min(fromCol, toCol),
+		max(int(fromRow), int(toRow)), max(fromCol, toCol))
+
+
+def addressName(address):
+	'''An address as A1 style text, Sheet1!B2.'''
+	return address[0] + "!" + address[2] + str(address[1])
+
+
+def rangeOf(workbook, t, cell):
+	'''The bounds of a formula node that is a range, a RELCELLRANGE, a resolved
+	RANGEREF or the name of more than one cell, or None.'''
+	if t[0] == 'RELCELLRANGE':
+		return rangeBounds(cell, t[1], t[2])
+	elif t[0] == 'RANGEREF':
+		return t[1]
+	elif t[0] == 'NAME':
+		return namedRange(workbook, workbook.scopedName(t[1], cell.sheet))
+	return None
+
+
+def namedRange(workbook, name):
+	'''The bounds of a name given to more than one cell, None for the name of a
+	single cell.'''
+	bounds = workbook.getNamedRange(name)
+	if bounds is None or (bounds[1] == bounds[3] and bounds[2] == bounds[4]):
+		return None
+	return bounds
+
+
+def inBounds(bounds, address):
+	'''True if the address is in the rectangle of the bounds.'''
+	sheet, row0, col0, row1, col1 = bounds
+	return (address[0] == sheet and row0 <= int(address[1]) <= row1
+		and col0 <= excel_store.name2col(address[2]) <= col1)
+
+
+def formulaAddresses(workbook, bounds):
+	'''The addresses of the cells of a range that hold a formula, row by row.'''
+	sheet, row0, col0, row1, col1 = bounds
+	store = workbook.getData()["worksheets"].get(sheet)
+	if store is None:
+		return []
+	formulas = store.getBlock(row0, col0, row1, col1)[1]
+	return [(sheet, str(row0 + r), excel_store.col2Name(col0 + c)) for r, c in np.argwhere(formulas)]
@@ -0,0 +1,754 @@
+import concurrent.futures
+import copy
+import functools
+import operator
+import os
+import numpy as np
+import excel_graph
+import excel_lookup
+import excel_stats
+import excel_store
+
+
+'''
+Evaluates the calculation behind a chosen cell over a grid of scenarios.
+
+Any number of input cells can be bound to NumPy arrays holding one value per
+scenario. Every other constant cell is treated as a scalar and every formula
+node is evaluated once, as a single array operation over all the scenarios,
+so the Python level work depends on the size of the DAG and not on the
+number of scenarios.
+
+No value is ever branched on per scenario. IF evaluates both arms and
+selects between them with a mask, and errors are numbers that are not
+finite (NaN, or inf from a division by zero) that the arithmetic carries
+along by itself, which IFERROR masks out. Text and numbers can both turn up
+in one result, '-' in some scenarios and a number in others, and such a
+value is an object array, see isMixed.
+'''
+
+class GridEvaluator():
+
+	def __init__(self, workbook, graph=None):
+		self.wb = workbook
+		# by default only the cones of the outputs asked for are ever read
+		self.graph = graph if graph is not None else excel_graph.CellGraph(workbook, [])
+		self.ranges = {}        # range bounds -> (ConstantBlock, calculated addresses)
+		self.rangesBound = None
+		self.sharedValues = {}  # expression id -> value, see excel_opt
+
+	def evaluate(self, output, inputs=None):
+		'''Evaluates the output cell (an address, 'Sheet1!D2' or a cell name) with
+		the inputs dict mapping cell references to arrays of scenario values. The
+		result is always an array with one entry per scenario.'''
+		bound = self.bindInputs(inputs)
+		graph = self.graph
+		output = graph.include([output])[0]
+		self.values = CellValues(self)
+		self.sharedValues = {}
+		self.evalNodes(graph.order([output], self.stopNodes(bound)), bound)
+		return self.result(output)
+
+	def bindInputs(self, inputs, bound=None):
+		'''Checks the input arrays, returning them keyed by address and setting
+		the number of scenarios.'''
+		bound = dict(bound or {})
+		for ref, value in (inputs or {}).items():
+			value = np.asarray(value)
+			if value.ndim > 1:
+				raise Exception("input " + str(ref) + " must be a 1-d array of scenario values")
+			bound[self.wb.resolveAddress(ref)] = value
+		self.scenarios = 1
+		for address, value in bound.items():
+			if value.ndim == 1:
+				if self.scenarios not in (1, len(value)):
+					raise Exception("input " + str(address) + " has " + str(len(value)) + " scenarios, expected " + str(self.scenarios))
+				self.scenarios = max(self.scenarios, len(value))
+		self.graph.addInputs(bound)
+		return bound
+
+	def stopNodes(self, bound):
+		return [self.graph.index[a] for a in bound if a in self.graph.index]
+
+	def evalNodes(self, nodes, bound):
+		'''Evaluates the nodes, which must come in topological order, so that
+		every reference can be read straight out of the values dict. Constant
+		cells are left for the values dict to read when they are asked for.'''
+		graph = self.graph
+		self.bound = bound
+		if self.rangesBound != set(bound):
+			self.ranges = {}
+			self.rangesBound = set(bound)
+		stats = excel_stats.current
+		trace = stats.trace if stats is not None else None
+		with excel_stats.phase('evaluate'), np.errstate(all='ignore'):
+			for node in nodes:
+				address = graph.addresses[node]
+				if address in bound:
+					self.values[address] = bound[address]
+				elif graph.trees[node] is not None:
+					self.values[address] = self.evalNode(graph.trees[node], graph.cells[node])
+					if trace is not None:
+						trace('evaluate', {'address': address})
+		if stats is not None:
+			stats.count('nodesEvaluated', sum(1 for node in nodes
+				if graph.trees[node] is not None and graph.addresses[node] not in bound))
+
+	def rangeValues(self, bounds):
+		'''A range as a list, its constant cells as one ConstantBlock followed by
+		the values of the cells in it that are calculated or bound as inputs.'''
+		parts = self.ranges.get(bounds)
+		if parts is None:
+			parts = self.ranges[bounds] = splitRange(self.wb, bounds, self.bound)
+		block, addresses = parts
+		return [block] + [self.values[a] for a in addresses]
+
+	def result(self, node):
+		return np.broadcast_to(np.asarray(self.values[self.graph.addresses[node]]), (self.scenarios,))
+
+	def evalNode(self, t, cell):
+		'''Evaluates a node of a parsed formula, relative to the cell that holds it.'''
+		kind = t[0]
+		if kind == 'NUMBER':
+			return float(t[1])
+		elif kind == 'STRING':
+			return t[1]
+		elif kind == 'BOOL':
+			return t[1]
+		elif kind == 'RELCELL':
+			return self.values[cell.calcOffset(t[1])]
+		elif kind == 'RELCELLRANGE':
+			return self.rangeValues(excel_graph.rangeBounds(cell, t[1], t[2]))
+		elif kind == 'CELLREF':
+			return self.values[t[1]]
+		elif kind == 'RANGEREF':
+			return self.rangeValues(t[1])
+		elif kind == 'SHARED':
+			# a subexpression the optimiser found in more than one place
+			if t[1] not in self.sharedValues:
+				self.sharedValues[t[1]] = self.evalNode(self.graph.shared[t[1]], cell)
+			return self.sharedValues[t[1]]
+		elif kind == 'NAME':
+			name = self.wb.scopedName(t[1], cell.sheet)
+			bounds = excel_graph.namedRange(self.wb, name)
+			if bounds is not None:
+				return self.rangeValues(bounds)
+			return self.values[self.wb.resolveAddress(name)]
+		elif kind == 'SUBEXP':
+			return self.evalNode(t[1][0], cell)
+		elif kind == 'UNOP':
+			return -asNumber(self.evalNode(t[2][0], cell))
+		elif kind == 'BINOP':
+			left = self.evalNode(t[2][0], cell)
+			right = self.evalNode(t[2][1], cell)
+			return binop(t[1], left, right)
+		elif kind == 'FUNC':
+			return self.evalFunction(t[1], t[2], cell)
+		raise Exception("ERROR: type " + str(kind) + " not supported yet!")
+
+	def evalFunction(self, name, args, cell):
+		if name == 'PI':
+			return np.pi
+
+		if name == 'IF':
+			if len(args) != 3:
+				raise Exception("IF function requires exactly 3 arguments, " + str(len(args)) + " given")
+			return select(self.evalNode(args[0], cell), self.evalNode(args[1], cell), self.evalNode(args[2], cell))
+
+		if name == 'IFERROR':
+			if len(args) != 2:
+				raise Exception("IFERROR function requires exactly 2 arguments, " + str(len(args)) + " given")
+			return iferror(self.evalNode(args[0], cell), self.evalNode(args[1], cell))
+
+		if name == 'ROUND':
+			if len(args) != 2:
+				raise Exception("ROUND function requires exactly 2 arguments, " + str(len(args)) + " given")
+			return excelRound(self.evalNode(args[0], cell), self.evalNode(args[1], cell))
+
+		if name == 'VLOOKUP':
+			if len(args) not in (3, 4):
+				raise Exception("VLOOKUP function requires 3 or 4 arguments, " + str(len(args)) + " given")
+			bounds = excel_graph.rangeOf(self.wb, args[1], cell)
+			if bounds is None:
+				raise Exception("VLOOKUP needs a range or a named range as its table, not " + str(args[1][0]))
+			table = lookupTable(self.wb, bounds, self.bound)
+			exact = len(args) == 4 and np.all(asNumber(self.evalNode(args[3], cell)) == 0)
+			dynamic = dict((position, self.values[address]) for position, address in tableCells(table, self.bound))
+			return lookup(table, self.evalNode(args[0], cell), self.evalNode(args[2], cell), exact, dynamic)
+
+		if name in AGGREGATES:
+			values = []
+			for arg in args:
+				value = self.evalNode(arg, cell)
+				if isinstance(value, list):
+					values.extend(value)
+				else:
+					values.append(value)
+			return aggregate(name, values)
+
+		raise Exception("ERROR: " + name + " function not written yet!")
+
+
+class WavefrontEvaluator(GridEvaluator):
+	'''A GridEvaluator that evaluates the cone of an output level by level.
+
+	The formulas are grouped into wavefronts by CellGraph.levels, and the
+	nodes of each level, which never read each other, are shared out between
+	a pool of worker threads. NumPy lets go of the GIL inside its array
+	operations, so the gain comes with many scenarios per node; levels with
+	fewer than minParallel formulas are just evaluated in this thread. After
+	each evaluation parallelism() reports how wide every level was.
+
+	Every worker evaluates its share of a level on a copy of the evaluator
+	with state of its own: the values, the shared subexpressions and the
+	range blocks it works out go into its own dicts, and the evaluator's are
+	only read, so nothing the threads write is shared. They are merged in
+	once the level is done. The lookup tables kept on the workbook are still
+	shared: a table two workers ask for at once may be built twice, but
+	either is the same table and one dict store keeps it. The
+	instrumentation counters take a lock of their own.'''
+
+	def __init__(self, workbook, graph=None, workers=None, minParallel=64):
+		GridEvaluator.__init__(self, workbook, graph)
+		self.workers = workers or os.cpu_count() or 1
+		self.minParallel = minParallel
+		self.widths = []
+
+	def evalNodes(self, nodes, bound):
+		graph = self.graph
+		levels = graph.levels(nodes, self.stopNodes(bound))
+		self.widths = [len(level) for level in levels]
+		# the bound inputs first, then the levels in order
+		GridEvaluator.evalNodes(self, [n for n in nodes if graph.addresses[n] in bound], bound)
+		if self.workers == 1:
+			for level in levels:
+				GridEvaluator.evalNodes(self, level, bound)
+			return
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+			for level in levels:
+				if len(level) < self.minParallel:
+					GridEvaluator.evalNodes(self, level, bound)
+					continue
+				size = -(-len(level) // self.workers)
+				chunks = [level[i:i+size] for i in range(0, len(level), size)]
+				for worker in pool.map(lambda chunk: self.evalChunk(chunk, bound), chunks):
+					self.values.update(worker.values)
+					self.sharedValues.update(worker.sharedValues)
+					self.ranges.update(worker.ranges)
+
+	def evalChunk(self, nodes, bound):
+		'''Evaluates nodes of a level in a worker thread, on a copy of the
+		evaluator that writes to dicts of its own, returned to be merged.'''
+		worker = copy.copy(self)
+		worker.values = LevelValues(worker, self.values)
+		worker.sharedValues = dict(self.sharedValues)
+		worker.ranges = dict(self.ranges)
+		GridEvaluator.evalNodes(worker, nodes, bound)
+		return worker
+
+	def parallelism(self):
+		'''The number of formulas in each level of the last evaluation, and how
+		many could be evaluated at the same time on average.'''
+		nodes = sum(self.widths)
+		return {
+			'levels': len(self.widths),
+			'formulas': nodes,
+			'widths': list(self.widths),
+			'maxWidth': max(self.widths or [0]),
+			'averageWidth': nodes / len(self.widths) if self.widths else 0.0,
+		}
+
+
+class IncrementalEvaluator(GridEvaluator):
+	'''Keeps the values of a set of outputs up to date as inputs change.
+
+	Everything the outputs need is evaluated once up front. After that, when
+	input arrays are rebound or cells are replaced with ExcelWB.setCellData(...,
+	replace=True), recalculate() follows the reverse dependency index from the
+	changed cells and re-evaluates only the cone that depends on them, so the
+	cost follows the size of the change rather than the size of the workbook.'''
+
+	def __init__(self, workbook, outputs, inputs=None, graph=None):
+		GridEvaluator.__init__(self, workbook, graph)
+		self.outputs = self.graph.include(outputs)
+		self.bound = self.bindInputs(inputs)
+		self.values = CellValues(self)
+		self.sharedValues = {}
+		self.wb.popChanges()    # anything changed before now is already in the graph
+		self.refresh()
+
+	def refresh(self):
+		'''Evaluates any node of the outputs' cone that has no value yet.'''
+		order = self.graph.order(self.outputs, self.stopNodes(self.bound))
+		self.needed = set(order)
+		self.evalNodes([n for n in order if self.graph.addresses[n] not in self.values], self.bound)
+
+	def recalculate(self, inputs=None):
+		'''Rebinds any inputs given, picks up the cells replaced in the workbook
+		and re-evaluates what depends on them. Returns the addresses of the
+		outputs whose values changed.'''
+		graph = self.graph
+		changed = set()
+		restructured = False
+		if inputs:
+			# an input bound for the first time may add edges to the graph
+			restructured = any(self.wb.resolveAddress(ref) not in graph.inputs for ref in inputs)
+			self.bound = self.bindInputs(inputs, self.bound)
+			for address in map(self.wb.resolveAddress, inputs):
+				if address in graph.index:
+					changed.add(graph.index[address])
+
+		changes = self.wb.popChanges()
+		if changes:
+			self.ranges = {}    # the constant blocks may be out of date
+		for address in changes:
+			node = graph.index.get(address)
+			cell = self.wb.getCell(address)
+			if not cell.getFormula():
+				# the formulas reading a constant as part of a range's block
+				changed.update(graph.rangeReaders(address))
+				if node is None and graph.isCone():
+					continue    # nothing in the cone reads it on its own
+			if node is None or cell.getFormula() or graph.trees[node] is not None:
+				# a formula may now read other cells, so the edges are redone
+				node = graph.updateNode(address)
+				restructured = True
+			else:
+				graph.cells[node] = cell
+			changed.add(node)
+
+		stop = self.stopNodes(self.bound)
+		dirty = graph.dependentCone(changed, set(stop))
+		if restructured:
+			self.needed = set(graph.order(self.outputs, stop))
+		dirty &= self.needed
+
+		before = dict((n, self.values.get(graph.addresses[n])) for n in self.outputs if n in dirty)
+		for node in dirty:
+			self.values.pop(graph.addresses[node], None)
+		self.sharedValues = {}
+		if restructured:
+			self.refresh()
+		else:
+			self.evalNodes(graph.sortTopologically(dirty), self.bound)
+
+		return [graph.addresses[n] for n, old in before.items()
+			if old is None or not sameValue(old, self.values[graph.addresses[n]])]
+
+	def getValue(self, output):
+		return self.result(self.graph.nodeId(self.wb.resolveAddress(output)))
+
+
+class CellValues(dict):
+	'''The values of the cells during an evaluation, keyed by address. Cells
+	that are not calculated are read from the workbook the first time they
+	are asked for, so constants that are only ever read as part of a range
+	block cost nothing.'''
+
+	def __init__(self, evaluator):
+		dict.__init__(self)
+		self.evaluator = evaluator
+
+	def __missing__(self, address):
+		graph = self.evaluator.graph
+		node = graph.index.get(address)
+		cell = graph.cells[node] if node is not None else None
+		if cell is None:
+			value = 0.0     # an empty cell reads as zero
+		else:
+			value = constantValue(cell.getData())
+		self[address] = value
+		return value
+
+
+class LevelValues(CellValues):
+	'''The values of a WavefrontEvaluator's worker thread: what the levels
+	before worked out is read from values, never written, and what the
+	worker works out, or reads from the workbook, is kept here.'''
+
+	def __init__(self, evaluator, values):
+		CellValues.__init__(self, evaluator)
+		self.shared = values
+
+	def __missing__(self, address):
+		if address in self.shared:
+			return self.shared[address]
+		return CellValues.__missing__(self, address)
+
+
+class ConstantBlock():
+	'''The constant, numeric cells of a range as one 2-D block, NaN where a cell
+	is empty, text or calculated. The aggregate functions reduce it with one
+	vectorized call, and remember the result.'''
+
+	__slots__ = ('block', 'count', 'reductions')
+
+	def __init__(self, block):
+		self.block = block
+		self.count = int(np.count_nonzero(~np.isnan(block)))
+		self.reductions = {}
+
+	def reduce(self, name):
+		if name not in self.reductions:
+			self.reductions[name] = float(BLOCKREDUCTIONS[name](self.block))
+		return self.reductions[name]
+
+
+def splitRange(workbook, bounds, bound=()):
+	'''Splits the rectangle of a range into a ConstantBlock and the addresses of
+	the cells in it that have to be calculated, or are bound as inputs.'''
+	sheet, row0, col0, row1, col1 = bounds
+	store = workbook.getData()["worksheets"].get(sheet)
+	if store is None:
+		values = np.full((row1 - row0 + 1, col1 - col0 + 1), np.nan)
+		calculated = np.zeros(values.shape, dtype=bool)
+	else:
+		values, calculated = store.getBlock(row0, col0, row1, col1)
+		calculated = calculated.copy()
+	for address in bound:
+		if address[0] == sheet:
+			r, c = int(address[1]) - row0, excel_store.name2col(address[2]) - col0
+			if 0 <= r < values.shape[0] and 0 <= c < values.shape[1]:
+				calculated[r, c] = True
+	if calculated.any():
+		values = np.where(calculated, np.nan, values)
+	addresses = [(sheet, str(row0 + r), excel_store.col2Name(col0 + c)) for r, c in np.argwhere(calculated)]
+	return ConstantBlock(values), addresses
+
+
+def lookupTable(workbook, bounds, bound=()):
+	'''The excel_lookup.LookupTable of a range, built from its constant cells
+	the first time it is used and kept on the workbook until a cell of the
+	workbook is replaced. Inputs bound inside the table are treated as
+	calculated.'''
+	lookups = workbook.getData()["lookups"]
+	table = lookups.get(bounds)
+	if table is None:
+		sheet, row0, col0, row1, col1 = bounds
+		store = workbook.getData()["worksheets"].get(sheet)
+		columns = [[None] * (row1 - row0 + 1) for col in range(col0, col1 + 1)]
+		calculated = []
+		for row in range(row0, row1 + 1):
+			for col in range(col0, col1 + 1):
+				slot = store.findSlot(row, col) if store is not None else None
+				if slot is None:
+					continue
+				if store.getFormula(slot):
+					calculated.append((row - row0, col - col0))
+				else:
+					columns[col - col0][row - row0] = constantValue(store.getData(slot))
+		table = lookups[bounds] = excel_lookup.LookupTable(bounds, columns, calculated)
+	for position, address in tableCells(table, bound):
+		if position[1] == 0:
+			raise Exception("the input " + str(address) + " is in the first column of a lookup table, which VLOOKUP cannot index")
+	return table
+
+
+def tableCells(table, bound=()):
+	'''The ((row, col), address) of the cells of a lookup table whose values
+	come from the evaluation, the calculated ones and any bound inputs.'''
+	sheet, row0, col0, row1, col1 = table.bounds
+	cells = [((r, c), (sheet, str(row0 + r), excel_store.col2Name(col0 + c))) for r, c in table.calculated]
+	for address in bound:
+		if address[0] == sheet:
+			r, c = int(address[1]) - row0, excel_store.name2col(address[2]) - col0
+			if 0 <= r <= row1 - row0 and 0 <= c <= col1 - col0 and (r, c) not in table.calculated:
+				cells.append(((r, c), address))
+	return cells
+
+
+def lookup(table, keys, column, exact, dynamic=None):
+	'''VLOOKUP of the keys, a scalar or one per scenario, in a LookupTable,
+	giving the value in the column (from 1) of the matching row, or an error
+	(NaN, as #N/A and #REF! are) where there is none. dynamic maps the (row,
+	col) of the table's calculated cells to their values.'''
+	if not isinstance(keys, (str, bool, np.bool_)) and not isText(keys) and not isMixed(keys):
+		keys = asNumber(keys)
+	errors = isError(keys)
+	rows = table.match(keys, exact)
+	column = asNumber(column)
+	if np.ndim(column):
+		# a column per scenario, rare, so each distinct one is looked up in turn
+		result = np.full(np.broadcast(rows, column).shape, np.nan)
+		for c in np.unique(column[np.isfinite(column)]):
+			result = choose(column == c, lookup(table, keys, c, exact, dynamic), result)
+		return withErrors(result, errors)
+	col = int(column) - 1 if np.isfinite(column) else -1
+	if not 0 <= col < table.width:
+		return withErrors(np.full(np.shape(rows), np.nan), True)
+	values = table.columns[col]
+	missing = np.asarray(rows) < 0
+	result = values[np.maximum(rows, 0)] if table.height else np.full(np.shape(rows), np.nan)
+	if values.dtype == object and np.ndim(result) == 0:
+		result = result if isinstance(result, str) else float(result)
+	for (r, c), value in (dynamic or {}).items():
+		if c == col:
+			result = choose(np.asarray(rows) == r, value, result)
+	return withErrors(result, missing | errors)
+
+
+def sameValue(a, b):
+	a, b = np.asarray(a), np.asarray(b)
+	try:
+		return np.array_equal(a, b, equal_nan=True)
+	except TypeError:
+		return np.array_equal(a, b)
+
+
+def constantValue(data):
+	'''The value of a cell without a formula, from its SAX data.'''
+	datatype = data.get('datatype')
+	content = data.get('content', '')
+	if datatype == 'Number':
+		return float(content)
+	if datatype == 'Boolean':
+		return content.strip() == '1'
+	return content
+
+
+def excelRound(value, digits):
+	'''ROUND, excel rounds halves away from zero where numpy rounds them to even.'''
+	value = asNumber(value)
+	scale = 10.0 ** asNumber(digits)
+	return np.sign(value) * np.floor(np.abs(value) * scale + 0.5) / scale
+
+
+def aggregate(name, values):
+	'''Applies one of the AGGREGATES to a list of values, which may hold the
+	ConstantBlock of a range. As in excel, text and empty cells inside a range
+	are ignored, and so is the text in the scenarios of a mixed value.'''
+	blocks = [v for v in values if isinstance(v, ConstantBlock) and v.count]
+	count = sum(b.count for b in blocks)
+	numbers = []
+	for v in values:
+		if isinstance(v, ConstantBlock) or isText(v):
+			continue
+		if isMixed(v):
+			text = textMask(v)
+			numbers.append(np.where(text, IDENTITIES[name], asNumber(v)))
+			count = count + ~text
+		else:
+			numbers.append(asNumber(v))
+			count = count + 1
+	if name == 'AVG':
+		if not np.any(count):
+			return 0.0
+		total = AGGREGATES['SUM']([b.reduce('SUM') for b in blocks] + numbers)
+		return np.where(count == 0, 0.0, total / np.maximum(count, 1))
+	values = [b.reduce(name) for b in blocks] + numbers
+	if not values:
+		return 0.0
+	result = AGGREGATES[name](values)
+	# only text in a scenario is no numbers at all
+	return np.where(count == 0, 0.0, result) if np.ndim(count) else result
+
+
+def isText(value):
+	return isinstance(value, str) or (isinstance(value, np.ndarray) and value.dtype.kind in 'US')
+
+
+def isMixed(value):
+	'''An object array, holding text in some scenarios and numbers (or errors)
+	in others, as a check cell giving '-' or a number does.'''
+	return isinstance(value, np.ndarray) and value.dtype == object
+
+
+def textMask(value):
+	'''Where a value is text, elementwise for a mixed array.'''
+	if isMixed(value):
+		return np.asarray(_isString(value)).astype(bool)
+	return np.asarray(isText(value))
+
+
+def isError(value):
+	'''Where a value is an excel error. Errors are carried as numbers that are
+	not finite, NaN for #VALUE! and friends and inf for #DIV/0!, so they
+	flow through the arithmetic by themselves.'''
+	if isMixed(value):
+		return np.asarray(_isErrorElement(value)).astype(bool)
+	if isText(value):
+		return np.zeros(np.shape(value), dtype=bool)
+	return ~np.isfinite(np.asarray(value, dtype=float))
+
+
+def asNumber(value):
+	'''Numbers (and booleans) as float arrays, text that is not a number is NaN.'''
+	if isText(value):
+		return np.asarray(_textToNumber(value))
+	if isMixed(value):
+		return np.asarray(_toNumber(value)).astype(float)
+	return np.asarray(value, dtype=float)
+
+
+def _textToNumber(value):
+	if isinstance(value, str):
+		return _convert(value)
+	value = np.asarray(value)
+	if value.size and not any(value.strides):
+		# the same text in every scenario, as a broadcast constant
+		return np.full(value.shape, _convert(value.flat[0]))
+	# each distinct text is converted once
+	distinct, inverse = np.unique(value, return_inverse=True)
+	return np.array([_convert(s) for s in distinct.tolist()], dtype=float)[inverse].reshape(value.shape)
+
+
+def _convert(s):
+	try:
+		return float(s)
+	except ValueError:
+		return np.nan
+
+
+def _numberOf(v):
+	return _convert(v) if isinstance(v, str) else float(v)
+
+
+def _textOf(v):
+	if isinstance(v, str):
+		return v
+	if isinstance(v, (bool, np.bool_)):
+		return 'TRUE' if v else 'FALSE'
+	return errorText(v) if not np.isfinite(v) else '%.15g' % v
+
+
+def _errorOf(v):
+	return not isinstance(v, (str, bool, np.bool_)) and not np.isfinite(v)
+
+
+def _compareKey(v):
+	# excel orders numbers before text before booleans, and text ignoring case
+	if isinstance(v, str):
+		return (1, v.lower())
+	if isinstance(v, (bool, np.bool_)):
+		return (2, bool(v))
+	return (0, float(v))
+
+
+_isString = np.frompyfunc(lambda v: isinstance(v, str), 1, 1)
+_isErrorElement = np.frompyfunc(_errorOf, 1, 1)
+_toNumber = np.frompyfunc(_numberOf, 1, 1)
+_toText = np.frompyfunc(_textOf, 1, 1)
+
+
+def errorText(v):
+	return '#DIV/0!' if np.isinf(v) else '#VALUE!'
+
+
+def asText(value):
+	'''Formats a value the way excel does when it is used as text.'''
+	if isText(value):
+		return np.asarray(value, dtype=str)
+	if isMixed(value):
+		return np.asarray(_toText(value)).astype(str)
+	value = np.asarray(value)
+	if value.dtype == bool:
+		return np.where(value, 'TRUE', 'FALSE')
+	return np.char.mod('%.15g', value.astype(float))
+
+
+def asMixed(value):
+	'''A value as an object array, text staying text and numbers numbers.'''
+	if isMixed(value):
+		return value
+	if isText(value):
+		return np.asarray(value, dtype=object)
+	value = np.asarray(value)
+	return value.astype(object) if value.dtype == bool else value.astype(float).astype(object)
+
+
+def withErrors(value, errors, error=np.nan):
+	'''A value with error (which may be an array) in the scenarios where errors
+	is set. Text has nowhere to keep an error, so it becomes a mixed array
+	first.'''
+	if not np.any(errors):
+		return value
+	if isText(value) or isMixed(value) or np.asarray(value).dtype == bool:
+		value = asMixed(value)
+	else:
+		value = np.asarray(value, dtype=float)
+	return np.where(errors, error, value)
+
+
+def select(cond, a, b):
+	'''IF as a masked select, over every scenario at once: both arms are
+	worked out and the condition picks between them. A condition that is an
+	error gives the error. When one arm is text and the other a number, as in
+	IF(R[-1]C>R[-2]C,"-",R[-1]C), the result is a mixed array.'''
+	cond = asNumber(cond)
+	return withErrors(choose(cond != 0, a, b), ~np.isfinite(cond), cond)
+
+
+def iferror(value, alt):
+	'''IFERROR, alt in the scenarios where value is an error.'''
+	errors = isError(value)
+	if not np.any(errors):
+		return value
+	return choose(errors, alt, value)
+
+
+def choose(mask, a, b):
+	if isText(a) != isText(b) or isMixed(a) or isMixed(b):
+		a, b = asMixed(a), asMixed(b)
+	return np.where(mask, a, b)
+
+
+def binop(op, left, right):
+	if op == '&':
+		text = np.char.add(asText(left), asText(right))
+		# an error stays an error rather than turning into its text
+		return withErrors(text, isError(left) | isError(right))
+	if op in COMPARISONS:
+		if isText(left) and isText(right):
+			return COMPARISONS[op](np.char.lower(np.asarray(left, dtype=str)), np.char.lower(np.asarray(right, dtype=str)))
+		if isMixed(left) or isMixed(right) or isText(left) != isText(right):
+			result = _compare[op](asMixed(left), asMixed(right)).astype(bool)
+			return withErrors(result, isError(left) | isError(right))
+		left, right = asNumber(left), asNumber(right)
+		# a comparison of an error is that error, not whatever inf > 1 gives
+		return withErrors(COMPARISONS[op](left, right), ~np.isfinite(left) | ~np.isfinite(right),
+			np.where(np.isfinite(left), right, left))
+	return ARITHMETIC[op](asNumber(left), asNumber(right))
+
+
+ARITHMETIC = {
+	'+': np.add,
+	'-': np.subtract,
+	'*': np.multiply,
+	'/': np.divide,
+	'^': np.power,
+}
+
+COMPARISONS = {
+	'=': np.equal,
+	'<>': np.not_equal,
+	'>': np.greater,
+	'<': np.less,
+	'>=': np.greater_equal,
+	'<=': np.less_equal,
+}
+
+AGGREGATES = {
+	'SUM': lambda values: functools.reduce(np.add, values),
+	'MAX': lambda values: functools.reduce(np.maximum, values),
+	'MIN': lambda values: functools.reduce(np.minimum, values),
+	'AVG': lambda values: functools.reduce(np.add, values) / len(values),
+}
+
+# what a text scenario of a mixed value counts as
+IDENTITIES = {
+	'SUM': 0.0,
+	'AVG': 0.0,
+	'MAX': -np.inf,
+	'MIN': np.inf,
+}
+
+# the comparisons elementwise, for mixed values, see _compareKey
+_compare = dict((op, np.frompyfunc(lambda a, b, fn=fn: fn(_compareKey(a), _compareKey(b)), 2, 1))
+	for op, fn in (('=', operator.eq), ('<>', operator.ne), ('>', operator.gt),
+		('<', operator.lt), ('>=', operator.ge), ('<=', operator.le)))
+
+BLOCKREDUCTIONS = {
+	'SUM': np.nansum,
+	'MAX': np.nanmax,
+	'MIN': np.nanmin,
+}
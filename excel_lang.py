@@ -5,9 +5,9 @@
 # "Lex and Yacc", p. 63.
 # -----------------------------------------------------------------------------
 
-import sys, random
-import ply.lex as lex
-import ply.yacc as yacc
+import sys, os
+import collections
+import excel_stats
 
 if sys.version_info[0] >= 3:
     raw_input = input
@@ -23,6 +23,7 @@ tokens = (
     'NUMBER',
     'NUMBER_HEX',
     'INTEGER',
+    'BOOL',
     'FN',
     'ARGSEP',
 
@@ -30,7 +31,8 @@ tokens = (
     'DIV',
     'SUB',
     'ADD',
-    'GT','LT','GTE','LTE',
+    'POW',
+    'GT','LT','GTE','LTE','NE',
     'STRCONCAT',
     
     'TYPEDEF',
@@ -55,10 +57,12 @@ t_MULT      = r'\*'
 t_DIV       = r'/'
 t_SUB       = r'-'
 t_ADD       = r'\+'
+t_POW       = r'\^'
 t_GT        = r'>'
 t_LT        = r'<'
 t_GTE       = r'>='
 t_LTE       = r'<='
+t_NE        = r'<>'
 t_STRCONCAT = r'&'
 
 t_DOLLAR    = r'\$(list|type)?'
@@ -75,17 +79,32 @@ def t_WBREF(t):
     raise Exception("External workbook references are not supported")
     return t
 
+# a reference in R1C1 notation. Each part is either relative, R[-2], or
+# absolute, R13, and a bare R or C means an offset of 0. The row and col
+# are offsets when relative and 1-based indices when absolute.
+RelRef = collections.namedtuple('RelRef', 'row col rowAbs colAbs sheet')
+RelRef.__new__.__defaults__ = (False, False, None)
+
 def t_RELCELL(t):
-    r'R(\[(?P<rowoffset>-?[0-9]+)\])?C(\[(?P<coloffset>-?[0-9]+)\])?'
-    rTerm = t.lexer.lexmatch.group('rowoffset')
-    cTerm = t.lexer.lexmatch.group('coloffset')
+    r'((?P<sheet>[A-Za-z0-9_]+|\'([^\']|\'\')+\')\!)?R((\[(?P<rowoffset>-?[0-9]+)\])|(?P<rowabs>[0-9]+))?C((\[(?P<coloffset>-?[0-9]+)\])|(?P<colabs>[0-9]+))?(?![A-Za-z0-9_])'
+    m = t.lexer.lexmatch
+    rTerm = m.group('rowoffset') or m.group('rowabs')
+    cTerm = m.group('coloffset') or m.group('colabs')
     if not cTerm: cTerm = 0     # we need to ensure that we convert None to 0 for offsets
     if not rTerm: rTerm = 0
-    t.value = (int(rTerm), int(cTerm))
+    sheet = m.group('sheet')
+    if sheet and sheet.startswith("'"):
+        sheet = sheet[1:-1].replace("''", "'")  # 'My Sheet'!R1C1, quoted as it has a space
+    t.value = RelRef(int(rTerm), int(cTerm), m.group('rowabs') is not None, m.group('colabs') is not None, sheet)
     return t
 
 def t_FN(t):
-    r'AVG|IFERROR|IF|MAX|MIN|PI|ROUND|SUM|VLOOKUP'
+    r'(AVG|IFERROR|IF|MAX|MIN|PI|ROUND|SUM|VLOOKUP)(?![A-Za-z0-9_])'
+    return t
+
+def t_BOOL(t):
+    r'(TRUE|FALSE)(?![A-Za-z0-9_])'
+    t.value = t.value == 'TRUE'
     return t
 
 def t_NUMBER_HEX(t):
@@ -109,7 +128,7 @@ def t_CELL(t):
     return t
 
 def t_NUMBER(t):
-    r'[-]?[0-9]+(\.[0-9]*)?'
+    r'[0-9]+(\.[0-9]*)?([eE][-+]?[0-9]+)?'
     try:
         t.value = float(t.value)
     except ValueError as e:
@@ -117,7 +136,7 @@ def t_NUMBER(t):
     return t
 
 def t_INTEGER(t):
-    r'[-]?[0-9]'
+    r'[0-9]'
     try:
         t.value = int(t.value)
     except ValueError as e:
@@ -152,22 +171,22 @@ def t_error(t):
 # dictionary of names
 names = { }
 
-# formulas are the base cases for an = cell
-def p_formula_fn(p):
-    'formula : EQ functions'
-    p[0] = ('FORMULA', p[2])
+# operator precedence, lowest first. Excel binds comparison loosest, then
+# concatenation, then the arithmetic operators and finally unary minus.
+precedence = (
+    ('left', 'EQ', 'NE', 'GT', 'LT', 'GTE', 'LTE'),
+    ('left', 'STRCONCAT'),
+    ('left', 'ADD', 'SUB'),
+    ('left', 'MULT', 'DIV'),
+    ('left', 'POW'),
+    ('right', 'UMINUS'),
+)
 
+# formulas are the base cases for an = cell, the body is always a single
+# node wrapped in a list
 def p_formula_exp(p):
     'formula : EQ expression'
-    p[0] = ('FORMULA', p[2])
-
-def p_formula_number(p):
-    'formula : EQ NUMBER'
-    p[0] = ('FORMULA', p[2])
-
-def p_formula_cell(p):
-    'formula : EQ CELL'
-    p[0] = ('FORMULA', p[2])
+    p[0] = ('FORMULA', [p[2]])
 
 def p_formula_array(p):
     'formula : EQ array'
@@ -176,36 +195,32 @@ def p_formula_array(p):
 
 # array functions
 def p_array_function(p):
-    'array : LBRACE functions RBRACE'
-    p[0] = ["ARRAY_FN", p[2]]
+    'array : LBRACE expression RBRACE'
+    p[0] = ["ARRAY_FN", [p[2]]]
 
 
 # functions..
-def p_functions(p):
-    'functions : function functions'
-    p[0] = [p[1]] + p[2]
-
-def p_functions_empty(p):
-    'functions : '
-    p[0] = []
-
 def p_function(p):
     '''function : FN LPAREN terms RPAREN'''
     p[0] = ('FUNC', p[1], p[3])     # invoke FUNCtion called p[1] with arguments p[3]
 
-# terms..
+# terms are the comma separated arguments of a function
 def p_terms(p):
-    'terms : ARGSEP terms'
-    p[0] = p[2]
-
-def p_moreterms(p):
-    'terms : term terms'
-    p[0] = [p[1]] + p[2]
+    'terms : termlist'
+    p[0] = p[1]
 
 def p_args_empty(p):
     'terms :'
     p[0] = []
 
+def p_termlist_single(p):
+    'termlist : expression'
+    p[0] = [p[1]]
+
+def p_termlist_more(p):
+    'termlist : termlist ARGSEP expression'
+    p[0] = p[1] + [p[3]]
+
 # term defs
 def p_term_function(p):
     'term : function'
@@ -215,21 +230,17 @@ def p_term_string(p):
     'term : STRING'
     p[0] = ('STRING', p[1])
 
-# def p_term_relcell(p):
-#     'term : RELCELL'
-#     # if not p[1][0]: p[1] = (0, p[1][1]) # we need to ensure that we convert None to 0 for offsets
-#     # if not p[1][1]: p[1] = (p[1][0], 0)
-#     # print(p[1])
-#     # sys.exit()
-#     p[0] = ('RELCELL', p[1])
+def p_term_relcell(p):
+    'term : RELCELL'
+    p[0] = ('RELCELL', p[1])
 
 def p_term_name(p):
     'term : NAME'
     p[0] = ('NAME', p[1])
 
-# def p_term_fn(p):
-#     'term : FN'
-#     p[0] = ['TERM', p[1]]
+def p_term_bool(p):
+    'term : BOOL'
+    p[0] = ('BOOL', p[1])
 
 def p_term_numberhex(p):
     'term : NUMBER_HEX'
@@ -239,10 +250,6 @@ def p_term_number(p):
     'term : NUMBER'
     p[0] = ('NUMBER', p[1])
 
-def p_term_expression(p):
-    'term : expression'
-    p[0] = ('EXPRESSION', p[1])
-
 def p_term_cell(p):
     'term : CELL'
     p[0] = ('CELL', p[1])
@@ -264,39 +271,147 @@ def p_term_rowrange(p):
     p[0] = ('ROWRANGE', p[1])
 
 # expression
-def p_expression_sub(p):
-    'expression : LPAREN terms RPAREN'
-    p[0] = ['SUBEXP', p[2] ]
+def p_expression_term(p):
+    'expression : term'
+    p[0] = p[1]
 
-# def p_expression(p):
-#     'expression : LPAREN expression RPAREN'
-#     p[0] = ['BINOP', p[2], [p[1]] + p[3]]
+def p_expression_sub(p):
+    'expression : LPAREN expression RPAREN'
+    p[0] = ['SUBEXP', [p[2]] ]
 
 def p_expression_binop(p):
-    'expression : term binop term'
+    '''expression : expression ADD expression
+                  | expression SUB expression
+                  | expression MULT expression
+                  | expression DIV expression
+                  | expression POW expression
+                  | expression EQ expression
+                  | expression NE expression
+                  | expression GT expression
+                  | expression LT expression
+                  | expression GTE expression
+                  | expression LTE expression
+                  | expression STRCONCAT expression'''
     p[0] = ['BINOP', p[2], [p[1],  p[3]]]
 
-def p_binop(p):
-    '''binop : ADD
-             | SUB
-             | MULT
-             | DIV
-             | EQ
-             | GT
-             | LT
-             | GTE
-             | LTE
-             | STRCONCAT'''
-    p[0] = p[1]
-
-
-
-lexer = lex.lex()
-yacc.yacc()
+def p_expression_uminus(p):
+    '''expression : SUB expression %prec UMINUS
+                  | ADD expression %prec UMINUS'''
+    if p[1] == '+':
+        p[0] = p[2]
+    else:
+        p[0] = ['UNOP', p[1], [p[2]]]
+
+def p_error(p):
+    if p:
+        raise Exception("Syntax error in formula at '%s' (position %d)" % (p.value, p.lexpos))
+    raise Exception("Syntax error in formula, unexpected end of input")
+
+
+
+# the LALR tables are generated ahead of time into excel_lang_tab.py (see
+# writeTables), so building the parser only reads them back. Nothing is built,
+# or even imported from PLY, until the first formula is parsed, and no debug
+# or table files are written.
+TABMODULE = 'excel_lang_tab'
+_lexer = None
+_parser = None
+
+def getLexer():
+    global _lexer
+    if _lexer is None:
+        import ply.lex as lex
+        _lexer = lex.lex()
+    return _lexer
+
+def getParser():
+    '''The formula parser, built the first time it is asked for. If the grammar
+    has changed since excel_lang_tab.py was written the tables are rebuilt in
+    memory, which works but is slow, so run writeTables().'''
+    global _parser
+    if _parser is None:
+        import ply.yacc as yacc
+        _parser = yacc.yacc(tabmodule=TABMODULE, debug=False, write_tables=False)
+    return _parser
+
+def writeTables():
+    '''Regenerates excel_lang_tab.py next to this module, after the grammar
+    has been changed. python excel_lang.py --tables does the same.'''
+    global _parser
+    import ply.yacc as yacc
+    outputdir = os.path.dirname(os.path.abspath(__file__))
+    tabFile = os.path.join(outputdir, TABMODULE + '.py')
+    # yacc only writes tables it had to generate, so the old ones go first
+    if os.path.exists(tabFile):
+        os.remove(tabFile)
+    sys.modules.pop(TABMODULE, None)
+    _parser = yacc.yacc(tabmodule=TABMODULE, outputdir=outputdir, debug=False, write_tables=True)
+
+
+def freeze(tree):
+    '''Turns the lists of a parsed formula into tuples, so that one tree can be
+    safely shared between every cell that holds the same formula text.'''
+    if isinstance(tree, (list, tuple)) and not isinstance(tree, RelRef):
+        return tuple(freeze(t) for t in tree)
+    return tree
+
+
+class ParseCache():
+    '''A bounded LRU cache of parsed formulas, keyed by the formula text.
+
+    Formulas are stored in R1C1 form, so a filled down column holds the same
+    text in every cell and only the first one needs to be parsed.'''
+
+    def __init__(self, maxSize=4096):
+        self.maxSize = maxSize
+        self.trees = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def parse(self, text):
+        tree = self.trees.get(text)
+        stats = excel_stats.current
+        if tree is not None:
+            self.hits += 1
+            self.trees.move_to_end(text)
+            if stats is not None:
+                stats.count('parseHits')
+            return tree
+        self.misses += 1
+        if stats is not None:
+            stats.count('parseMisses')
+        with excel_stats.phase('parse'):
+            tree = freeze(getParser().parse(text, lexer=getLexer()))
+        self.trees[text] = tree
+        if len(self.trees) > self.maxSize:
+            self.trees.popitem(last=False)
+            self.evictions += 1
+        return tree
+
+    def clear(self):
+        self.trees.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {'size': len(self.trees), 'maxSize': self.maxSize, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+formulaCache = ParseCache()
+
+def parseFormula(text):
+    '''Parses formula text, returning the shared (immutable) tree from the cache
+    when the same text has been seen before.'''
+    return formulaCache.parse(text)
 
 
 if __name__ == '__main__':
 
+    if sys.argv[1:] == ['--tables']:
+        writeTables()
+        sys.exit(0)
+
     # Test inputs
     inputs = [
                 # Field test formulae
@@ -354,7 +469,7 @@ if __name__ == '__main__':
         dump = True
 
         try:
-            tree = yacc.parse(t)
+            tree = getParser().parse(t, lexer=getLexer())
             print(tree)
             if tree == None:
                 dump = True
@@ -364,6 +479,7 @@ if __name__ == '__main__':
 
         if dump:
             print("DUMP:::")
+            lexer = getLexer()
             lexer.input(t)
             while True:
                 tok = lexer.token()
@@ -0,0 +1,66 @@
+
+# excel_lang_tab.py
+# This file is automatically generated. Do not edit.
+# pylint: disable=W,C,R
+_tabversion = '3.10'
+
+_lr_method = 'LALR'
+
+_lr_signature = 'leftEQNEGTLTGTELTEleftSTRCONCATleftADDSUBleftMULTDIVleftPOWrightUMINUSADD ARGSEP BOOL CELL CELLRANGE COLRANGE DIV DOLLAR EQ FN GT GTE INTEGER LBRACE LBRACKET LPAREN LT LTE MULT NAME NE NUMBER NUMBER_HEX POW RANGESEP RBRACE RBRACKET RELCELL ROWRANGE RPAREN STRCONCAT STRING SUB TYPEDEF WBREFformula : EQ expressionformula : EQ arrayarray : LBRACE expression RBRACEfunction : FN LPAREN terms RPARENterms : termlistterms :termlist : expressiontermlist : termlist ARGSEP expressionterm : functionterm : STRINGterm : RELCELLterm : NAMEterm : BOOLterm : NUMBER_HEXterm : NUMBERterm : CELLterm : CELLRANGEterm : RELCELL RANGESEP RELCELLterm : COLRANGEterm : ROWRANGEexpression : termexpression : LPAREN expression RPARENexpression : expression ADD expression\n                  | expression SUB expression\n                  | expression MULT expression\n                  | expression DIV expression\n                  | expression POW expression\n                  | expression EQ expression\n                  | expression NE expression\n                  | expression GT expression\n                  | expression LT expression\n                  | expression GTE expression\n                  | expression LTE expression\n                  | expression STRCONCAT expressionexpression : SUB expression %prec UMINUS\n                  | ADD expression %prec UMINUS'
+    
+_lr_action_items = {'EQ':([0,3,5,10,11,12,13,14,15,16,17,18,19,20,34,35,36,37,40,41,42,43,44,45,46,47,48,49,50,51,52,54,57,58,60,],[2,22,-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,22,-36,-35,22,-28,-23,-24,-25,-26,-27,-29,-30,-31,-32,-33,-34,-22,-18,22,-4,22,]),'$end':([1,3,4,5,10,11,12,13,14,15,16,17,18,19,20,35,36,40,41,42,43,44,45,46,47,48,49,50,51,52,53,54,58,],[0,-1,-2,-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,-36,-35,-28,-23,-24,-25,-26,-27,-29,-30,-31,-32,-33,-34,-22,-3,-18,-4,]),'LPAREN':([2,6,7,8,9,21,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[6,6,6,6,6,39,6,6,6,6,6,6,6,6,6,6,6,6,6,6,]),'SUB':([2,3,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,39,40,41,42,43,44,45,46,47,48,49,50,51,52,54,57,58,59,60,],[8,24,-21,8,8,8,8,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,8,8,8,8,8,8,8,8,8,8,8,8,24,-36,-35,24,8,24,-23,-24,-25,-26,-27,24,24,24,24,24,24,-22,-18,24,-4,8,24,]),'ADD':([2,3,5,6,7,8,9,10,11,12,13,14,15,16,17,18,19,20,22,23,24,25,26,27,28,29,30,31,32,33,34,35,36,37,39,40,41,42,43,44,45,46,47,48,49,50,51,52,54,57,58,59,60,],[7,23,-21,7,7,7,7,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,7,7,7,7,7,7,7,7,7,7,7,7,23,-36,-35,23,7,23,-23,-24,-25,-26,-27,23,23,23,23,23,23,-22,-18,23,-4,7,23,]),'LBRACE':([2,],[9,]),'STRING':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[11,11,11,11,11,11,11,11,11,11,11,11,11,11,11,11,11,11,11,]),'RELCELL':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,38,39,59,],[12,12,12,12,12,12,12,12,12,12,12,12,12,12,12,12,12,54,12,12,]),'NAME':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,]),'BOOL':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[14,14,14,14,14,14,14,14,14,14,14,14,14,14,14,14,14,14,14,]),'NUMBER_HEX':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,]),'NUMBER':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[16,16,16,16,16,16,16,16,16,16,16,16,16,16,16,16,16,16,16,]),'CELL':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,]),'CELLRANGE':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,18,]),'COLRANGE':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,19,]),'ROWRANGE':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,20,]),'FN':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,21,]),'MULT':([3,5,10,11,12,13,14,15,16,17,18,19,20,34,35,36,37,40,41,42,43,44,45,46,47,48,49,50,51,52,54,57,58,60,],[25,-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,25,-36,-35,25,25,25,25,-25,-26,-27,25,25,25,25,25,25,-22,-18,25,-4,25,]),'DIV':([3,5,10,11,12,13,14,15,16,17,18,19,20,34,35,36,37,40,41,42,43,44,45,46,47,48,49,50,51,52,54,57,58,60,],[26,-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,26,-36,-35,26,26,26,26,-25,-26,-27,26,26,26,26,26,26,-22,-18,26,-4,26,]),'POW':([3,5,10,11,12,13,14,15,16,17,18,19,20,34,35,36,37,40,41,42,43,44,45,46,47,48,49,50,51,52,54,57,58,60,],[27,-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,27,-36,-35,27,27,27,27,27,27,-27,27,27,27,27,27,27,-22,-18,27,-4,27,]),'NE':([3,5,10,11,12,13,14,15,16,17,18,19,20,34,35,36,37,40,41,42,43,44,45,46,47,48,49,50,51,52,54,57,58,60,],[28,-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,28,-36,-35,28,-28,-23,-24,-25,-26,-27,-29,-30,-31,-32,-33,-34,-22,-18,28,-4,28,]),'GT':([3,5,10,11,12,13,14,15,16,17,18,19,20,34,35,36,37,40,41,42,43,44,45,46,47,48,49,50,51,52,54,57,58,60,],[29,-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,29,-36,-35,29,-28,-23,-24,-25,-26,-27,-29,-30,-31,-32,-33,-34,-22,-18,29,-4,29,]),'LT':([3,5,10,11,12,13,14,15,16,17,18,19,20,34,35,36,37,40,41,42,43,44,45,46,47,48,49,50,51,52,54,57,58,60,],[30,-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,30,-36,-35,30,-28,-23,-24,-25,-26,-27,-29,-30,-31,-32,-33,-34,-22,-18,30,-4,30,]),'GTE':([3,5,10,11,12,13,14,15,16,17,18,19,20,34,35,36,37,40,41,42,43,44,45,46,47,48,49,50,51,52,54,57,58,60,],[31,-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,31,-36,-35,31,-28,-23,-24,-25,-26,-27,-29,-30,-31,-32,-33,-34,-22,-18,31,-4,31,]),'LTE':([3,5,10,11,12,13,14,15,16,17,18,19,20,34,35,36,37,40,41,42,43,44,45,46,47,48,49,50,51,52,54,57,58,60,],[32,-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,32,-36,-35,32,-28,-23,-24,-25,-26,-27,-29,-30,-31,-32,-33,-34,-22,-18,32,-4,32,]),'STRCONCAT':([3,5,10,11,12,13,14,15,16,17,18,19,20,34,35,36,37,40,41,42,43,44,45,46,47,48,49,50,51,52,54,57,58,60,],[33,-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,33,-36,-35,33,33,-23,-24,-25,-26,-27,33,33,33,33,33,-34,-22,-18,33,-4,33,]),'RPAREN':([5,10,11,12,13,14,15,16,17,18,19,20,34,35,36,39,40,41,42,43,44,45,46,47,48,49,50,51,52,54,55,56,57,58,60,],[-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,52,-36,-35,-6,-28,-23,-24,-25,-26,-27,-29,-30,-31,-32,-33,-34,-22,-18,58,-5,-7,-4,-8,]),'RBRACE':([5,10,11,12,13,14,15,16,17,18,19,20,35,36,37,40,41,42,43,44,45,46,47,48,49,50,51,52,54,58,],[-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,-36,-35,53,-28,-23,-24,-25,-26,-27,-29,-30,-31,-32,-33,-34,-22,-18,-4,]),'ARGSEP':([5,10,11,12,13,14,15,16,17,18,19,20,35,36,40,41,42,43,44,45,46,47,48,49,50,51,52,54,56,57,58,60,],[-21,-9,-10,-11,-12,-13,-14,-15,-16,-17,-19,-20,-36,-35,-28,-23,-24,-25,-26,-27,-29,-30,-31,-32,-33,-34,-22,-18,59,-7,-4,-8,]),'RANGESEP':([12,],[38,]),}
+
+_lr_action = {}
+for _k, _v in _lr_action_items.items():
+   for _x,_y in zip(_v[0],_v[1]):
+      if not _x in _lr_action:  _lr_action[_x] = {}
+      _lr_action[_x][_k] = _y
+del _lr_action_items
+
+_lr_goto_items = {'formula':([0,],[1,]),'expression':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[3,34,35,36,37,40,41,42,43,44,45,46,47,48,49,50,51,57,60,]),'array':([2,],[4,]),'term':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,5,]),'function':([2,6,7,8,9,22,23,24,25,26,27,28,29,30,31,32,33,39,59,],[10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,]),'terms':([39,],[55,]),'termlist':([39,],[56,]),}
+
+_lr_goto = {}
+for _k, _v in _lr_goto_items.items():
+   for _x, _y in zip(_v[0], _v[1]):
+       if not _x in _lr_goto: _lr_goto[_x] = {}
+       _lr_goto[_x][_k] = _y
+del _lr_goto_items
+_lr_productions = [
+  ("S' -> formula","S'",1,None,None,None),
+  ('formula -> EQ expression','formula',2,'p_formula_exp','excel_lang.py',186),
+  ('formula -> EQ array','formula',2,'p_formula_array','excel_lang.py',190),
+  ('array -> LBRACE expression RBRACE','array',3,'p_array_function','excel_lang.py',196),
+  ('function -> FN LPAREN terms RPAREN','function',4,'p_function','excel_lang.py',202),
+  ('terms -> termlist','terms',1,'p_terms','excel_lang.py',207),
+  ('terms -> <empty>','terms',0,'p_args_empty','excel_lang.py',211),
+  ('termlist -> expression','termlist',1,'p_termlist_single','excel_lang.py',215),
+  ('termlist -> termlist ARGSEP expression','termlist',3,'p_termlist_more','excel_lang.py',219),
+  ('term -> function','term',1,'p_term_function','excel_lang.py',224),
+  ('term -> STRING','term',1,'p_term_string','excel_lang.py',228),
+  ('term -> RELCELL','term',1,'p_term_relcell','excel_lang.py',232),
+  ('term -> NAME','term',1,'p_term_name','excel_lang.py',236),
+  ('term -> BOOL','term',1,'p_term_bool','excel_lang.py',240),
+  ('term -> NUMBER_HEX','term',1,'p_term_numberhex','excel_lang.py',244),
+  ('term -> NUMBER','term',1,'p_term_number','excel_lang.py',248),
+  ('term -> CELL','term',1,'p_term_cell','excel_lang.py',252),
+  ('term -> CELLRANGE','term',1,'p_term_cellrange','excel_lang.py',256),
+  ('term -> RELCELL RANGESEP RELCELL','term',3,'p_term_cellrange_rel','excel_lang.py',260),
+  ('term -> COLRANGE','term',1,'p_term_colrange','excel_lang.py',264),
+  ('term -> ROWRANGE','term',1,'p_term_rowrange','excel_lang.py',268),
+  ('expression -> term','expression',1,'p_expression_term','excel_lang.py',273),
+  ('expression -> LPAREN expression RPAREN','expression',3,'p_expression_sub','excel_lang.py',277),
+  ('expression -> expression ADD expression','expression',3,'p_expression_binop','excel_lang.py',281),
+  ('expression -> expression SUB expression','expression',3,'p_expression_binop','excel_lang.py',282),
+  ('expression -> expression MULT expression','expression',3,'p_expression_binop','excel_lang.py',283),
+  ('expression -> expression DIV expression','expression',3,'p_expression_binop','excel_lang.py',284),
+  ('expression -> expression POW expression','expression',3,'p_expression_binop','excel_lang.py',285),
+  ('expression -> expression EQ expression','expression',3,'p_expression_binop','excel_lang.py',286),
+  ('expression -> expression NE expression','expression',3,'p_expression_binop','excel_lang.py',287),
+  ('expression -> expression GT expression','expression',3,'p_expression_binop','excel_lang.py',288),
+  ('expression -> expression LT expression','expression',3,'p_expression_binop','excel_lang.py',289),
+  ('expression -> expression GTE expression','expression',3,'p_expression_binop','excel_lang.py',290),
+  ('expression -> expression LTE expression','expression',3,'p_expression_binop','excel_lang.py',291),
+  ('expression -> expression STRCONCAT expression','expression',3,'p_expression_binop','excel_lang.py',292),
+  ('expression -> SUB expression','expression',2,'p_expression_uminus','excel_lang.py',296),
+  ('expression -> ADD expression','expression',2,'p_expression_uminus','excel_lang.py',297),
+]
@@ -0,0 +1,120 @@
+import numpy as np
+
+
+'''
+The indexes behind VLOOKUP.
+
+A LookupTable holds the first column of a lookup table, indexed two ways, and
+the constant cells of every column. Exact matches go through a hash of the
+keys, approximate matches through the keys sorted, with numbers and text kept
+apart as excel never matches one against the other. A whole array of keys,
+one per scenario, is matched at once: each distinct key is hashed once, and
+a sorted search is a single np.searchsorted call.
+
+As in excel, text matches ignoring case. An approximate match finds the
+largest key no bigger than the one looked up, excel expects the first column
+to be sorted for that and here it is sorted first, so an unsorted table gives
+the answer a sorted one would.
+'''
+
+class LookupTable():
+
+	def __init__(self, bounds, columns, calculated=()):
+		'''bounds is the (sheet, row0, col0, row1, col1) of the table, columns
+		a list of the columns of constant values, each a list with one value
+		per row (None for an empty or calculated cell), and calculated the
+		(row, col) positions, from 0, of the cells holding formulas.'''
+		self.bounds = bounds
+		self.width = len(columns)
+		self.height = len(columns[0]) if columns else 0
+		self.calculated = frozenset(calculated)
+		for row, col in self.calculated:
+			if col == 0:
+				raise Exception("the first column of the lookup table " + str(bounds) + " is calculated, which VLOOKUP cannot index")
+		self.columns = [columnArray(c) for c in columns]
+
+		keys = columns[0] if columns else []
+		self.exact = {}
+		for row in range(len(keys) - 1, -1, -1):
+			# the first of equal keys is the one found
+			if keys[row] is not None:
+				self.exact[keyOf(keys[row])] = row
+		self.numbers, self.numberRows = sortedKeys(keys, lambda k: isinstance(k, float), float)
+		self.texts, self.textRows = sortedKeys(keys, lambda k: isinstance(k, str), str.lower)
+
+	def match(self, keys, exact=True):
+		'''The rows of the table matching the keys, a scalar or an array, with
+		-1 where nothing matches.'''
+		if np.ndim(keys) == 0:
+			key = keys.item() if isinstance(keys, np.ndarray) else keys
+			if exact:
+				return self.exact.get(keyOf(key), -1) if isKey(key) else -1
+			return int(self.approximate(np.asarray([key], dtype=object))[0])
+		keys = np.asarray(keys)
+		if exact:
+			if keys.dtype == object:
+				# text and numbers together cannot be sorted by np.unique
+				return np.frompyfunc(lambda k: self.exact.get(keyOf(k), -1) if isKey(k) else -1, 1, 1)(keys).astype(np.int64)
+			distinct, inverse = np.unique(keys, return_inverse=True)
+			rows = np.array([self.exact.get(keyOf(k), -1) if isKey(k) else -1 for k in distinct.tolist()], dtype=np.int64)
+			return rows[inverse].reshape(keys.shape)
+		return self.approximate(keys)
+
+	def approximate(self, keys):
+		rows = np.full(keys.shape, -1, dtype=np.int64)
+		if keys.dtype.kind in 'US':
+			return searchSorted(self.texts, self.textRows, np.char.lower(keys.astype(str)), rows, np.ones(keys.shape, dtype=bool))
+		if keys.dtype != object:
+			return searchSorted(self.numbers, self.numberRows, keys.astype(float), rows, np.ones(keys.shape, dtype=bool))
+		text = np.frompyfunc(lambda k: isinstance(k, str), 1, 1)(keys).astype(bool)
+		number = np.frompyfunc(lambda k: isinstance(k, (float, int)) and not isinstance(k, bool), 1, 1)(keys).astype(bool)
+		if text.any():
+			rows = searchSorted(self.texts, self.textRows, np.char.lower(np.where(text, keys, '').astype(str)), rows, text)
+		if number.any():
+			rows = searchSorted(self.numbers, self.numberRows, np.where(number, keys, np.nan).astype(float), rows, number)
+		return rows
+
+
+def searchSorted(sortedKeys, sortedRows, keys, rows, mask):
+	'''Fills in rows, where mask is set, with the row of the largest sorted key
+	no bigger than each key.'''
+	if not len(sortedKeys):
+		return rows
+	pos = np.searchsorted(sortedKeys, keys, side='right') - 1
+	if keys.dtype.kind == 'f':
+		mask = mask & ~np.isnan(keys)
+	found = mask & (pos >= 0)
+	return np.where(found, sortedRows[np.maximum(pos, 0)], rows)
+
+
+def sortedKeys(keys, test, convert):
+	'''The keys passing test, converted and sorted, with the rows they are on.
+	Of equal keys the last is kept, as excel's binary search finds it.'''
+	rows = [row for row, k in enumerate(keys) if test(k) and not (isinstance(k, float) and np.isnan(k))]
+	values = np.array([convert(keys[row]) for row in rows])
+	rows = np.array(rows, dtype=np.int64)
+	order = np.argsort(values, kind='stable')
+	return values[order], rows[order]
+
+
+def isKey(key):
+	'''False for the keys that can never match, errors.'''
+	return isinstance(key, str) or not np.isnan(key)
+
+
+def keyOf(key):
+	'''The hash key of a value, so that 1, 1.0 and '1' are told apart but not
+	'Steel' and 'STEEL'.'''
+	if isinstance(key, str):
+		return ('s', key.lower())
+	if isinstance(key, (bool, np.bool_)):
+		return ('b', bool(key))
+	return ('n', float(key))
+
+
+def columnArray(values):
+	'''A column of values as a float array, NaN for the empty cells, or as an
+	object array if it holds any text.'''
+	if any(isinstance(v, (str, bool)) for v in values):
+		return np.array([np.nan if v is None else v for v in values], dtype=object)
+	return np.array([np.nan if v is None else v for v in values], dtype=float)
@@ -0,0 +1,229 @@
+import math
+import numpy as np
+import excel_graph
+import excel_grid
+
+
+'''
+An optimisation pass over the formulas of a CellGraph, run between parsing
+and evaluation or code generation.
+
+Every formula tree is rewritten with its references resolved to the cells
+they point at, ('CELLREF', address) and ('RANGEREF', bounds), so that two
+cells reading the same cells through different relative references hold the
+same subexpression. Along the way
+	literal arithmetic, PI(), and ROUND, IF, IFERROR or the aggregates over
+	literals are folded into a NUMBER, and the literals of a chain of * are
+	multiplied together first, as in 0.58*R[-319]C*PI()*R[-277]C
+	every subexpression is hash-consed, given one id for the whole graph, and
+	those used more than once become ('SHARED', id), whose tree is kept once
+	in graph.shared and which the evaluators and the kernel compiler work out
+	only once per scenario.
+'''
+
+# the trees that are never worth sharing, reading them is as cheap as a lookup
+LEAVES = ('NUMBER', 'STRING', 'BOOL', 'CELLREF', 'RANGEREF', 'NAME')
+
+
+class Optimizer():
+
+	def __init__(self, graph):
+		self.graph = graph
+		self.wb = graph.wb
+		self.ids = {}       # hash-consed key -> expression id
+		self.keys = []      # expression id -> key, (kind, arg, child ids)
+		self.uses = []      # expression id -> how many times it is read
+		self.before = 0     # nodes of the parsed trees
+		self.folded = 0
+
+	def run(self):
+		'''Optimises every formula of the graph in place, returning a report.'''
+		graph = self.graph
+		roots = {}
+		with np.errstate(all='ignore'):
+			for node, tree in enumerate(graph.trees):
+				if tree is not None:
+					self.before += countNodes(tree)
+					roots[node] = self.intern(self.resolve(tree, graph.cells[node]))
+		for id in roots.values():
+			self.uses[id] += 1
+
+		self.built = {}
+		graph.shared = {}
+		for node, id in roots.items():
+			graph.trees[node] = self.build(id)
+		return {
+			'before': self.before,
+			'after': len(self.keys),
+			'removed': self.before - len(self.keys),
+			'folded': self.folded,
+			'shared': len(graph.shared),
+		}
+
+	def intern(self, key):
+		'''The id of an expression, (kind, arg, child ids), the same id for the
+		same expression anywhere in the graph.'''
+		id = self.ids.get(key)
+		if id is None:
+			id = self.ids[key] = len(self.keys)
+			self.keys.append(key)
+			self.uses.append(0)
+			for child in key[2]:
+				self.uses[child] += 1
+		return id
+
+	def build(self, id, root=False):
+		'''The tree of an expression, with the shared expressions under it as
+		('SHARED', id).'''
+		kind, arg, children = self.keys[id]
+		if not root and self.uses[id] > 1 and kind not in LEAVES:
+			if id not in self.graph.shared:
+				self.graph.shared[id] = self.build(id, True)
+			return ('SHARED', id)
+		if id in self.built and not root:
+			return self.built[id]
+		if kind in ('FUNC', 'BINOP', 'UNOP'):
+			tree = (kind, arg, tuple(self.build(c) for c in children))
+		elif kind == 'ARRAY_FN':
+			tree = (kind, tuple(self.build(c) for c in children))
+		else:
+			tree = (kind, arg)
+		self.built[id] = tree
+		return tree
+
+	def resolve(self, t, cell):
+		'''The hash-consing key of a parsed tree, references resolved and the
+		literals folded.'''
+		kind = t[0]
+		if kind == 'SUBEXP':
+			return self.resolve(t[1][0], cell)
+		elif kind == 'NUMBER':
+			return ('NUMBER', float(t[1]), ())
+		elif kind in ('STRING', 'BOOL'):
+			return (kind, t[1], ())
+		elif kind == 'RELCELL':
+			return ('CELLREF', cell.calcOffset(t[1]), ())
+		elif kind == 'RELCELLRANGE':
+			return ('RANGEREF', excel_graph.rangeBounds(cell, t[1], t[2]), ())
+		elif kind == 'NAME':
+			name = self.wb.scopedName(t[1], cell.sheet)
+			bounds = excel_graph.namedRange(self.wb, name)
+			if bounds is not None:
+				return ('RANGEREF', bounds, ())
+			return ('CELLREF', self.wb.resolveAddress(name), ())
+		elif kind in ('CELLREF', 'RANGEREF'):
+			# already resolved by an earlier run over the graph
+			return (kind, t[1], ())
+		elif kind == 'SHARED':
+			return self.resolve(self.graph.shared[t[1]], cell)
+		elif kind == 'UNOP':
+			arg = self.resolve(t[2][0], cell)
+			if arg[0] == 'NUMBER':
+				return self.literal(-arg[1])
+			return ('UNOP', t[1], (self.intern(arg),))
+		elif kind == 'BINOP':
+			if t[1] == '*':
+				return self.resolveProduct(t, cell)
+			left, right = self.resolve(t[2][0], cell), self.resolve(t[2][1], cell)
+			if left[0] == 'NUMBER' and right[0] == 'NUMBER':
+				if t[1] in excel_grid.COMPARISONS:
+					self.folded += 1
+					return ('BOOL', bool(excel_grid.binop(t[1], left[1], right[1])), ())
+				folded = foldValue(excel_grid.binop(t[1], left[1], right[1])) if t[1] in excel_grid.ARITHMETIC else None
+				if folded is not None:
+					return self.literal(folded)
+			return ('BINOP', t[1], (self.intern(left), self.intern(right)))
+		elif kind == 'FUNC':
+			return self.resolveFunction(t[1], [self.resolve(a, cell) for a in t[2]])
+		elif kind == 'ARRAY_FN':
+			return ('ARRAY_FN', None, (self.intern(self.resolve(t[1][0], cell)),))
+		raise Exception("ERROR: type " + str(kind) + " not supported yet!")
+
+	def resolveProduct(self, t, cell):
+		'''A chain of *, with the literals in it multiplied together up front.'''
+		factors = []
+		stack = [t]
+		while stack:
+			f = stack.pop()
+			while f[0] == 'SUBEXP':
+				f = f[1][0]
+			if f[0] == 'BINOP' and f[1] == '*':
+				stack.append(f[2][1])
+				stack.append(f[2][0])
+			else:
+				factors.append(self.resolve(f, cell))
+		numbers = [f[1] for f in factors if f[0] == 'NUMBER']
+		others = [f for f in factors if f[0] != 'NUMBER']
+		if len(numbers) > 1:
+			product = foldValue(np.prod(numbers))
+			if product is None:
+				# leave the literals where they were rather than fold to an error
+				others = factors
+			else:
+				self.folded += len(numbers) - 1
+				others = [('NUMBER', product, ())] + others
+		else:
+			others = factors
+		if len(others) == 1:
+			return others[0]
+		key = others[0]
+		for f in others[1:]:
+			key = ('BINOP', '*', (self.intern(key), self.intern(f)))
+		return key
+
+	def resolveFunction(self, name, args):
+		numbers = all(a[0] == 'NUMBER' for a in args)
+		folded = None
+		if name == 'PI' and not args:
+			folded = math.pi
+		elif name == 'ROUND' and len(args) == 2 and numbers:
+			folded = foldValue(excel_grid.excelRound(args[0][1], args[1][1]))
+		elif name in excel_grid.AGGREGATES and args and numbers:
+			folded = foldValue(excel_grid.aggregate(name, [a[1] for a in args]))
+		elif name == 'IF' and len(args) == 3 and args[0][0] in ('NUMBER', 'BOOL'):
+			# only the arm that is taken is left, whatever it is
+			self.folded += 1
+			return args[1] if args[0][1] else args[2]
+		elif name == 'IFERROR' and len(args) == 2 and args[0][0] in ('NUMBER', 'STRING', 'BOOL'):
+			# a literal is never an error, literals that would be are not folded
+			self.folded += 1
+			return args[0]
+		if folded is not None:
+			return self.literal(folded)
+		return ('FUNC', name, tuple(self.intern(a) for a in args))
+
+	def literal(self, value):
+		self.folded += 1
+		return ('NUMBER', value, ())
+
+
+def foldValue(value):
+	'''A folded result as a float, or None when it is not a finite number and
+	so is better left to be worked out, and reported, at run time.'''
+	value = np.asarray(value)
+	if value.shape != () or value.dtype.kind not in 'fiub':
+		return None
+	value = float(value)
+	return value if math.isfinite(value) else None
+
+
+def countNodes(t):
+	'''The number of nodes in a parsed tree.'''
+	count = 0
+	stack = [t]
+	while stack:
+		t = stack.pop()
+		count += 1
+		kind = t[0]
+		if kind in ('BINOP', 'UNOP', 'FUNC'):
+			stack.extend(t[2])
+		elif kind in ('SUBEXP', 'ARRAY_FN'):
+			stack.extend(t[1])
+	return count
+
+
+def optimizeGraph(graph):
+	'''Folds constants and shares common subexpressions across every formula of
+	a CellGraph, see the module docstring. Returns a report of the number of
+	nodes before and after, and so removed.'''
+	return Optimizer(graph).run()
@@ -1,8 +1,18 @@
 import xml.sax
+import xml.parsers.expat
+import concurrent.futures
+import mmap
+import os
+import re
 import sys
-import math
-import excel_lang
-import pickle
+import time
+import numpy as np
+import excel_stats
+import excel_store
+import excel_cache
+import excel_codegen
+import excel_graph
+import excel_xlsx
 
 
 '''
@@ -17,8 +27,15 @@ class ExcelWB():
 		self.xlData = {}
 		self.xlData["namedRanges"] = []
 		self.xlData["namedCells"]  = {}
+		self.xlData["names"] = {}       # name -> (sheet, row0, col0, row1, col1), see getNamedRange
 		self.xlData["worksheets"]  = {}
 		self.xlData["fileName"] = ""
+		self.xlData["changes"] = set()
+		self.xlData["lookups"] = {}     # table bounds -> excel_lookup.LookupTable
+		# the values that repeat across cells are interned once per workbook
+		self.xlData["datatypes"] = excel_store.InternTable()
+		self.xlData["strings"]   = excel_store.InternTable()
+		self.xlData["formulas"]  = excel_store.InternTable()
 
 	def setFileName(self, fileName):
 		self.xlData["fileName"] = fileName
@@ -26,131 +43,290 @@ class ExcelWB():
 	def getFileName(self):
 		return self.xlData["fileName"]
 
-	def setCellData(self, cell, field, value):
-		'''each cell location in the nested dict of objects. The 'data' for the
-		cell is a dict, with each key representing an associated piece of data, its
-		name, type and other meta-data.'''
-		cellAddress = cell.getAddress()
-		col = cellAddress[2]
-		row = str(cellAddress[1])
-		worksheet = cellAddress[0]
-		if not worksheet in self.xlData["worksheets"]:
-			self.xlData["worksheets"][worksheet] = {}
-		if not col in self.xlData["worksheets"][worksheet]:
-			self.xlData["worksheets"][worksheet][col] = {}
-		if not row in self.xlData["worksheets"][worksheet][col]:
-			self.xlData["worksheets"][worksheet][col][row] = {}
-		if not field in self.xlData["worksheets"][worksheet][col][row]:
-			self.xlData["worksheets"][worksheet][col][row][field] = value
+	def getSheet(self, worksheet):
+		'''The SheetStore of a worksheet, created the first time it is asked for.'''
+		store = self.xlData["worksheets"].get(worksheet)
+		if store is None:
+			store = excel_store.SheetStore(worksheet, self.xlData["datatypes"],
+				self.xlData["strings"], self.xlData["formulas"])
+			self.xlData["worksheets"][worksheet] = store
+		return store
+
+	def setCellData(self, cell, field, value, replace=False):
+		'''each cell has a slot in the arrays of its worksheet's store. The 'data'
+		for the cell is its formula, datatype and content, the first value set
+		for a field is kept unless replace is True. Replaced cells are noted so
+		that an IncrementalEvaluator can pick up the change.'''
+		self.getSheet(cell.sheet).setField(cell.row, cell.col, field, value, replace)
+		if replace:
+			self.xlData["changes"].add(cell.getAddress())
+		if self.xlData["lookups"]:
+			self.xlData["lookups"] = {}
+
+	def popChanges(self):
+		'''The addresses of the cells replaced since the last call.'''
+		changes = self.xlData["changes"]
+		self.xlData["changes"] = set()
+		return changes
 
 	def getCell(self, address): #, worksheet, col, row, type
 		col = address[2]
 		row = address[1]
 		worksheet = address[0]
-		try:
-			cell = ExcelCell(worksheet, 
-				col, 
-				row, 
-				self.xlData["worksheets"][worksheet][col][row]
-			)
-		except Exception as e:
-			if not worksheet in self.xlData["worksheets"]:
-				print("ERROR:", worksheet, "worksheet is not found")
-			elif not col in self.xlData["worksheets"][worksheet]:
-				print("ERROR: column", col, "not found in workbook")
-				print(self.xlData['worksheets'][worksheet])
-			elif not row in self.xlData["worksheets"][worksheet][col]:
-				print("ERROR: row", row, "not found in workbook")
-			raise e
-		return cell
+		stats = excel_stats.current
+		if stats is not None:
+			stats.count('getCell')
+		if not worksheet in self.xlData["worksheets"]:
+			raise KeyError("worksheet " + str(worksheet) + " is not found")
+		store = self.xlData["worksheets"][worksheet]
+		slot = store.findSlot(int(row), excel_store.name2col(col))
+		if slot is None:
+			raise KeyError("cell " + col + str(row) + " of " + str(worksheet) + " is not found in the workbook")
+		return ExcelCell(worksheet, col, row, None, store, slot)
+
+	def hasCell(self, address):
+		'''True if the workbook holds any data for the (sheet, row, col) address.'''
+		store = self.xlData["worksheets"].get(address[0])
+		return store is not None and store.findSlot(int(address[1]), excel_store.name2col(address[2])) is not None
+
+	def getRange(self, fromRef, toRef):
+		'''The numeric values of the rectangle between two references (see
+		resolveAddress), as a 2-D float64 NumPy array with NaN where a cell holds
+		no number, newly gathered from just the cells of the rectangle. Cells
+		holding formulas give their last calculated value.'''
+		fromAddress, toAddress = self.resolveAddress(fromRef), self.resolveAddress(toRef)
+		if fromAddress[0] != toAddress[0]:
+			raise Exception("A range must be on one worksheet, " + str(fromAddress) + " to " + str(toAddress))
+		rows = sorted((int(fromAddress[1]), int(toAddress[1])))
+		cols = sorted((excel_store.name2col(fromAddress[2]), excel_store.name2col(toAddress[2])))
+		return self.getBlock((fromAddress[0], rows[0], cols[0], rows[1], cols[1]))
+
+	def getBlock(self, bounds):
+		'''The numeric values of the (sheet, row0, col0, row1, col1) rectangle,
+		as getRange gives them.'''
+		sheet, row0, col0, row1, col1 = bounds
+		store = self.xlData["worksheets"].get(sheet)
+		if store is None:
+			return np.full((row1 - row0 + 1, col1 - col0 + 1), np.nan)
+		return store.getBlock(row0, col0, row1, col1)[0]
+
+	def getAddresses(self):
+		'''Yields the (sheet, row, col) address of every populated cell.'''
+		for sheet, store in self.xlData["worksheets"].items():
+			for slot, row, col in store.getSlots():
+				yield (sheet, str(row), excel_store.col2Name(col))
+
+	def resolveAddress(self, ref):
+		'''Turns a reference into a (sheet, row, col) address. A reference can
+		already be an address tuple, an A1 style 'Sheet1!D2' string or the name
+		of a named cell or range.'''
+		if isinstance(ref, tuple):
+			return (ref[0], str(ref[1]), ref[2])
+		bounds = self.xlData["names"].get(ref)
+		if bounds is not None:
+			# the top left cell of a named range
+			return (bounds[0], str(bounds[1]), excel_store.col2Name(bounds[2]))
+		if '!' in ref:
+			sheet, cellRef = ref.rsplit('!', 1)
+			cellRef = cellRef.replace('$', '')
+			split = len(cellRef.rstrip('0123456789'))
+			if 0 < split < len(cellRef):
+				return (sheet, cellRef[split:], cellRef[:split])
+		raise Exception("Cannot resolve '" + str(ref) + "' to a cell address")
 
 	def getNamedCell(self, workbook, name):
-		if name in self.xlData["namedCells"]:
-			cellRange = self.xlData["namedCells"][name]
-			if len(cellRange) == 1:
-				print("named cell points to:", cellRange[0][0], cellRange[0][1], cellRange[0][2])
-				return self.getCell( (cellRange[0][0], cellRange[0][2], cellRange[0][1]) )
-		else:
+		'''The ExcelCell a name refers to, None if the name is not known, names
+		a range or an empty cell.'''
+		bounds = self.xlData["names"].get(name)
+		if bounds is None or bounds[1] != bounds[3] or bounds[2] != bounds[4]:
 			return None
+		address = self.resolveAddress(name)
+		return self.getCell(address) if self.hasCell(address) else None
+
+	def getNamedRange(self, name):
+		'''The (sheet, row0, col0, row1, col1) bounds, rows from 1 and columns
+		from 0, a name refers to, or None if the name is not known. Names are
+		indexed as they are loaded, from the RefersTo of their NamedRange and
+		the cells marked with them.'''
+		return self.xlData["names"].get(name)
+
+	def getNamedValues(self, name):
+		'''The numeric values of the cells a name refers to, as a newly gathered
+		2-D array, see getRange.'''
+		bounds = self.xlData["names"].get(name)
+		if bounds is None:
+			raise Exception("Cannot resolve the name '" + str(name) + "'")
+		return self.getBlock(bounds)
 
 	def setNamedCell(self, cellName, cell):
+		cellName = self.scopedName(cellName, cell.sheet)
 		if not cellName in self.xlData["namedCells"]:
 			self.addNamedCell(cellName)
 		addr = cell.getAddress()
 		self.xlData["namedCells"][cellName].append((addr[0], addr[2], str(addr[1])))
-
-	def addNamedRange(self, rangeName, rangeRefersTo):
-		self.xlData["namedRanges"].append({'name':rangeName, 'refersto':rangeRefersTo})
+		self.indexName(cellName, (addr[0], cell.row, cell.col, cell.row, cell.col))
+
+	def addNamedRange(self, rangeName, rangeRefersTo, sheet=None):
+		'''Adds a name, local to the worksheet sheet if one is given, as a name
+		under a Worksheet's Names is. A local name is indexed as Sheet!Name,
+		the way Excel refers to it from other sheets, see scopedName.'''
+		namedRange = {'name':rangeName, 'refersto':rangeRefersTo}
+		if sheet is not None:
+			namedRange['sheet'] = sheet
+		self.xlData["namedRanges"].append(namedRange)
+		bounds = parseRefersTo(rangeRefersTo)
+		if bounds is not None:
+			self.indexName(indexKey(namedRange), bounds)
+
+	def scopedName(self, name, sheet):
+		'''The key of a name in the name index as a formula on the worksheet
+		sheet reads it, its own local name if it has one, or else the workbook
+		wide one.'''
+		local = str(sheet) + '!' + name
+		return local if local in self.xlData["names"] else name
 
 	def addNamedCell(self, cellName):
 		self.xlData["namedCells"][cellName] = []
 
+	def indexName(self, name, bounds):
+		'''Adds bounds to the name index, growing the bounds a name already has
+		on the same sheet to take them in. The cells marked with a name lie in
+		its RefersTo, so for those nothing changes.'''
+		names = self.xlData["names"]
+		old = names.get(name)
+		if old is not None and old[0] == bounds[0]:
+			bounds = (old[0], min(old[1], bounds[1]), min(old[2], bounds[2]), max(old[3], bounds[3]), max(old[4], bounds[4]))
+		names[name] = bounds
+
+	def indexNames(self):
+		'''Rebuilds the name index from the named ranges and named cells.'''
+		self.xlData["names"] = {}
+		for namedRange in self.xlData["namedRanges"]:
+			bounds = parseRefersTo(namedRange['refersto'])
+			if bounds is not None:
+				self.indexName(indexKey(namedRange), bounds)
+		for name, cells in self.xlData["namedCells"].items():
+			for sheet, col, row in cells:
+				col = excel_store.name2col(col) if isinstance(col, str) else int(col)
+				self.indexName(name, (sheet, int(row), col, int(row), col))
+
 	def getData(self):
 		return self.xlData
 
 	def dump(self):
-		print("WORKSHEETS\n", self.xlData["worksheets"])
+		print("WORKSHEETS")
+		for address in self.getAddresses():
+			print(address, self.getCell(address).getData())
 		print("NAMED CELLS\n", self.xlData["namedCells"])
 		print("NAMED RANGES\n", self.xlData["namedRanges"])
 
 
+# a RefersTo, =Sheet1!R2C3 or =Sheet1!R2C3:R10C4, or in A1 style =Sheet1!$C$2:$D$10,
+# the sheet name quoted when it has to be
+REFERSTO = re.compile(r"=?(?:'((?:[^']|'')+)'|([^'!]+))!(.+)$")
+R1C1RANGE = re.compile(r"R(\d+)C(\d+)(?::R(\d+)C(\d+))?$")
+# whole rows or columns in R1C1, which would read as A1 cells otherwise
+R1C1LINES = re.compile(r"(?:R\d+(?::R\d+)?|C\d+(?::C\d+)?)$")
+A1RANGE = re.compile(r"\$?([A-Za-z]{1,3})\$?(\d+)(?::\$?([A-Za-z]{1,3})\$?(\d+))?$")
+
+
+def parseRefersTo(refersTo):
+	'''The (sheet, row0, col0, row1, col1) bounds of the cells a RefersTo points
+	at, rows from 1 and columns from 0, or None when it is anything else (a
+	constant, a formula, whole rows or columns).'''
+	found = REFERSTO.match(refersTo.strip())
+	if not found:
+		return None
+	sheet = found.group(1).replace("''", "'") if found.group(1) else found.group(2)
+	ref = found.group(3)
+	cells = R1C1RANGE.match(ref)
+	if cells:
+		row0, col0 = int(cells.group(1)), int(cells.group(2)) - 1
+		row1, col1 = (int(cells.group(3)), int(cells.group(4)) - 1) if cells.group(3) else (row0, col0)
+	else:
+		cells = A1RANGE.match(ref) if not R1C1LINES.match(ref) else None
+		if not cells:
+			return None
+		row0, col0 = int(cells.group(2)), excel_store.name2col(cells.group(1).upper())
+		row1, col1 = (int(cells.group(4)), excel_store.name2col(cells.group(3).upper())) if cells.group(3) else (row0, col0)
+	return (sheet, min(row0, row1), min(col0, col1), max(row0, row1), max(col0, col1))
+
+
+def indexKey(namedRange):
+	'''The key of a named range in the name index, Sheet!Name for a name local
+	to a worksheet.'''
+	sheet = namedRange.get('sheet')
+	return namedRange['name'] if sheet is None else sheet + '!' + namedRange['name']
+
+
 class ExcelCell():
+	'''A lightweight view of one cell, its data is read from the worksheet's
+	store when asked for.'''
+
+	__slots__ = ('sheet', 'col', 'row', 'data', 'store', 'slot')
 
-	def __init__(self, sheet, col, row, data):
-		self.BigA = ord('A')
+	def __init__(self, sheet, col, row, data, store=None, slot=None):
 		self.sheet = sheet
 		self.col = int(self.name2col(col))
 		self.row = int(row)
 		self.data = data
+		self.store = store
+		self.slot = slot
 
 	def getAddress(self):
-		return (self.sheet, str(self.row), str(self.col2Name(self.col) ) )
+		return (self.sheet, str(self.row), excel_store.col2Name(self.col))
 
 	def getFormula(self):
+		if self.store is not None:
+			return self.store.getFormula(self.slot)
 		if 'formula' in self.data:
 			return self.data['formula']
 
 	def getData(self):
+		if self.data is None and self.store is not None:
+			return self.store.getData(self.slot)
 		return self.data
 
 	def getDataType(self):
-		return self.datatype
+		if self.store is not None:
+			return self.store.getDataType(self.slot)
+		return self.data.get('datatype')
 
 	def getVar(self):
-		return self.sheet + "__" + self.col2Name(self.col) + "__" + str(self.row)
+		return self.sheet + "__" + excel_store.col2Name(self.col) + "__" + str(self.row)
 
 	def calcOffset(self, relcell):
 		'''A relcell always supplies offsets in int format, therefore we must first
-		convert the Column to an int, before adding.'''
-		row = str(int(self.row) + int(relcell[0]))
-		col = self.col2Name(str(int(self.col) + int(relcell[1]) ) )
-		return self.sheet, row, col
+		convert the Column to an int, before adding. A full R1C1 reference may also
+		carry absolute parts (1-based) and a sheet name, which replace our own.'''
+		sheet = self.sheet
+		rowAbs = colAbs = False
+		if len(relcell) > 2:
+			rowAbs, colAbs = relcell[2], relcell[3]
+			if relcell[4]:
+				sheet = relcell[4]
+		if rowAbs:
+			row = str(int(relcell[0]))
+		else:
+			row = str(int(self.row) + int(relcell[0]))
+		if colAbs:
+			col = self.col2Name(str(int(relcell[1]) - 1))
+		else:
+			col = self.col2Name(str(int(self.col) + int(relcell[1]) ) )
+		return sheet, row, col
 
 	def col2Name(self, columnValue):
 		'''Converts an integer column value to an Excel Alpha based name.'''
 		try:
-			columnValue = int(columnValue)  # 26 should yield Z, which is A + 25
-			x = math.floor(columnValue / 26) - 1
-			y = columnValue % 26
-			col = ""
-			if x > 0:
-				col = chr(self.BigA + x)
-			return col + chr(self.BigA + y)
-		except Exception as e:
-			# print("col2Name", columnValue, e)
+			return excel_store.col2Name(int(columnValue))  # 25 should yield Z, which is A + 25
+		except ValueError:
 			pass
 		return columnValue
 
 	def name2col(self, columnValue):
 		'''Converts a str column value to an integer.'''
-		acc = 0
-		try:
-			for ch in columnValue:
-				acc = (acc * 26) + ord(ch) - self.BigA
-			return acc
-		except Exception as e:
-			# print("name2col", e)
-			pass
+		if isinstance(columnValue, str) and columnValue.isalpha():
+			return excel_store.name2col(columnValue)
 		return columnValue
 
 
@@ -166,6 +342,7 @@ class ExcelHandler(xml.sax.ContentHandler):
 
 		self.row = 0
 		self.col = 0
+		self.cells = 0
 
 	def startElement(self, name, attrs):
 		# print("startElement '" + name + "'")
@@ -173,9 +350,11 @@ class ExcelHandler(xml.sax.ContentHandler):
 		if self.ok:
 			if name == 'Worksheet':
 				self.worksheet = attrs['ss:Name']
-				print("Worksheet: " + self.worksheet)
+				excel_stats.trace('worksheet', name=self.worksheet)
 			elif name == 'NamedRange':
-				self.wb.addNamedRange(attrs['ss:Name'], attrs['ss:RefersTo'])
+				# the Names under a Worksheet are local to it
+				self.wb.addNamedRange(attrs['ss:Name'], attrs['ss:RefersTo'],
+					self.worksheet if 'Worksheet' in self.state else None)
 				# self.xlData["namedRanges"].append({'name':attrs['ss:Name'], 'refersto':attrs['ss:RefersTo']})
 
 			# a table marks the start of the worksheet's data  (rows and cells)
@@ -192,6 +371,7 @@ class ExcelHandler(xml.sax.ContentHandler):
 
 			# a cell is a holder of data and other goodies
 			elif name == 'Cell' and 'Row' in self.state:
+				self.cells += 1
 				if 'ss:Index' in attrs:
 					self.col = int(attrs['ss:Index'])
 				else:
@@ -221,9 +401,11 @@ class ExcelHandler(xml.sax.ContentHandler):
 			stateName = self.state.pop()
 			if name != stateName:
 				print("ERROR: popping '" + stateName + "' but closing element '" + name + "'")
-			if name == 'Worksheet':
-				print('Worksheet closing: ' + self.worksheet)
 
+	def endDocument(self):
+		stats = excel_stats.current
+		if stats is not None:
+			stats.count('cellsLoaded', self.cells)
 
 	def characters(self, content):
 		if 'Data' == self.state[-1]:
@@ -238,160 +420,306 @@ class ExcelHandler(xml.sax.ContentHandler):
 		return self.wb
 
 
-def fetchCell(cell):
-	example_string = cell.getFormula()
-	if example_string:
-		# Tokenize
-		# excel_lang.lexer.input(example_string)
-		# while True:
-		#     tok = excel_lang.lexer.token()
-		#     if not tok: break      # No more input
-		#     print(tok)
-
-		t = excel_lang.yacc.parse(example_string)
-		if t[0] == 'FORMULA':
-			cell.parsed = t[1]
-			expanded = expand(t[1], cell)
-			return expanded
-		else:
-			raise Exception("a formula must start with 'FORMULA', either the parser failed of it's an invalid cell")
+class FastExcelLoader():
+	'''Streams an Excel 2003 XML workbook straight into the worksheet stores.
 
-	else:
-		data = cell.getData()
-		varName = cell.getVar()
-		if not varName in declaredVars:
-			print("CODE:", data['datatype'], cell.getVar(), '=', data['content'], ";")
-			declaredVars.append(varName)
-		return data
-
-
-def expand(tree, cell):
-	'''start to drill down into the formula. This is one large part of the 
-	guts of the parser, taking elements and expanding their references and
-	then parsing and expanding them, until we reach cells that do not need
-	any further expansion...'''
-	print('Expanding: ', cell.getAddress(), tree)
-	for t in tree:
-		if t[0] == 'FUNC':
-			if t[1] == 'IF':
-				callStack.append(t[1])
-				if len(t[2]) != 3:
-					errorMssg = "IF function requires exactly 3 arguments, " + str(len(t[2])) + " given"
-					raise Exception(errorMssg)
-				return expand(t[2], cell)
-
-			if t[1] == 'IFERROR':
-				callStack.append(t[1])
-				if len(t[2]) != 2:
-					errorMssg = "IFERROR function requires exactly 2 arguments, " + str(len(t[2])) + " given"
-					raise Exception(errorMssg)
-				return expand(t[2], cell)
-
-			if t[1] == 'MAX':
-				varss = expand(t[2], cell) # varss will return a list of cells
-				celss = []
-				for ci in range(len(varss)):
-					celss.append( fetchCell(varss[ci]) )
-				for ci in range(len(varss)):
-					if ci == 0:
-						print("CODE: tempMax = ", varss[ci].getVar(), ";")
-					else:
-						print("CODE: if (", varss[ci].getVar(), " > tempMax ) { tempMax =", varss[ci].getVar(), "; }")
-				return 'tempMax'
+	This is the fast path of ExcelHandler, driving expat directly. The element
+	state is kept as a handful of flags rather than a stack that has to be
+	searched, character data is joined once per Data element and cells are
+	written to their SheetStore by row and column, without building an
+	ExcelCell for each event. getStats() reports how long the load took.'''
 
+	def __init__(self):
+		self.wb = ExcelWB()
+		self.store = None
+		self.worksheet = None
+		self.row = 0
+		self.col = 0
+		self.inTable = False
+		self.inCell = False
+		self.inData = False
+		self.slot = None
+		self.datatype = None
+		self.text = []
+		self.cells = 0
+		self.stats = {}
+
+	def load(self, sourceFileName, spans=None, encoding=None, wrap=False):
+		'''Loads the whole file, or only the (start, end) byte spans of it given,
+		parsed as one document. With wrap the spans are parsed inside a bare
+		Workbook element, for spans holding worksheets and nothing else.'''
+		parser = xml.parsers.expat.ParserCreate(encoding)
+		parser.buffer_text = True
+		parser.buffer_size = 1 << 20
+		parser.StartElementHandler = self.startElement
+		parser.EndElementHandler = self.endElement
+		parser.CharacterDataHandler = self.characters
+
+		start = time.perf_counter()
+		with open(sourceFileName, 'rb') as source:
+			if spans is None:
+				parser.ParseFile(source)
 			else:
-				print("ERROR: "+t[1]+" function not written yet!")
-				sys.exit(500)
-		else:
-			if t[0] == 'RELCELLRANGE':
-				print("fetch data from range", cell.calcOffset(t[1]), cell.calcOffset(t[2]))
-				rangeData = []
-				fromCellRowOff	= t[1][0]
-				fromCellColOff	= t[1][1]
-				toCellRowOff 	= t[2][0]
-				toCellColOff 	= t[2][1]
-				# print(str(fromCellRowOff), str(fromCellColOff), str(toCellRowOff), str(toCellColOff))
-				for r in range(fromCellRowOff, int(toCellRowOff)+1):
-					for c in range(fromCellColOff, toCellColOff+1):
-						# print("fetch data from", cell.calcOffset( (r, c) ))
-						rangeData.append(xlWB.getCell(cell.calcOffset( (r, c) ) ) )
-				return rangeData
-
-			elif t[0] == 'BINOP':
-				args = expand(t[2], cell)
-				print("binop", t[1], args)
-
-			elif t[0] == 'RELCELL':
-				# print("fetch data from cell", cell.calcOffset(t[1]))
-				return fetchCell(xlWB.getCell(cell.calcOffset(t[1])))
-
-			elif t[0] == 'NAME':
-				# first check if this is a named cell reference
-				namedCell = xlWB.getNamedCell(None, t[1])
-				if namedCell:
-					print("we have a named cell, so expand it..")
-					fetchCell(namedCell)
-				cell = xlWB.getCell(cell.calcOffset(t[1]))
-				print("CODE: ", cell.getVar(), "=", cell.getData())
-				return fetchCell()
-
-			elif t[0] == 'NUMBER':
-				print("We have a NUMBER value!!", t[1])
-				return t
-
-			elif t[0] == 'STRING':
-				print("We have a value!!", t[1])
-				return t
-
-			elif t[0] == 'SUBEXP':
-				print("Expanding sub expression")
-				ev = expand(t[1], cell)
-				return ev
+				if wrap:
+					parser.Parse(b'<Workbook>', False)
+				for begin, end in spans:
+					source.seek(begin)
+					remaining = end - begin
+					while remaining > 0:
+						block = source.read(min(remaining, 1 << 20))
+						if not block:
+							break
+						remaining -= len(block)
+						parser.Parse(block, False)
+				parser.Parse(b'</Workbook>' if wrap else b'', True)
+		seconds = time.perf_counter() - start
+
+		self.wb.setFileName(sourceFileName)
+		stats = excel_stats.current
+		if stats is not None:
+			stats.count('cellsLoaded', self.cells)
+			stats.addTime('load', seconds)
+			excel_stats.trace('load', fileName=sourceFileName, cells=self.cells, seconds=seconds)
+		self.stats = {
+			'cells': self.cells,
+			'seconds': seconds,
+			'cellsPerSecond': self.cells / seconds if seconds > 0 else 0.0,
+			'peakMemory': peakMemory(),
+		}
+		return self.wb
 
-			else:
-				print("ERROR: type", t, "not supported yet!")
-				sys.exit(500)
+	def startElement(self, name, attrs):
+		# the elements are tested in order of how often they turn up
+		if name == 'Cell':
+			if not self.inTable:
+				return
+			self.inCell = True
+			index = attrs.get('ss:Index')
+			self.col = int(index) if index else self.col + 1
+			self.cells += 1
+			self.slot = None    # only cells holding a formula or data get a slot
+			formula = attrs.get('ss:Formula')
+			if formula:
+				self.slot = self.store.addSlot(self.row, self.col-1)
+				self.store.setFormula(self.slot, formula)
+
+		elif name == 'Data':
+			if not self.inCell:
+				return
+			self.inData = True
+			if self.slot is None:
+				self.slot = self.store.addSlot(self.row, self.col-1)
+			self.datatype = attrs.get('ss:Type')
+			if self.datatype:
+				self.store.setDataType(self.slot, self.datatype)
+
+		elif name == 'Row':
+			if not self.inTable:
+				return
+			self.col = 0
+			index = attrs.get('ss:Index')
+			self.row = int(index) if index else self.row + 1
+
+		elif name == 'Table':
+			self.inTable = True
+			self.row = 0
+
+		elif name == 'Worksheet':
+			self.worksheet = attrs['ss:Name']
+			self.store = self.wb.getSheet(self.worksheet)
+			excel_stats.trace('worksheet', name=self.worksheet)
+
+		elif name == 'NamedRange':
+			# the Names under a Worksheet are local to it
+			self.wb.addNamedRange(attrs['ss:Name'], attrs['ss:RefersTo'], self.worksheet)
+
+		elif name == 'NamedCell' and self.inCell:
+			if not 'ss:Name' in attrs:
+				raise Exception("A named cell element found without an ss:Name attribute in " + self.worksheet)
+			self.wb.setNamedCell(attrs['ss:Name'], ExcelCell(self.worksheet, self.col-1, self.row, None))
+
+	def endElement(self, name):
+		if name == 'Data':
+			if self.inData:
+				self.inData = False
+				if self.text:
+					self.store.setContent(self.slot, ''.join(self.text), self.datatype)
+					self.text = []
+		elif name == 'Cell':
+			self.inCell = False
+		elif name == 'Table':
+			self.inTable = False
+		elif name == 'Worksheet':
+			self.worksheet = None
 
+	def characters(self, content):
+		if self.inData:
+			self.text.append(content)
 
-def main(sourceFileName, refresh=False):
+	def getWorkbook(self):
+		return self.wb
 
-	global callStack, xlWB, declaredVars
+	def getStats(self):
+		return self.stats
 
-	declaredVars = []
 
+def peakMemory():
+	'''The peak resident memory of this process in bytes, or None where the
+	resource module is not available.'''
 	try:
-		# if we are refreshing, raise an exception immediately
-		if refresh:
-			raise Exception("Refresh file")
-		xlpickle = open("xlstruct.pkl", "r+b")
-		U = pickle.Unpickler(xlpickle)
-		xlWB = U.load()
-		# finally check the name of the WB
-		if xlWB.getFileName() != sourceFileName:
-			raise Exception("Different file in pickle jar, must rerun parser")
-
-	except:
-		xlpickle = open("xlstruct.pkl", "w+b")
-		source = open(sourceFileName, 'r', encoding='utf-8')
-		handler = ExcelHandler()
-		xml.sax.parse(source, handler)
-
-		xlWB = handler.getWorkbook()
-		xlWB.setFileName(sourceFileName)
-		P = pickle.Pickler(xlpickle)
-		P.dump(xlWB)
+		import resource
+	except ImportError:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# linux reports kilobytes, macOS reports bytes
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def loadWorkbook(sourceFileName, workers=1):
+	'''Loads a workbook through the fast path, returning the ExcelWB. With more
+	than one worker (None for one per core) the worksheets are loaded in
+	parallel, see loadWorkbookParallel. An .xlsx workbook is read from its
+	zip package, see excel_xlsx.'''
+	if excel_xlsx.isXlsx(sourceFileName):
+		return excel_xlsx.loadWorkbook(sourceFileName)
+	if workers != 1:
+		return loadWorkbookParallel(sourceFileName, workers)
+	return FastExcelLoader().load(sourceFileName)
+
+
+def findWorksheets(sourceFileName):
+	'''The (start, end) byte offsets of every Worksheet element of a file, end
+	being just past its closing tag. The raw bytes are searched, which is safe
+	as a '<' can only turn up in the text of the XML escaped.'''
+	spans = []
+	with open(sourceFileName, 'rb') as f:
+		if os.fstat(f.fileno()).st_size == 0:
+			return spans
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as source:
+			pos = 0
+			while True:
+				start = source.find(b'<Worksheet', pos)
+				if start < 0:
+					break
+				pos = start + len(b'<Worksheet')
+				if source[pos:pos+1] not in (b' ', b'>', b'\t', b'\r', b'\n'):
+					continue    # some other element, WorksheetOptions say
+				end = source.find(b'</Worksheet>', pos)
+				if end < 0:
+					raise Exception("The worksheet starting at byte " + str(start) + " of " + sourceFileName + " is never closed")
+				pos = end + len(b'</Worksheet>')
+				spans.append((start, pos))
+	return spans
+
+
+def xmlEncoding(sourceFileName):
+	'''The encoding named in the XML declaration of a file, if any.'''
+	with open(sourceFileName, 'rb') as f:
+		head = f.read(200)
+	found = re.match(rb'<\?xml[^>]*encoding=["\']([A-Za-z0-9._-]+)["\']', head)
+	return found.group(1).decode('ascii') if found else None
+
+
+def loadWorksheets(sourceFileName, start, end, encoding=None):
+	'''Loads the worksheets in one byte span of a file, in a worker process.
+	The result is made of plain values and NumPy arrays so that it pickles
+	cheaply, see mergeWorksheets.'''
+	loader = FastExcelLoader()
+	wb = loader.load(sourceFileName, [(start, end)], encoding, wrap=True)
+	data = wb.getData()
+	return {
+		'sheets': [(name, store.sortedArrays()) for name, store in data['worksheets'].items()],
+		'tables': dict((table, data[table].getValues()) for table in ('datatypes', 'strings', 'formulas')),
+		'namedCells': data['namedCells'],
+		'namedRanges': data['namedRanges'],
+		'cells': loader.cells,
+	}
+
+
+def mergeWorksheets(wb, part):
+	'''Adds the worksheets loaded by loadWorksheets to a workbook. The ids of
+	the worker's intern tables are mapped onto the workbook's, and the sorted
+	arrays become read only stores like those of a cached workbook.'''
+	data = wb.getData()
+	remaps = {}
+	for table, values in part['tables'].items():
+		remaps[table] = np.array([data[table].intern(v) for v in values] or [0], dtype=np.int64)
+	for name, arrays in part['sheets']:
+		arrays = dict(arrays)
+		# strings and formulas keep -1 for not set, datatypes are stored as id + 1
+		for field in ('strings', 'formulas'):
+			ids = arrays[field]
+			arrays[field] = np.where(ids >= 0, remaps[field][np.maximum(ids, 0)], -1).astype(ids.dtype)
+		ids = arrays['datatypes']
+		arrays['datatypes'] = np.where(ids > 0, remaps['datatypes'][np.maximum(ids - 1, 0)] + 1, 0).astype(ids.dtype)
+		buffers = dict((field, memoryview(np.ascontiguousarray(arrays[field])).cast('B').cast(excel_store.TYPECODES[field]))
+			for field in excel_store.ARRAYFIELDS)
+		data['worksheets'][name] = excel_store.SheetStore.fromBuffers(name,
+			data['datatypes'], data['strings'], data['formulas'], buffers)
+	for name, refs in part['namedCells'].items():
+		data['namedCells'].setdefault(name, []).extend(refs)
+		for sheet, col, row in refs:
+			col = excel_store.name2col(col)
+			wb.indexName(name, (sheet, int(row), col, int(row), col))
+	for namedRange in part['namedRanges']:
+		wb.addNamedRange(namedRange['name'], namedRange['refersto'], namedRange.get('sheet'))
+	stats = excel_stats.current
+	if stats is not None:
+		stats.count('cellsLoaded', part['cells'])
+		for name, arrays in part['sheets']:
+			excel_stats.trace('worksheet', name=name)
+
+
+def loadWorkbookParallel(sourceFileName, workers=None):
+	'''Loads the worksheets of a workbook in a pool of worker processes, one
+	worksheet per task, and merges them into one ExcelWB. The workbook level
+	parts of the file (the Names) are loaded here while the workers run. A
+	file with a single worksheet is just loaded in this process.'''
+	spans = findWorksheets(sourceFileName)
+	if len(spans) < 2 or workers == 1:
+		return FastExcelLoader().load(sourceFileName)
+
+	encoding = xmlEncoding(sourceFileName)
+	workers = min(workers or os.cpu_count() or 1, len(spans))
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+		# the biggest worksheets go first, so that no worker is left with one at the end
+		bySize = sorted(spans, key=lambda span: span[0] - span[1])
+		futures = dict((span, pool.submit(loadWorksheets, sourceFileName, span[0], span[1], encoding)) for span in bySize)
+		wb = FastExcelLoader().load(sourceFileName, [(0, spans[0][0]), (spans[-1][1], os.path.getsize(sourceFileName))], encoding)
+		# merged in the order of the file, so the worksheets keep their order,
+		# the time waiting on the workers counting as loading
+		with excel_stats.phase('load'):
+			for span in spans:
+				mergeWorksheets(wb, futures[span].result())
+
+	return wb
+
+
+def main(sourceFileName, refresh=False, workers=1):
+
+	global xlWB
+
+	# the cache is only reused while it matches the source file
+	xlWB = excel_cache.openWorkbook(sourceFileName, refresh=refresh, workers=workers)
 
 	# example_string = xlWB.getCell('PegTop', 'ES', '252', 'formula')
 	cell = xlWB.getNamedCell(None, 'YResult')
 	# example_string = "=IF(R[-277]C>R[-305]C-2*R[-303]C,'-',0.58*R[-319]C*PI()*R[-277]C*R[-303]C*R[-3]C/R[-404]C/1000)"
-	
-	callStack = []
 
-	cell = xlWB.getCell(("Sheet1", "2", "D"))
-	comp = fetchCell(cell)
+	# only the cone of the output is read, parsed and compiled, once, then
+	# the kernel can be called for any number of scenarios
+	outputs = [("Sheet1", "2", "D")]
+	graph = excel_graph.CellGraph(xlWB, outputs)
+	print(len(graph), "of", sum(len(store) for store in xlWB.getData()["worksheets"].values()), "cells in the cone of", outputs)
+	kernel = excel_codegen.compileKernel(xlWB, outputs, [("Sheet1", "2", "B")], graph)
+	print(kernel.source)
+	print(kernel.cudaSource())
+	comp = kernel([float(b) for b in range(11)])
 	print(comp)
 
 
 if __name__ == '__main__':
-	# main('design_check.xml')
-	main('stage2.xml', refresh=True)
+	# the command line is the sweep driver, e.g.
+	#   python excel_parse.py stage2.xml --input Sheet1!B2=0:10:1 --output Sheet1!D2
+	import excel_sweep
+	excel_sweep.main()
@@ -0,0 +1,194 @@
+import concurrent.futures
+import os
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+import excel_cache
+import excel_codegen
+import excel_graph
+import excel_grid
+import excel_stats
+
+
+'''
+Evaluates the outputs of a workbook over the scenarios with a pool of
+worker processes, each taking a shard of the scenario axis.
+
+Every worker opens the workbook from its cache (memory mapped, so the pages
+are shared between them), builds the cone of the outputs and compiles it
+into a kernel once, when the pool starts, and then uses that kernel for every
+shard it is given. The input and output arrays live in shared memory blocks,
+a row per input and per output, that the workers attach to by name; a task
+is only the names of the blocks and the range of scenarios to work out, so
+no array is ever pickled. The blocks are kept between calls and only grown.
+
+A ShardPool is called like a CompiledKernel, so it can stand in for one, in
+excel_stream.streamKernel for instance.
+
+	with excel_shard.ShardPool('design.xml', ['YResult'], ['Sheet1!B2'], workers=64) as pool:
+		yResult, = pool.call({'Sheet1!B2': np.linspace(0, 10, 10000000)})
+
+Inputs must be numbers. The outputs come back as floats, text becoming NaN
+as in excel_stream.NpyWriter.
+'''
+
+# the fewest scenarios worth sending to a worker as a shard of their own
+MINSHARD = 4096
+
+# the worker's kernel and the blocks it is attached to, set up by startWorker
+worker = None
+
+
+class ShardPool():
+
+	def __init__(self, fileName, outputs, inputs, workers=None, cacheDir=excel_cache.CACHEDIR, shardsPerWorker=4, refresh=False):
+		'''Starts worker processes (one per core by default) evaluating the
+		outputs of the workbook in fileName, an Excel 2003 XML or .xlsx file,
+		with the inputs bound. The scenarios of a call are cut into up to
+		shardsPerWorker shards per worker, so that a slow worker holds the
+		others up less.'''
+		# the cache is written here, once, so that every worker just maps it
+		excel_cache.openWorkbook(fileName, refresh, cacheDir)
+		self.outputs = list(outputs)
+		self.inputs = list(inputs)
+		self.workers = workers or os.cpu_count() or 1
+		self.shardsPerWorker = shardsPerWorker
+		self.capacity = 0
+		self.inBlock = None
+		self.outBlock = None
+		# started before the workers, so that they share it rather than each
+		# starting a tracker of its own, see attach
+		resource_tracker.ensure_running()
+		self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=startWorker,
+			initargs=(fileName, self.outputs, self.inputs, cacheDir))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+		return False
+
+	def __call__(self, *args):
+		if len(args) != len(self.inputs):
+			raise Exception("kernel takes " + str(len(self.inputs)) + " inputs, " + str(len(args)) + " given")
+		return self.call(dict(zip(self.inputs, args)))
+
+	def call(self, inputs):
+		'''Evaluates the outputs for a dict of input arrays (or scalars), keyed
+		like the inputs the pool was started with, returning a tuple with an
+		array per output.'''
+		values = [np.asarray(inputs[ref]) for ref in self.inputs]
+		for ref, value in zip(self.inputs, values):
+			if value.ndim > 1 or value.dtype.kind not in 'fiub':
+				raise Exception("input " + str(ref) + " must be a 1-d array of numbers to be sharded")
+		n = max([np.size(v) for v in values] or [1])
+		self.reserve(n)
+		inArray, outArray = self.arrays()
+		for row, value in zip(inArray, values):
+			row[:n] = value
+
+		with excel_stats.phase('evaluate'):
+			futures = [self.pool.submit(evaluateShard, self.inBlock.name, self.outBlock.name, self.capacity, start, end)
+				for start, end in shards(n, self.workers * self.shardsPerWorker)]
+			for future in futures:
+				future.result()
+		stats = excel_stats.current
+		if stats is not None:
+			stats.count('shards', len(futures))
+		# copied out, as the blocks are written over by the next call
+		return tuple(row[:n].copy() for row in outArray)
+
+	def coneSize(self):
+		'''The number of cells the workers' kernel works with, see
+		CompiledKernel.coneSize.'''
+		return self.pool.submit(workerConeSize).result()
+
+	def reserve(self, n):
+		'''Makes sure the shared blocks hold at least n scenarios.'''
+		if n <= self.capacity:
+			return
+		self.release()
+		self.capacity = max(n, 2 * self.capacity)
+		self.inBlock = shared_memory.SharedMemory(create=True, size=max(1, 8 * len(self.inputs) * self.capacity))
+		self.outBlock = shared_memory.SharedMemory(create=True, size=max(1, 8 * len(self.outputs) * self.capacity))
+
+	def arrays(self):
+		return (blockArray(self.inBlock, len(self.inputs), self.capacity),
+			blockArray(self.outBlock, len(self.outputs), self.capacity))
+
+	def release(self):
+		for block in (self.inBlock, self.outBlock):
+			if block is not None:
+				block.close()
+				block.unlink()
+		self.inBlock = self.outBlock = None
+		self.capacity = 0
+
+	def close(self):
+		self.pool.shutdown()
+		self.release()
+
+
+def shards(n, most):
+	'''Cuts n scenarios into at most most (start, end) shards, none smaller
+	than MINSHARD unless there is only the one.'''
+	count = max(1, min(most, n // MINSHARD))
+	bounds = np.linspace(0, n, count + 1).astype(np.int64)
+	return [(int(bounds[i]), int(bounds[i + 1])) for i in range(count) if bounds[i + 1] > bounds[i]]
+
+
+def blockArray(block, rows, capacity):
+	return np.ndarray((rows, capacity), dtype=float, buffer=block.buf)
+
+
+def attach(name):
+	'''Attaches to a shared memory block made by the pool, which alone unlinks
+	it. The workers are children of the pool's process and share its resource
+	tracker, started before them, so the block being registered again as it is
+	attached is harmless; a tracker of the worker's own would unlink the block
+	when the worker exits.'''
+	return shared_memory.SharedMemory(name=name)
+
+
+def startWorker(fileName, outputs, inputs, cacheDir):
+	'''Run once in each worker as the pool starts, compiling the kernel every
+	shard is evaluated with.'''
+	global worker
+	wb = excel_cache.openWorkbook(fileName, cacheDir=cacheDir)
+	graph = excel_graph.CellGraph(wb, outputs)
+	worker = {
+		'kernel': excel_codegen.compileKernel(wb, outputs, inputs, graph),
+		'names': None,
+		'blocks': [],
+		'arrays': None,
+	}
+
+
+def workerConeSize():
+	return worker['kernel'].coneSize()
+
+
+def workerArrays(inName, outName, capacity):
+	'''The worker's views of the shared input and output blocks, attached the
+	first time they are seen. Blocks the pool has since replaced are let go.'''
+	if worker['names'] != (inName, outName):
+		worker['arrays'] = None
+		for block in worker['blocks']:
+			block.close()
+		kernel = worker['kernel']
+		worker['blocks'] = [attach(inName), attach(outName)]
+		worker['arrays'] = (blockArray(worker['blocks'][0], len(kernel.inputs), capacity),
+			blockArray(worker['blocks'][1], len(kernel.outputs), capacity))
+		worker['names'] = (inName, outName)
+	return worker['arrays']
+
+
+def evaluateShard(inName, outName, capacity, start, end):
+	'''Evaluates scenarios start to end, reading the inputs from and writing the
+	outputs to the shared blocks.'''
+	kernel = worker['kernel']
+	inArray, outArray = workerArrays(inName, outName, capacity)
+	results = kernel.call(dict((ref, inArray[i, start:end]) for i, ref in enumerate(kernel.inputs)))
+	for i, result in enumerate(results):
+		outArray[i, start:end] = excel_grid.asNumber(result)
+	return end - start
@@ -0,0 +1,137 @@
+import threading
+import time
+
+
+'''
+Instrumentation of loading, parsing and evaluating workbooks.
+
+It is off unless switched on with enable(), and while it is off current is
+None and the instrumented code does nothing more than check for that. Once
+on, current is a Stats collecting
+	counters     cellsLoaded, getCell, parseHits, parseMisses, graphNodes,
+	             nodesEvaluated, kernelsCompiled, cacheHits, cacheMisses
+	maxima       expansionDepth, the deepest chain of precedents followed
+	             while ordering a cone
+	seconds      the time spent in each phase, load, parse, graph, evaluate,
+	             compile, cacheLoad and cacheWrite, added up over calls (and
+	             over threads, for a WavefrontEvaluator)
+and passing events to its trace hook, if it has one, as trace(event, info)
+with info a dict. The events are 'load' and 'worksheet' from the loaders,
+'cache' and 'evaluate', the latter once per formula node evaluated.
+
+	stats = excel_stats.enable()
+	...
+	print(excel_stats.disable().report())
+'''
+
+current = None      # the Stats being collected, None while instrumentation is off
+
+# counters turned into rates by report(), (counter, phase, rate)
+RATES = (
+	('cellsLoaded', 'load', 'cellsPerSecond'),
+	('nodesEvaluated', 'evaluate', 'nodesPerSecond'),
+	('scenariosStreamed', 'stream', 'scenariosPerSecond'),
+)
+
+
+class Stats():
+
+	def __init__(self, trace=None):
+		self.counters = {}
+		self.maxima = {}
+		self.seconds = {}
+		self.trace = trace
+		self.lock = threading.Lock()
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def maximum(self, name, value):
+		with self.lock:
+			if value > self.maxima.get(name, 0):
+				self.maxima[name] = value
+
+	def addTime(self, phase, seconds):
+		with self.lock:
+			self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+
+	def phase(self, phase):
+		return Phase(self, phase)
+
+	def report(self):
+		'''Everything collected as a plain dict, with the RATES worked out.'''
+		rates = {}
+		for counter, phase, rate in RATES:
+			if self.seconds.get(phase) and counter in self.counters:
+				rates[rate] = self.counters[counter] / self.seconds[phase]
+		return {
+			'counters': dict(self.counters),
+			'maxima': dict(self.maxima),
+			'seconds': dict(self.seconds),
+			'rates': rates,
+		}
+
+
+class Phase():
+	'''Times a with block into a phase of a Stats.'''
+
+	__slots__ = ('stats', 'phase', 'start')
+
+	def __init__(self, stats, phase):
+		self.stats = stats
+		self.phase = phase
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		self.stats.addTime(self.phase, time.perf_counter() - self.start)
+		return False
+
+
+class NoPhase():
+	'''The phase timer while instrumentation is off, it does nothing.'''
+
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+
+NOPHASE = NoPhase()
+
+
+def enable(trace=None):
+	'''Starts collecting into a new Stats, which is returned. trace, if given,
+	is called with every event.'''
+	global current
+	current = Stats(trace)
+	return current
+
+
+def disable():
+	'''Stops collecting, returning the Stats collected, or None.'''
+	global current
+	stats = current
+	current = None
+	return stats
+
+
+def phase(name):
+	'''A timer for a with block, adding to the named phase while instrumentation
+	is on and doing nothing otherwise.'''
+	stats = current
+	return stats.phase(name) if stats is not None else NOPHASE
+
+
+def trace(event, **info):
+	'''Passes an event to the trace hook, if instrumentation is on and has one.
+	Hot loops should check current.trace themselves rather than call this.'''
+	stats = current
+	if stats is not None and stats.trace is not None:
+		stats.trace(event, info)
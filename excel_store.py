@@ -0,0 +1,289 @@
+import array
+import bisect
+import functools
+import math
+import numpy as np
+
+
+'''
+Compact storage for the cells of a workbook.
+
+Each worksheet keeps its cells as parallel arrays, one slot per cell, with
+integer row and column indices. Numeric content lives in a float64 array and
+everything that repeats (datatypes, text and formulas) is interned once per
+workbook and referred to by id, so a filled down column of formulas costs a
+few bytes per cell rather than a dict per cell.
+'''
+
+COLBITS = 16        # excel has at most 16384 columns
+
+# the per cell arrays of a SheetStore and their array typecodes
+TYPECODES = {
+	'keys': 'q',
+	'rows': 'i',
+	'cols': 'i',
+	'datatypes': 'h',
+	'values': 'd',
+	'strings': 'i',
+	'formulas': 'i',
+}
+ARRAYFIELDS = tuple(TYPECODES)
+
+
+@functools.lru_cache(maxsize=None)
+def col2Name(col):
+	'''Converts a 0-based integer column to its Excel Alpha based name, 0 -> A,
+	25 -> Z, 26 -> AA.'''
+	col = int(col) + 1
+	name = ""
+	while col > 0:
+		col, rem = divmod(col - 1, 26)
+		name = chr(ord('A') + rem) + name
+	return name
+
+
+@functools.lru_cache(maxsize=None)
+def name2col(name):
+	'''Converts an Excel Alpha based column name to a 0-based integer.'''
+	acc = 0
+	for ch in name:
+		acc = (acc * 26) + ord(ch) - ord('A') + 1
+	return acc - 1
+
+
+class InternTable():
+	'''Hands out a small integer id for each distinct value. A table read back
+	from a cache is only decoded, by its loader, the first time it is used.'''
+
+	def __init__(self, loader=None):
+		self.loader = loader
+		self.values = []
+		self.ids = None if loader else {}
+
+	def load(self):
+		if self.loader:
+			self.values = self.loader()
+			self.loader = None
+
+	def intern(self, value):
+		if self.ids is None:
+			self.load()
+			self.ids = {v: i for i, v in enumerate(self.values)}
+		id = self.ids.get(value)
+		if id is None:
+			id = len(self.values)
+			self.ids[value] = id
+			self.values.append(value)
+		return id
+
+	def lookup(self, id):
+		if self.loader:
+			self.load()
+		return self.values[id]
+
+	def getValues(self):
+		self.load()
+		return self.values
+
+	def __len__(self):
+		self.load()
+		return len(self.values)
+
+
+class SheetStore():
+	'''The cells of one worksheet, as parallel arrays indexed by slot.'''
+
+	def __init__(self, name, datatypes, strings, formulas):
+		self.name = name
+		self.datatypeTable = datatypes      # the workbook wide intern tables
+		self.stringTable = strings
+		self.formulaTable = formulas
+		self.index = {}                     # (row << COLBITS | col) -> slot
+		self.keys = None                    # sorted keys when mapped from a cache
+		self.rows = array.array('i')
+		self.cols = array.array('i')
+		self.datatypes = array.array('h')   # datatype id + 1, 0 if not set
+		self.values = array.array('d')      # numeric content, NaN otherwise
+		self.strings = array.array('i')     # text content id, -1 if not set
+		self.formulas = array.array('i')    # formula id, -1 if not set
+		self.sorted = None                  # see sortedKeys
+
+	@classmethod
+	def fromBuffers(cls, name, datatypes, strings, formulas, arrays):
+		'''A read only store over arrays that already exist, such as memoryviews
+		of a memory mapped cache file. The slots must be sorted by their key so
+		that cells can be found by a binary search instead of a dict.'''
+		store = cls(name, datatypes, strings, formulas)
+		store.index = None
+		for field in ARRAYFIELDS:
+			setattr(store, field, arrays[field])
+		return store
+
+	def thaw(self):
+		'''Copies a mapped store into arrays of its own, so that it can be changed.'''
+		for field in ARRAYFIELDS:
+			if field != 'keys':
+				setattr(self, field, array.array(TYPECODES[field], getattr(self, field)))
+		self.index = dict((key, slot) for slot, key in enumerate(self.keys))
+		self.keys = None
+
+	def __len__(self):
+		return len(self.rows)
+
+	def findSlot(self, row, col):
+		'''The slot of the cell at the 1-based row and 0-based col, or None.'''
+		key = (row << COLBITS) | col
+		if self.index is not None:
+			return self.index.get(key)
+		slot = bisect.bisect_left(self.keys, key)
+		if slot < len(self.keys) and self.keys[slot] == key:
+			return slot
+		return None
+
+	def addSlot(self, row, col):
+		if self.index is None:
+			self.thaw()
+		key = (row << COLBITS) | col
+		slot = self.index.get(key)
+		if slot is None:
+			self.sorted = None
+			slot = len(self.rows)
+			self.index[key] = slot
+			self.rows.append(row)
+			self.cols.append(col)
+			self.datatypes.append(0)
+			self.values.append(math.nan)
+			self.strings.append(-1)
+			self.formulas.append(-1)
+		return slot
+
+	def sortedArrays(self):
+		'''Every per cell array as a NumPy array, the slots sorted by key, which
+		is the layout fromBuffers expects.'''
+		if self.keys is not None:
+			keys = np.frombuffer(self.keys, dtype=np.int64)
+		else:
+			rows = np.frombuffer(self.rows, dtype=np.int32).astype(np.int64)
+			keys = (rows << COLBITS) | np.frombuffer(self.cols, dtype=np.int32)
+		order = np.argsort(keys, kind='stable')
+		arrays = {'keys': keys[order]}
+		for field in ARRAYFIELDS:
+			if field != 'keys':
+				arrays[field] = np.frombuffer(getattr(self, field), dtype=np.dtype(TYPECODES[field]))[order]
+		return arrays
+
+	def getKeys(self):
+		'''The key of every slot, row << COLBITS | col.'''
+		if self.keys is not None:
+			return self.keys
+		return array.array('q', ((r << COLBITS) | c for r, c in zip(self.rows, self.cols)))
+
+	def setField(self, row, col, field, value, replace=False):
+		'''Sets a field of a cell. The first value set is kept, like the dict based
+		store always did, unless replace is True.'''
+		slot = self.addSlot(row, col)
+		if field == 'formula':
+			self.setFormula(slot, value, replace)
+		elif field == 'datatype':
+			self.setDataType(slot, value, replace)
+		elif field == 'content':
+			self.setContent(slot, value, replace=replace)
+		else:
+			raise Exception("Unknown cell field '" + field + "'")
+
+	# the set methods below work on a slot directly, for the bulk loaders
+
+	def setFormula(self, slot, formula, replace=False):
+		if replace or self.formulas[slot] < 0:
+			self.formulas[slot] = self.formulaTable.intern(formula) if formula else -1
+
+	def setDataType(self, slot, datatype, replace=False):
+		if replace or not self.datatypes[slot]:
+			self.datatypes[slot] = self.datatypeTable.intern(datatype) + 1 if datatype else 0
+
+	def setContent(self, slot, content, datatype=None, replace=False):
+		if replace:
+			self.strings[slot] = -1
+			self.values[slot] = math.nan
+		elif self.strings[slot] >= 0 or not math.isnan(self.values[slot]):
+			return
+		if (datatype or self.getDataType(slot)) == 'Number':
+			try:
+				self.values[slot] = float(content)
+				return
+			except ValueError:
+				pass
+		self.strings[slot] = self.stringTable.intern(content)
+
+	def getDataType(self, slot):
+		id = self.datatypes[slot]
+		return self.datatypeTable.lookup(id - 1) if id else None
+
+	def getFormula(self, slot):
+		id = self.formulas[slot]
+		return self.formulaTable.lookup(id) if id >= 0 else None
+
+	def getContent(self, slot):
+		id = self.strings[slot]
+		if id >= 0:
+			return self.stringTable.lookup(id)
+		value = self.values[slot]
+		if not math.isnan(value):
+			# the shortest text that reads back as the same float, so a cell
+			# read on its own agrees with the same cell read in a block
+			text = repr(float(value))
+			return text[:-2] if text.endswith('.0') else text
+		return None
+
+	def getData(self, slot):
+		'''The fields of a cell as a dict, in the shape of the old nested store.'''
+		data = {}
+		for field, value in (('formula', self.getFormula(slot)),
+				('datatype', self.getDataType(slot)),
+				('content', self.getContent(slot))):
+			if value is not None:
+				data[field] = value
+		return data
+
+	def getSlots(self):
+		'''Yields (slot, row, col) for every cell, in the order they were added.'''
+		for slot in range(len(self.rows)):
+			yield slot, self.rows[slot], self.cols[slot]
+
+	def getBlock(self, row0, col0, row1, col1):
+		'''The numeric values of the rectangle from (row0, col0) to (row1, col1),
+		inclusive, as a 2-D float64 array with NaN where a cell holds no number,
+		and a bool array of the same shape marking the cells holding a formula.
+		Just the cells of the rectangle are gathered, found by a binary search
+		for where each of its rows starts and ends in the keys sorted, so the
+		cost follows the size of the block and not of the sheet.'''
+		keys, order = self.sortedKeys()
+		shape = (row1 - row0 + 1, col1 - col0 + 1)
+		blockValues = np.full(shape, np.nan)
+		blockFormulas = np.zeros(shape, dtype=bool)
+		rows = np.arange(row0, row1 + 1, dtype=np.int64) << COLBITS
+		starts = np.searchsorted(keys, rows | col0)
+		ends = np.searchsorted(keys, rows | col1, side='right')
+		counts = ends - starts
+		if counts.sum():
+			# where every row's run is in the sorted keys, one after the other
+			found = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+			slots = found if order is None else order[found]
+			r = np.repeat(np.arange(shape[0]), counts)
+			c = (keys[found] & ((1 << COLBITS) - 1)) - col0
+			blockValues[r, c] = np.frombuffer(self.values, dtype=np.float64)[slots]
+			blockFormulas[r, c] = np.frombuffer(self.formulas, dtype=np.int32)[slots] >= 0
+		return blockValues, blockFormulas
+
+	def sortedKeys(self):
+		'''The keys of the cells sorted, and the slot of each, None when the slots
+		are in key order already as they are in a mapped store. Sorted the first
+		time a block is asked for and again once cells have been added.'''
+		if self.keys is not None:
+			return np.frombuffer(self.keys, dtype=np.int64), None
+		if self.sorted is None:
+			rows = np.frombuffer(self.rows, dtype=np.int32).astype(np.int64)
+			keys = (rows << COLBITS) | np.frombuffer(self.cols, dtype=np.int32)
+			order = np.argsort(keys, kind='stable')
+			self.sorted = (keys[order], order)
+		return self.sorted
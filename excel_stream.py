@@ -0,0 +1,148 @@
+import numpy as np
+import excel_grid
+import excel_stats
+
+
+'''
+Evaluates a compiled kernel over a stream of scenarios in chunks of bounded
+size, so that the number of scenarios is limited by disk and not by memory.
+
+The scenarios come from any iterator of chunks, each a dict of input arrays
+keyed like the inputs of the kernel. A chunk longer than chunkSize is cut up,
+and every piece is copied into the same preallocated input buffers before the
+kernel is called on it. The kernel lets go of each intermediate array after
+its last read (see excel_codegen.releaseDead), so a call never holds more than
+chunkSize values for each cell still to be read, and the memory freed by one
+chunk is what the next one is worked out in. The results are written straight
+into a memory mapped .npy file by an NpyWriter, so peak memory stays the same
+however many scenarios there are.
+
+	kernel = excel_codegen.compileKernel(wb, ['YResult'], ['Sheet1!B2'])
+	chunks = ({'Sheet1!B2': rng.random(100000)} for i in range(1000))
+	results = excel_stream.evaluateToFile(kernel, chunks, 'results.npy')
+'''
+
+CHUNKSIZE = 65536
+
+# bytes kept for the header of a .npy file written before its length is known,
+# a multiple of 64 as the format asks
+HEADERSIZE = 128
+
+
+class NpyWriter():
+	'''Writes columns of results, a batch of rows at a time, into a .npy file
+	holding a 2-D float array with a column per name in columns. When the
+	number of rows is known up front the file is memory mapped and each batch
+	is written straight into it, otherwise the rows are appended and the
+	header filled in on close. Text is written as NaN, errors as the NaN or
+	inf they are carried as.'''
+
+	def __init__(self, fileName, columns, count=None):
+		self.fileName = fileName
+		self.columns = list(columns)
+		self.count = count
+		self.rows = 0
+		if count is not None:
+			self.array = np.lib.format.open_memmap(fileName, mode='w+', dtype=float, shape=(count, len(self.columns)))
+			self.file = None
+		else:
+			self.array = None
+			self.file = open(fileName, 'wb')
+			self.file.write(npyHeader(0, len(self.columns)))
+
+	def write(self, batch):
+		n = max(np.size(batch[c]) for c in self.columns) if self.columns else 0
+		if self.array is not None:
+			if self.rows + n > self.count:
+				raise Exception("more than the " + str(self.count) + " rows expected written to " + self.fileName)
+			rows = self.array[self.rows:self.rows + n]
+		else:
+			rows = np.empty((n, len(self.columns)))
+		for i, c in enumerate(self.columns):
+			rows[:, i] = excel_grid.asNumber(batch[c])
+		if self.file is not None:
+			self.file.write(rows.tobytes())
+		self.rows += n
+
+	def close(self):
+		if self.array is not None:
+			self.array.flush()
+			self.array = None
+		if self.file is not None:
+			self.file.seek(0)
+			self.file.write(npyHeader(self.rows, len(self.columns)))
+			self.file.close()
+			self.file = None
+
+	def open(self):
+		'''The results written, memory mapped read only.'''
+		return np.load(self.fileName, mmap_mode='r')
+
+
+def npyHeader(rows, width):
+	'''The header of a .npy file of rows x width floats, padded to HEADERSIZE
+	bytes so that it can be written again once the rows are counted.'''
+	header = "{'descr': %r, 'fortran_order': False, 'shape': (%d, %d), }" % (
+		np.lib.format.dtype_to_descr(np.dtype(float)), rows, width)
+	header = header.ljust(HEADERSIZE - 10 - 1) + "\n"
+	if len(header) + 10 != HEADERSIZE:
+		raise Exception("the .npy header of " + str(rows) + " rows does not fit in " + str(HEADERSIZE) + " bytes")
+	return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1')
+
+
+def pieces(chunk, chunkSize):
+	'''A chunk cut into pieces of at most chunkSize scenarios, as (length, chunk).'''
+	n = max([np.size(v) for v in chunk.values()] or [1])
+	if n <= chunkSize:
+		yield n, chunk
+		return
+	for start in range(0, n, chunkSize):
+		end = min(start + chunkSize, n)
+		yield end - start, dict((ref, v[start:end] if np.ndim(v) else v) for ref, v in chunk.items())
+
+
+def streamKernel(kernel, chunks, writer=None, chunkSize=CHUNKSIZE):
+	'''Calls a CompiledKernel on every chunk of scenarios chunks gives, at most
+	chunkSize at a time, passing writer each piece as a dict of the input and
+	output arrays (the outputs keyed as the kernel was compiled). Returns the
+	number of scenarios evaluated.'''
+	buffers = {}
+	count = 0
+	with excel_stats.phase('stream'):
+		for chunk in chunks:
+			for n, piece in pieces(chunk, chunkSize):
+				inputs = {}
+				for ref in kernel.inputs:
+					value = np.asarray(piece[ref])
+					if value.ndim == 1 and value.dtype.kind in 'fiub':
+						# numbers are copied into the same buffer every time
+						if ref not in buffers:
+							buffers[ref] = np.empty(chunkSize)
+						buffer = buffers[ref][:n]
+						buffer[:] = value
+						value = buffer
+					inputs[ref] = value
+				results = kernel.call(inputs)
+				if writer is not None:
+					batch = dict(piece)
+					batch.update(zip(kernel.outputs, results))
+					writer.write(batch)
+				count += n
+	stats = excel_stats.current
+	if stats is not None:
+		stats.count('scenariosStreamed', count)
+	return count
+
+
+def evaluateToFile(kernel, chunks, fileName, count=None, chunkSize=CHUNKSIZE):
+	'''Streams the chunks through the kernel into a .npy file with a column per
+	output, memory mapped as it is written if count, the number of scenarios,
+	is given. Returns the results, memory mapped read only.'''
+	writer = NpyWriter(fileName, kernel.outputs, count)
+	try:
+		streamKernel(kernel, chunks, writer, chunkSize)
+	finally:
+		writer.close()
+	if count is not None and writer.rows != count:
+		raise Exception(str(writer.rows) + " scenarios streamed into " + fileName + ", " + str(count) + " expected")
+	return writer.open()
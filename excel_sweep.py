@@ -0,0 +1,276 @@
+import argparse
+import csv
+import os
+import re
+import sys
+import time
+import numpy as np
+import excel_cache
+import excel_codegen
+import excel_graph
+import excel_grid
+import excel_shard
+import excel_stats
+import excel_stream
+
+
+'''
+Runs a workbook over a set of scenarios, from the command line.
+
+	python excel_sweep.py design.xml --input Sheet1!B2=1,2,5 --input Span=2:10:0.5
+		--input Load=normal(10,2) --samples 1000 --output YResult --output Sheet1!D2
+		--results results.csv
+
+Each --input sets a cell (a reference as resolveAddress takes it, Sheet1!B2
+or a name) to
+	a list of values        1,2,5  or  Steel,Timber
+	a range                 start:stop:step, stop included
+	a distribution          normal(mean,sd), lognormal(mean,sd),
+	                        uniform(low,high), triangular(low,mode,high),
+	                        one draw per scenario
+and --scenarios-csv gives a CSV file whose header names input cells and whose
+rows are scenarios. The scenarios are every CSV row, crossed with every
+combination of the lists and ranges, each repeated --samples times for the
+distributions to draw from.
+
+The cone of the outputs is compiled into a kernel once (see excel_codegen) and
+the scenarios are run through it in batches of --batch, each batch shared out
+between --processes worker processes if there are more than one (see
+excel_shard, large batches are best then). The results go to a columnar file,
+a column per input and output: .csv and .npy are written as they go, .npy
+memory mapped so that memory stays bounded however many scenarios there are
+(see excel_stream), and .npz at the end. The throughput, in scenarios per
+second, is reported on stderr.
+'''
+
+DISTRIBUTIONS = {
+	'normal': (2, lambda rng, p, n: rng.normal(p[0], p[1], n)),
+	'lognormal': (2, lambda rng, p, n: rng.lognormal(p[0], p[1], n)),
+	'uniform': (2, lambda rng, p, n: rng.uniform(p[0], p[1], n)),
+	'triangular': (3, lambda rng, p, n: rng.triangular(p[0], p[1], p[2], n)),
+}
+
+DISTRIBUTION = re.compile(r'([a-z]+)\((.*)\)$')
+RANGE = re.compile(r'([-+0-9.eE]+):([-+0-9.eE]+):([-+0-9.eE]+)$')
+
+
+class Input():
+	'''An input cell and where its scenario values come from, a list of values
+	(values) or a distribution (draw).'''
+
+	def __init__(self, ref, values=None, draw=None, params=None):
+		self.ref = ref
+		self.values = values
+		self.draw = draw
+		self.params = params
+
+
+def parseInput(spec):
+	'''An Input from a ref=values command line argument.'''
+	if '=' not in spec:
+		raise Exception("an input must be given as ref=values, not " + spec)
+	ref, text = spec.split('=', 1)
+	text = text.strip()
+	found = DISTRIBUTION.match(text)
+	if found:
+		if found.group(1) not in DISTRIBUTIONS:
+			raise Exception("unknown distribution " + found.group(1) + " for " + ref)
+		count, draw = DISTRIBUTIONS[found.group(1)]
+		params = [float(p) for p in found.group(2).split(',')]
+		if len(params) != count:
+			raise Exception(found.group(1) + " takes " + str(count) + " parameters, " + str(len(params)) + " given for " + ref)
+		return Input(ref, draw=draw, params=params)
+	found = RANGE.match(text)
+	if found:
+		start, stop, step = (float(g) for g in found.groups())
+		if step == 0 or (stop - start) / step < 0:
+			raise Exception("the range " + text + " for " + ref + " is empty")
+		return Input(ref, values=start + step * np.arange(int(np.floor((stop - start) / step + 1e-9)) + 1))
+	return Input(ref, values=asColumn(text.split(',')))
+
+
+def asColumn(values):
+	'''Text values as a float array, or as text if any of them is not a number.'''
+	try:
+		return np.array([float(v) for v in values])
+	except ValueError:
+		return np.array(values, dtype=str)
+
+
+def readScenarios(fileName):
+	'''The columns of a scenario CSV, keyed by the header, each an Input.'''
+	with open(fileName, newline='') as f:
+		rows = list(csv.reader(f))
+	if not rows:
+		raise Exception("the scenario file " + fileName + " is empty")
+	header, rows = rows[0], [row for row in rows[1:] if row]
+	for number, row in enumerate(rows):
+		if len(row) != len(header):
+			raise Exception("scenario " + str(number + 1) + " of " + fileName + " has " + str(len(row)) +
+				" fields, the header names " + str(len(header)))
+	return [Input(ref.strip(), values=asColumn([row[i] for row in rows])) for i, ref in enumerate(header)]
+
+
+class ScenarioSet():
+	'''Every scenario of the inputs, made a batch at a time. A scenario number
+	is split, like the digits of a number, into the CSV row, the value of
+	each list or range and the sample.'''
+
+	def __init__(self, inputs, csvInputs=(), samples=1, seed=0):
+		self.csvInputs = list(csvInputs)
+		self.sweeps = [i for i in inputs if i.values is not None]
+		self.randoms = [i for i in inputs if i.draw is not None]
+		self.samples = samples if self.randoms else 1
+		self.rng = np.random.default_rng(seed)
+		rows = len(self.csvInputs[0].values) if self.csvInputs else 1
+		self.shape = [rows] + [len(i.values) for i in self.sweeps] + [self.samples]
+		self.count = int(np.prod(self.shape))
+
+	def refs(self):
+		return [i.ref for i in self.csvInputs + self.sweeps + self.randoms]
+
+	def batch(self, start, end):
+		'''The input values of scenarios start to end, keyed by ref.'''
+		index = np.unravel_index(np.arange(start, end), self.shape)
+		values = {}
+		for i in self.csvInputs:
+			values[i.ref] = i.values[index[0]]
+		for n, i in enumerate(self.sweeps):
+			values[i.ref] = i.values[index[n + 1]]
+		for i in self.randoms:
+			values[i.ref] = i.draw(self.rng, i.params, end - start)
+		return values
+
+
+class CsvWriter():
+
+	def __init__(self, fileName, columns, count=None):
+		self.file = open(fileName, 'w', newline='')
+		self.writer = csv.writer(self.file)
+		self.writer.writerow(columns)
+		self.columns = columns
+
+	def write(self, batch):
+		self.writer.writerows(zip(*[textColumn(batch[c]).tolist() for c in self.columns]))
+
+	def close(self):
+		self.file.close()
+
+
+class NpzWriter():
+	'''Collects the batches and saves them as one array per column.'''
+
+	def __init__(self, fileName, columns, count=None):
+		self.fileName = fileName
+		self.columns = columns
+		self.batches = []
+
+	def write(self, batch):
+		self.batches.append(dict((c, columnValues(batch[c])) for c in self.columns))
+
+	def close(self):
+		np.savez(self.fileName, **dict((c, np.concatenate([b[c] for b in self.batches]) if self.batches else np.zeros(0))
+			for c in self.columns))
+
+
+WRITERS = {
+	'.csv': CsvWriter,
+	'.npy': excel_stream.NpyWriter,
+	'.npz': NpzWriter,
+}
+
+
+def columnValues(values):
+	'''A column as numbers, or as text (with the errors as excel writes them)
+	when it holds any.'''
+	values = np.asarray(values)
+	if values.dtype == object or values.dtype.kind in 'US':
+		return excel_grid.asText(values)
+	return values
+
+
+def textColumn(values):
+	'''A column as text for a CSV, the errors written as excel writes them.'''
+	values = np.asarray(values)
+	if values.dtype.kind == 'f':
+		return np.where(np.isfinite(values), excel_grid.asText(values), np.where(np.isinf(values), '#DIV/0!', '#VALUE!'))
+	return excel_grid.asText(values)
+
+
+def openWriter(fileName, columns, count=None):
+	extension = os.path.splitext(fileName)[1].lower()
+	if extension not in WRITERS:
+		raise Exception("cannot write results to " + fileName + ", use one of " + ", ".join(sorted(WRITERS)))
+	return WRITERS[extension](fileName, columns, count)
+
+
+def runSweep(workbook, outputs, scenarios, writer=None, batchSize=10000, kernel=None):
+	'''Evaluates the outputs for every scenario of a ScenarioSet in batches,
+	writing the inputs and outputs of each batch to writer. The kernel, if
+	given, is used rather than one compiled here, an excel_shard.ShardPool
+	say, which has built its graph already. Returns a report of the
+	scenarios run and the time taken.'''
+	start = time.perf_counter()
+	if kernel is None:
+		graph = excel_graph.CellGraph(workbook, outputs)
+		kernel = excel_codegen.compileKernel(workbook, outputs, scenarios.refs(), graph)
+	compiled = time.perf_counter()
+	chunks = (scenarios.batch(first, min(first + batchSize, scenarios.count))
+		for first in range(0, scenarios.count, batchSize))
+	excel_stream.streamKernel(kernel, chunks, writer, batchSize)
+	finished = time.perf_counter()
+	seconds = finished - compiled
+	return {
+		'scenarios': scenarios.count,
+		'cone': kernel.coneSize(),
+		'compileSeconds': compiled - start,
+		'evaluateSeconds': seconds,
+		'scenariosPerSecond': scenarios.count / seconds if seconds > 0 else 0.0,
+	}
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Evaluates workbook outputs over a sweep or Monte Carlo set of scenarios.")
+	parser.add_argument('workbook')
+	parser.add_argument('--input', action='append', default=[], metavar='REF=VALUES',
+		help="an input cell and its values, a list, start:stop:step or a distribution such as normal(10,2)")
+	parser.add_argument('--scenarios-csv', dest='scenariosCsv', help="a CSV of scenarios, a column per input cell")
+	parser.add_argument('--output', action='append', default=[], metavar='REF', help="an output cell or name")
+	parser.add_argument('--samples', type=int, default=1000, help="draws per combination for the distributions")
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--batch', type=int, default=10000, help="scenarios per kernel call")
+	parser.add_argument('--results', help="where to write the results, .csv, .npy or .npz")
+	parser.add_argument('--refresh', action='store_true', help="reload the workbook rather than use its cache")
+	parser.add_argument('--workers', type=int, default=1, help="processes to load the workbook with")
+	parser.add_argument('--processes', type=int, default=1,
+		help="worker processes to shard each batch of scenarios over, see excel_shard")
+	parser.add_argument('--stats', action='store_true', help="report the instrumentation counters too")
+	args = parser.parse_args(argv)
+	if not args.output:
+		parser.error("at least one --output is needed")
+
+	if args.stats:
+		excel_stats.enable()
+	wb = excel_cache.openWorkbook(args.workbook, refresh=args.refresh, workers=args.workers)
+	scenarios = ScenarioSet([parseInput(spec) for spec in args.input],
+		readScenarios(args.scenariosCsv) if args.scenariosCsv else (), args.samples, args.seed)
+	writer = openWriter(args.results, scenarios.refs() + args.output, scenarios.count) if args.results else None
+	pool = excel_shard.ShardPool(args.workbook, args.output, scenarios.refs(), args.processes) if args.processes > 1 else None
+	try:
+		report = runSweep(wb, args.output, scenarios, writer, args.batch, pool)
+	finally:
+		if pool is not None:
+			pool.close()
+		if writer is not None:
+			writer.close()
+
+	print("%d scenarios, %d cells in the cone, compiled in %.3fs, evaluated in %.3fs, %.0f scenarios/s" % (
+		report['scenarios'], report['cone'], report['compileSeconds'], report['evaluateSeconds'],
+		report['scenariosPerSecond']), file=sys.stderr)
+	if args.stats:
+		print(excel_stats.disable().report(), file=sys.stderr)
+	return report
+
+
+if __name__ == '__main__':
+	main()
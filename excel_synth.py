@@ -0,0 +1,147 @@
+import argparse
+import random
+import sys
+
+
+'''
+Generates synthetic Excel 2003 XML workbooks, for benchmarking.
+
+A generated sheet is a grid of rows by cols cells. The columns come in groups
+of depth + 1: the first column of each group holds numbers, and each column
+after it holds formulas reading the column to its left (with a probability of
+formulaDensity, numbers otherwise), so the longest chain of formulas is depth
+long. A formula reads either the cell to its left, or a range of rangeWidth
+rows of the column to its left through SUM, MIN or MAX, mixed in with IF and
+ROUND. Sheets after the first also read the sheet before them, and the last
+column of each sheet gets namedCells named cells, Out1, Out2 and so on.
+
+The content written for a formula cell is a placeholder 0, nothing here reads
+the calculated values excel would have saved.
+'''
+
+HEADER = '''<?xml version="1.0"?>
+<?mso-application progid="Excel.Sheet"?>
+<Workbook xmlns="urn:schemas-microsoft-com:office:spreadsheet"
+ xmlns:o="urn:schemas-microsoft-com:office:office"
+ xmlns:x="urn:schemas-microsoft-com:office:excel"
+ xmlns:ss="urn:schemas-microsoft-com:office:spreadsheet"
+ xmlns:html="http://www.w3.org/TR/REC-html40">
+'''
+
+DEFAULTS = {
+	'sheets': 1,
+	'rows': 1000,
+	'cols': 10,
+	'formulaDensity': 0.5,
+	'depth': 4,
+	'rangeWidth': 5,
+	'namedCells': 10,
+	'seed': 0,
+}
+
+
+def sheetName(sheet):
+	return "Sheet" + str(sheet + 1)
+
+
+def relRow(offset):
+	return "R" if offset == 0 else "R[" + str(offset) + "]"
+
+
+def isFormulaColumn(col, depth):
+	return col % (depth + 1) != 0
+
+
+def makeFormula(rnd, sheet, row, rows, rangeWidth):
+	'''A formula for a cell, reading the column to its left.'''
+	left = "C[-1]"
+	kind = rnd.random()
+	if kind < 0.4:
+		# a range of rangeWidth rows, turned round at the bottom of the sheet
+		top = 0 if row + rangeWidth - 1 <= rows else -min(rangeWidth - 1, row - 1)
+		bottom = top + min(rangeWidth, rows) - 1
+		fn = rnd.choice(('SUM', 'MIN', 'MAX'))
+		return "=" + fn + "(" + relRow(top) + left + ":" + relRow(bottom) + left + ")"
+	elif kind < 0.6:
+		return "=IF(R" + left + "&gt;0.5,R" + left + "*2,1-R" + left + ")"
+	elif kind < 0.75:
+		return "=ROUND(R" + left + "/3,2)"
+	elif kind < 0.85 and sheet > 0:
+		return "=" + sheetName(sheet - 1) + "!R" + left + "+R" + left
+	return "=R" + left + "*1.5+" + str(rnd.randint(1, 9))
+
+
+def generateWorkbook(fileName, sheets=1, rows=1000, cols=10, formulaDensity=0.5, depth=4,
+		rangeWidth=5, namedCells=10, seed=0):
+	'''Writes a synthetic workbook to fileName, returning a dict describing it
+	with its parameters and the number of cells and formulas written.'''
+	rnd = random.Random(seed)
+	names = {}      # (sheet, row) -> name, all in the last column
+	for sheet in range(sheets):
+		for row in rnd.sample(range(1, rows + 1), min(namedCells, rows)):
+			names[(sheet, row)] = "Out" + str(len(names) + 1)
+
+	cells = 0
+	formulas = 0
+	with open(fileName, 'w') as f:
+		f.write(HEADER)
+		if names:
+			f.write(' <Names>\n')
+			for (sheet, row), name in names.items():
+				f.write('  <NamedRange ss:Name="' + name + '" ss:RefersTo="=' + sheetName(sheet)
+					+ '!R' + str(row) + 'C' + str(cols) + '"/>\n')
+			f.write(' </Names>\n')
+		for sheet in range(sheets):
+			f.write(' <Worksheet ss:Name="' + sheetName(sheet) + '">\n')
+			f.write('  <Table ss:ExpandedColumnCount="' + str(cols) + '" ss:ExpandedRowCount="' + str(rows) + '">\n')
+			for row in range(1, rows + 1):
+				out = ['   <Row>\n']
+				for col in range(cols):
+					name = names.get((sheet, row)) if col == cols - 1 else None
+					named = '<NamedCell ss:Name="' + name + '"/>' if name else ''
+					if isFormulaColumn(col, depth) and rnd.random() < formulaDensity:
+						out.append('    <Cell ss:Formula="' + makeFormula(rnd, sheet, row, rows, rangeWidth)
+							+ '"><Data ss:Type="Number">0</Data>' + named + '</Cell>\n')
+						formulas += 1
+					else:
+						out.append('    <Cell><Data ss:Type="Number">' + repr(round(rnd.random(), 6))
+							+ '</Data>' + named + '</Cell>\n')
+				out.append('   </Row>\n')
+				f.write(''.join(out))
+				cells += cols
+			f.write('  </Table>\n </Worksheet>\n')
+		f.write('</Workbook>\n')
+
+	return {
+		'sheets': sheets, 'rows': rows, 'cols': cols, 'formulaDensity': formulaDensity,
+		'depth': depth, 'rangeWidth': rangeWidth, 'namedCells': len(names), 'seed': seed,
+		'cells': cells, 'formulas': formulas,
+	}
+
+
+def addArguments(parser):
+	'''Adds the workbook shape options, shared with excel_bench.'''
+	parser.add_argument('--sheets', type=int, default=DEFAULTS['sheets'])
+	parser.add_argument('--rows', type=int, default=DEFAULTS['rows'])
+	parser.add_argument('--cols', type=int, default=DEFAULTS['cols'])
+	parser.add_argument('--formula-density', dest='formulaDensity', type=float, default=DEFAULTS['formulaDensity'],
+		help="the chance a cell of a formula column holds a formula")
+	parser.add_argument('--depth', type=int, default=DEFAULTS['depth'],
+		help="the longest chain of formulas, in columns")
+	parser.add_argument('--range-width', dest='rangeWidth', type=int, default=DEFAULTS['rangeWidth'],
+		help="the number of rows in each range a formula reads")
+	parser.add_argument('--named-cells', dest='namedCells', type=int, default=DEFAULTS['namedCells'],
+		help="named cells per sheet")
+	parser.add_argument('--seed', type=int, default=DEFAULTS['seed'])
+
+
+def shapeOf(args):
+	return dict((key, getattr(args, key)) for key in DEFAULTS)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Writes a synthetic Excel 2003 XML workbook.")
+	parser.add_argument('fileName')
+	addArguments(parser)
+	args = parser.parse_args()
+	print(generateWorkbook(args.fileName, **shapeOf(args)), file=sys.stderr)
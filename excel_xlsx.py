@@ -0,0 +1,390 @@
+import posixpath
+import re
+import time
+import xml.parsers.expat
+import zipfile
+import excel_parse
+import excel_stats
+import excel_store
+
+
+'''
+Loads an .xlsx (or .xlsm) workbook into the same ExcelWB the Excel 2003 XML
+loaders build, straight from the zip package.
+
+Each worksheet member is streamed from the archive through expat, a block at
+a time, and never extracted. The shared strings table is read once and the
+cells that use it look their text up by index. Formulas are stored in A1
+style and are converted to the R1C1 form excel_lang parses, as Excel writes
+it into the XML, relative to the cell holding them. A shared formula has the
+same R1C1 form in every cell it is shared by, so it is converted once, in the
+cell that holds its text. The <definedNames> become named ranges, with their
+RefersTo in R1C1, and the cells inside a name's range are marked as named
+cells, as the NamedCell elements of the XML mark them. A name with a
+localSheetId is local to that sheet, as are the Names under a Worksheet of
+the XML, see ExcelWB.addNamedRange.
+
+The cell types map onto the XML ss:Type names, see DATATYPES. A date is
+stored in an .xlsx as its serial number with a date format, and here it
+stays a Number, styles are not read.
+
+	wb = excel_xlsx.loadWorkbook('design.xlsx')
+'''
+
+# the t attribute of a cell -> the ss:Type of the Excel 2003 XML, a cell with
+# no t holds a number
+DATATYPES = {
+	'n': 'Number',
+	's': 'String',
+	'str': 'String',
+	'inlineStr': 'String',
+	'b': 'Boolean',
+	'e': 'Error',
+	'd': 'DateTime',
+}
+
+CELLREF = re.compile(r'([A-Z]{1,3})(\d+)$')
+
+# a reference in an A1 formula, a cell, a range of cells, whole columns or
+# whole rows, on the sheet given or the formula's own. Not a name or the name
+# of a function, LOG10( say, nor a number like 1E10.
+A1REF = re.compile(r"(?<![\w.$!'\]])((?:'(?:[^']|'')+'|[A-Za-z_][\w.]*)!)?"
+	r"(?:(\$?)([A-Za-z]{1,3})(\$?)(\d+)(?::(\$?)([A-Za-z]{1,3})(\$?)(\d+))?"
+	r"|(\$?)([A-Za-z]{1,3}):(\$?)([A-Za-z]{1,3})"
+	r"|(\$?)(\d+):(\$?)(\d+))(?![\w(!.])")
+STRINGLITERAL = re.compile(r'("(?:[^"]|"")*")')
+
+MAXCOL = 16384
+MAXROW = 1048576
+
+
+def a1ToR1C1(formula, row, col):
+	'''An A1 formula as the R1C1 formula excel_lang parses, for the cell at the
+	1-based row and 0-based col, relative references becoming offsets from it.
+	The text inside string literals is left alone.'''
+	parts = STRINGLITERAL.split(formula)
+	for i in range(0, len(parts), 2):
+		parts[i] = A1REF.sub(lambda found: r1c1Ref(found, row, col), parts[i].replace('_xlfn.', ''))
+	return ''.join(parts)
+
+
+def r1c1Ref(found, row, col):
+	g = found.groups()
+	sheet = g[0] or ''
+	if g[2] is not None:
+		col0, row0 = excel_store.name2col(g[2].upper()), int(g[4])
+		if col0 >= MAXCOL or not 0 < row0 <= MAXROW:
+			return found.group(0)
+		ref = rowPart(g[3], row0, row) + colPart(g[1], col0, col)
+		if g[6] is not None:
+			col1 = excel_store.name2col(g[6].upper())
+			if col1 >= MAXCOL:
+				return found.group(0)
+			ref += ':' + rowPart(g[7], int(g[8]), row) + colPart(g[5], col1, col)
+		return sheet + ref
+	if g[10] is not None:
+		cols = [excel_store.name2col(g[10].upper()), excel_store.name2col(g[12].upper())]
+		if max(cols) >= MAXCOL:
+			return found.group(0)
+		parts = [colPart(g[9], cols[0], col), colPart(g[11], cols[1], col)]
+	else:
+		parts = [rowPart(g[13], int(g[14]), row), rowPart(g[15], int(g[16]), row)]
+	# a single column or row is written once, as Excel writes it
+	return sheet + (parts[0] if parts[0] == parts[1] else parts[0] + ':' + parts[1])
+
+
+def rowPart(absolute, row, base):
+	if absolute:
+		return "R" + str(row)
+	return "R" if row == base else "R[" + str(row - base) + "]"
+
+
+def colPart(absolute, col, base):
+	if absolute:
+		return "C" + str(col + 1)
+	return "C" if col == base else "C[" + str(col - base) + "]"
+
+
+def localName(name):
+	'''An element or attribute name without its namespace prefix, should the
+	file give one (x:c rather than c).'''
+	return name[name.index(':') + 1:] if ':' in name else name
+
+
+def parseMember(archive, member, start, end=None, characters=None):
+	'''Streams a member of the archive through expat, a block at a time.'''
+	parser = xml.parsers.expat.ParserCreate()
+	parser.buffer_text = True
+	parser.buffer_size = 1 << 20
+	parser.StartElementHandler = start
+	if end is not None:
+		parser.EndElementHandler = end
+	if characters is not None:
+		parser.CharacterDataHandler = characters
+	with archive.open(member) as source:
+		parser.ParseFile(source)
+
+
+def memberPath(base, target):
+	'''The archive path of a relationship target, relative to the part base.'''
+	if target.startswith('/'):
+		return target[1:]
+	return posixpath.normpath(posixpath.join(posixpath.dirname(base), target))
+
+
+def relationships(archive, part):
+	'''The relationships of a part, Id -> (type, archive path), the type being
+	matched on its last part as strict and transitional files name them apart.'''
+	relsName = posixpath.join(posixpath.dirname(part), '_rels', posixpath.basename(part) + '.rels')
+	rels = {}
+	if relsName not in archive.NameToInfo:
+		return rels
+
+	def start(name, attrs):
+		if localName(name) == 'Relationship' and attrs.get('TargetMode') != 'External':
+			rels[attrs['Id']] = (attrs.get('Type', ''), memberPath(part, attrs['Target']))
+	parseMember(archive, relsName, start)
+	return rels
+
+
+class XlsxLoader():
+	'''Streams an .xlsx package into the worksheet stores, the counterpart of
+	excel_parse.FastExcelLoader for the Excel 2003 XML. The element state is
+	kept as flags, as there, and cells are written to their SheetStore by row
+	and column.'''
+
+	def __init__(self):
+		self.wb = excel_parse.ExcelWB()
+		self.strings = []
+		self.store = None
+		self.worksheet = None
+		self.row = 0
+		self.col = 0
+		self.slot = None
+		self.celltype = None
+		self.shared = None
+		self.sharedFormulas = {}    # si -> the R1C1 formula of a shared formula
+		self.names = []             # the named ranges on the worksheet being loaded
+		self.inValue = False
+		self.inFormula = False
+		self.inInline = False
+		self.inPhonetic = False
+		self.text = []
+		self.cells = 0
+		self.stats = {}
+
+	def load(self, sourceFileName):
+		start = time.perf_counter()
+		with zipfile.ZipFile(sourceFileName) as archive:
+			workbookPart = 'xl/workbook.xml'
+			for kind, target in relationships(archive, '').values():
+				if kind.endswith('/officeDocument'):
+					workbookPart = target
+			rels = relationships(archive, workbookPart)
+			for kind, target in rels.values():
+				if kind.endswith('/sharedStrings'):
+					self.loadStrings(archive, target)
+			sheets = self.loadWorkbookPart(archive, workbookPart, rels)
+			for name, member in sheets:
+				self.loadSheet(archive, name, member)
+		seconds = time.perf_counter() - start
+
+		self.wb.setFileName(sourceFileName)
+		stats = excel_stats.current
+		if stats is not None:
+			stats.count('cellsLoaded', self.cells)
+			stats.addTime('load', seconds)
+			excel_stats.trace('load', fileName=sourceFileName, cells=self.cells, seconds=seconds)
+		self.stats = {
+			'cells': self.cells,
+			'seconds': seconds,
+			'cellsPerSecond': self.cells / seconds if seconds > 0 else 0.0,
+			'peakMemory': excel_parse.peakMemory(),
+		}
+		return self.wb
+
+	def loadStrings(self, archive, member):
+		'''Reads the shared strings table, the text of rich text runs joined and
+		phonetic guides left out.'''
+		strings = self.strings
+		text = []
+		state = {'inText': False, 'inPhonetic': False}
+
+		def start(name, attrs):
+			name = localName(name)
+			if name == 't':
+				state['inText'] = not state['inPhonetic']
+			elif name == 'si':
+				text.clear()
+			elif name == 'rPh':
+				state['inPhonetic'] = True
+
+		def end(name):
+			name = localName(name)
+			if name == 't':
+				state['inText'] = False
+			elif name == 'si':
+				strings.append(''.join(text))
+			elif name == 'rPh':
+				state['inPhonetic'] = False
+
+		def characters(content):
+			if state['inText']:
+				text.append(content)
+		parseMember(archive, member, start, end, characters)
+
+	def loadWorkbookPart(self, archive, member, rels):
+		'''Reads the sheets and defined names of the workbook, returning the
+		(name, archive path) of every worksheet in order.'''
+		sheets = []
+		names = []
+		text = []
+		state = {'name': None, 'sheet': None}
+
+		def start(name, attrs):
+			name = localName(name)
+			if name == 'sheet':
+				# r:id, whatever the prefix
+				for key, value in attrs.items():
+					if key.endswith(':id') and value in rels:
+						sheets.append((attrs['name'], rels[value][1]))
+			elif name == 'definedName':
+				state['name'] = attrs['name']
+				state['sheet'] = attrs.get('localSheetId')
+				text.clear()
+
+		def end(name):
+			if localName(name) == 'definedName' and state['name'] is not None:
+				names.append((state['name'], ''.join(text), state['sheet']))
+				state['name'] = None
+
+		def characters(content):
+			if state['name'] is not None:
+				text.append(content)
+		parseMember(archive, member, start, end, characters)
+
+		for name, refersTo, sheet in names:
+			if name.startswith('_xlnm.'):
+				name = name[len('_xlnm.'):]
+			# localSheetId is the position of the sheet in <sheets>, a name with
+			# one is local to that sheet, as a name under a Worksheet of the XML
+			sheet = sheets[int(sheet)][0] if sheet is not None and int(sheet) < len(sheets) else None
+			self.wb.addNamedRange(name, '=' + a1ToR1C1(refersTo, 1, 0), sheet)
+		return sheets
+
+	def loadSheet(self, archive, name, member):
+		self.worksheet = name
+		self.store = self.wb.getSheet(name)
+		self.row = 0
+		self.sharedFormulas = {}
+		# the names of cells on this sheet, but not the names local to another
+		self.names = [(r['name'], bounds) for r in self.wb.getData()['namedRanges']
+			for bounds in [excel_parse.parseRefersTo(r['refersto'])]
+			if bounds is not None and bounds[0] == name and r.get('sheet', name) == name]
+		excel_stats.trace('worksheet', name=name)
+		parseMember(archive, member, self.startElement, self.endElement, self.characters)
+
+	def startElement(self, name, attrs):
+		if ':' in name:
+			name = name[name.index(':') + 1:]
+		# the elements are tested in order of how often they turn up
+		if name == 'c':
+			ref = attrs.get('r')
+			found = CELLREF.match(ref) if ref else None
+			if found:
+				self.col = excel_store.name2col(found.group(1)) + 1
+				self.row = int(found.group(2))
+			else:
+				self.col += 1
+			self.celltype = attrs.get('t', 'n')
+			self.slot = None    # only cells holding a formula or a value get a slot
+			self.cells += 1
+			if self.names:
+				for cellName, (sheet, row0, col0, row1, col1) in self.names:
+					if row0 <= self.row <= row1 and col0 <= self.col - 1 <= col1:
+						self.wb.setNamedCell(cellName, excel_parse.ExcelCell(self.worksheet, self.col - 1, self.row, None))
+
+		elif name == 'v':
+			self.inValue = True
+			self.text = []
+
+		elif name == 'f':
+			self.inFormula = True
+			self.text = []
+			self.shared = attrs.get('si') if attrs.get('t') == 'shared' else None
+
+		elif name == 'row':
+			self.col = 0
+			index = attrs.get('r')
+			self.row = int(index) if index else self.row + 1
+
+		elif name == 'is':
+			self.inInline = True
+			self.text = []
+
+		elif name == 't':
+			self.inValue = self.inInline and not self.inPhonetic
+
+		elif name == 'rPh':
+			self.inPhonetic = True
+
+	def endElement(self, name):
+		if ':' in name:
+			name = name[name.index(':') + 1:]
+		if name == 'c':
+			return
+		elif name == 'v':
+			if self.inValue:
+				self.inValue = False
+				text = ''.join(self.text)
+				if self.celltype == 's':
+					text = self.strings[int(text)]
+				self.setValue(text)
+		elif name == 'f':
+			self.inFormula = False
+			text = ''.join(self.text)
+			if text:
+				formula = '=' + a1ToR1C1(text, self.row, self.col - 1)
+				if self.shared is not None:
+					self.sharedFormulas[self.shared] = formula
+			else:
+				formula = self.sharedFormulas.get(self.shared)
+			if formula:
+				if self.slot is None:
+					self.slot = self.store.addSlot(self.row, self.col - 1)
+				self.store.setFormula(self.slot, formula)
+		elif name == 't':
+			if self.inInline:
+				self.inValue = False
+		elif name == 'is':
+			self.inInline = False
+			self.setValue(''.join(self.text))
+		elif name == 'rPh':
+			self.inPhonetic = False
+
+	def setValue(self, text):
+		if self.slot is None:
+			self.slot = self.store.addSlot(self.row, self.col - 1)
+		datatype = DATATYPES.get(self.celltype, 'Number')
+		self.store.setDataType(self.slot, datatype)
+		if text:
+			self.store.setContent(self.slot, text, datatype)
+
+	def characters(self, content):
+		if self.inValue or self.inFormula:
+			self.text.append(content)
+
+	def getWorkbook(self):
+		return self.wb
+
+	def getStats(self):
+		return self.stats
+
+
+def isXlsx(sourceFileName):
+	return sourceFileName.lower().endswith(('.xlsx', '.xlsm'))
+
+
+def loadWorkbook(sourceFileName):
+	'''Loads an .xlsx workbook, returning the ExcelWB.'''
+	return XlsxLoader().load(sourceFileName)
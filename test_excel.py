@@ -0,0 +1,689 @@
+import csv
+import os
+import shutil
+import subprocess
+import sys
+import xml.sax
+import xml.sax.saxutils
+import zipfile
+import numpy as np
+import pytest
+import excel_ast
+import excel_bench
+import excel_cache
+import excel_codegen
+import excel_graph
+import excel_grid
+import excel_lang
+import excel_lookup
+import excel_opt
+import excel_parse
+import excel_shard
+import excel_stats
+import excel_store
+import excel_stream
+import excel_sweep
+import excel_synth
+import excel_xlsx
+
+
+'''
+Regression tests, run with python -m pytest from this directory.
+'''
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def stage2():
+	return excel_parse.loadWorkbook(os.path.join(HERE, 'stage2.xml'))
+
+
+def test_kernel_input_outside_cone():
+	wb = stage2()
+	output = ('Sheet1', '2', 'D')
+	expected = excel_grid.GridEvaluator(wb).evaluate(output, {})
+	kernel = excel_codegen.compileKernel(wb, [output], ['Sheet1!B9'])
+	result, = kernel(np.array([1.0, 2.0]))
+	assert len(result) == 2
+	assert np.all(result == expected)
+
+
+def setFormula(wb, col, row, formula):
+	wb.setCellData(excel_parse.ExcelCell('Sheet1', col, row, None), 'formula', formula, replace=True)
+
+
+def test_recalculate_scalar_with_vector_inputs():
+	wb = stage2()
+	setFormula(wb, 'E', 2, '=R2C2*R3C2')
+	output = ('Sheet1', '2', 'E')
+	inc = excel_grid.IncrementalEvaluator(wb, [output], {'Sheet1!B2': np.arange(5.0), 'Sheet1!B3': 2.0})
+	assert inc.recalculate({'Sheet1!B3': 3.0}) == [output]
+	assert inc.scenarios == 5
+	assert np.all(inc.getValue(output) == np.arange(5.0) * 3)
+
+
+def test_recalculate_through_cells_a_new_formula_reads():
+	wb = stage2()
+	setFormula(wb, 'E', 2, '=R2C2')
+	setFormula(wb, 'F', 2, '=R2C2*10')
+	output = ('Sheet1', '2', 'E')
+	inc = excel_grid.IncrementalEvaluator(wb, [output], {'Sheet1!B2': 1.0})
+	inc.graph.getDependents()
+	setFormula(wb, 'E', 2, '=R2C6+100')
+	inc.recalculate()
+	assert inc.getValue(output)[0] == 110
+	inc.recalculate({'Sheet1!B2': 2.0})
+	assert inc.getValue(output)[0] == 120
+
+
+def test_number_read_alone_matches_range_read():
+	wb = stage2()
+	cell = excel_parse.ExcelCell('Sheet1', 'G', 2, None)
+	wb.setCellData(cell, 'datatype', 'Number', replace=True)
+	wb.setCellData(cell, 'content', repr(0.1 + 0.2), replace=True)
+	setFormula(wb, 'H', 2, '=R2C7-0.3')
+	setFormula(wb, 'H', 3, '=SUM(R2C7:R2C7)-0.3')
+	evaluator = excel_grid.GridEvaluator(wb)
+	alone = evaluator.evaluate(('Sheet1', '2', 'H'))
+	assert alone[0] == 0.1 + 0.2 - 0.3
+	assert np.all(alone == evaluator.evaluate(('Sheet1', '3', 'H')))
+
+
+def test_optimize_again_after_include():
+	wb = stage2()
+	setFormula(wb, 'E', 2, '=(R2C2+R3C2)*2+(R2C2+R3C2)*3')
+	setFormula(wb, 'E', 3, '=SUM(R2C2:R4C2)+(R2C2+R3C2)')
+	inputs = {'Sheet1!B2': np.arange(4.0)}
+	graph = excel_graph.CellGraph(wb, [('Sheet1', '2', 'E')])
+	excel_opt.optimizeGraph(graph)
+	graph.include([('Sheet1', '3', 'E')])
+	excel_opt.optimizeGraph(graph)
+	plain = excel_grid.GridEvaluator(wb)
+	optimized = excel_grid.GridEvaluator(wb, graph)
+	for output in [('Sheet1', '2', 'E'), ('Sheet1', '3', 'E')]:
+		assert np.allclose(optimized.evaluate(output, inputs), plain.evaluate(output, inputs))
+
+
+def test_block_of_a_sparse_sheet():
+	wb = stage2()
+	far = excel_parse.ExcelCell('Sheet1', 'XFA', 1000000, None)
+	wb.setCellData(far, 'datatype', 'Number')
+	wb.setCellData(far, 'content', '7')
+	block = wb.getBlock(('Sheet1', 999999, 16380, 1000000, 16381))
+	assert block.shape == (2, 2)
+	assert block[1, 0] == 7 and np.isnan(block[0, 0]) and np.isnan(block[1, 1])
+
+
+def test_range_constants_are_not_nodes():
+	wb = stage2()
+	for row in range(2, 7):
+		setFormula(wb, 'G', row, None)
+		cell = excel_parse.ExcelCell('Sheet1', 'G', row, None)
+		wb.setCellData(cell, 'datatype', 'Number', replace=True)
+		wb.setCellData(cell, 'content', str(row), replace=True)
+	setFormula(wb, 'G', 7, '=R2C7*2')
+	setFormula(wb, 'H', 2, '=SUM(R2C7:R7C7)')
+	output = ('Sheet1', '2', 'H')
+	graph = excel_graph.CellGraph(wb, [output])
+	assert sorted(graph.addresses) == [('Sheet1', '2', 'G'), ('Sheet1', '2', 'H'), ('Sheet1', '7', 'G')]
+
+	inputs = {'Sheet1!G4': np.array([4.0, 14.0])}
+	expected = np.array([2 + 3 + 4 + 5 + 6 + 4, 2 + 3 + 14 + 5 + 6 + 4])
+	assert np.all(excel_grid.GridEvaluator(wb, graph).evaluate(output, inputs) == expected)
+	kernel = excel_codegen.compileKernel(wb, [output], list(inputs))
+	assert np.all(kernel(inputs['Sheet1!G4'])[0] == expected)
+
+	inc = excel_grid.IncrementalEvaluator(wb, [output], inputs)
+	assert inc.recalculate({'Sheet1!G4': np.array([5.0, 15.0])}) == [output]
+	assert np.all(inc.getValue(output) == expected + 1)
+	cell = excel_parse.ExcelCell('Sheet1', 'G', 5, None)
+	wb.setCellData(cell, 'content', '10', replace=True)
+	inc.recalculate()
+	assert np.all(inc.getValue(output) == expected + 6)
+	setFormula(wb, 'G', 6, '=R2C7*100')
+	inc.recalculate()
+	assert np.all(inc.getValue(output) == expected + 200)
+
+
+def test_comparison_of_an_error_is_the_error():
+	wb = stage2()
+	setFormula(wb, 'E', 2, '=IFERROR(IF(R2C2/0>1,"a","b"),"err")')
+	setFormula(wb, 'E', 3, '=IF(R2C2/0>1,1,2)')
+	setFormula(wb, 'E', 4, '=IF(R2C2>1,1,2)')
+	outputs = [('Sheet1', str(row), 'E') for row in (2, 3, 4)]
+	inputs = {'Sheet1!B2': np.array([0.0, 3.0])}
+	evaluator = excel_grid.GridEvaluator(wb)
+	kernel = excel_codegen.compileKernel(wb, outputs, list(inputs))
+	for results in ([evaluator.evaluate(o, inputs) for o in outputs], kernel.call(inputs)):
+		text, error, plain = results
+		assert list(text) == ['err', 'err']
+		# 0/0 is NaN and 3/0 is inf, #DIV/0!
+		assert np.isnan(error[0]) and np.isinf(error[1])
+		assert list(plain) == [2, 1]
+	cuda = excel_codegen.compileKernel(wb, outputs[2:], list(inputs)).cudaSource()
+	assert 'xl_compare(' in cuda
+
+
+def test_kernel_with_a_non_finite_literal():
+	wb = stage2()
+	setFormula(wb, 'E', 2, '=1e999*R2C2')
+	setFormula(wb, 'E', 3, '=-1e999*R2C2')
+	outputs = [('Sheet1', '2', 'E'), ('Sheet1', '3', 'E')]
+	kernel = excel_codegen.compileKernel(wb, outputs, ['Sheet1!B2'])
+	up, down = kernel(np.array([1.0, 2.0]))
+	assert np.all(up == np.inf) and np.all(down == -np.inf)
+	cuda = kernel.cudaSource()
+	assert 'Sheet1__E__2 = (INFINITY * ' in cuda
+
+
+def withoutBrackets(t):
+	'''A parsed tree with its SUBEXP nodes taken out, as a NodeTable holds it.'''
+	if t[0] == 'SUBEXP':
+		return withoutBrackets(t[1][0])
+	if t[0] in ('BINOP', 'UNOP', 'FUNC'):
+		return (t[0], t[1], tuple(withoutBrackets(a) for a in t[2]))
+	if t[0] == 'ARRAY_FN':
+		return (t[0], tuple(withoutBrackets(a) for a in t[1]))
+	return t
+
+
+def test_node_table_round_trips_parsed_formulas():
+	wb = stage2()
+	setFormula(wb, 'E', 2, '=-(R[1]C+2.5)*SUM(R1C1:R2C2,"x",TRUE)+IF(R2C2>1,1,2)&A1')
+	table = excel_ast.compileWorkbook(wb)
+	for text in wb.getData()["formulas"].getValues():
+		parsed = excel_lang.parseFormula(text)[1][0]
+		assert table.toTree(table.compileFormula(text)) == withoutBrackets(parsed)
+	assert table.getRoot(wb, ('Sheet1', '2', 'E')) == table.cellRoots['Sheet1'][wb.getSheet('Sheet1').findSlot(2, 4)]
+
+
+def test_cached_workbook_is_not_parsed_again(tmp_path):
+	source = str(tmp_path / 'stage2.xml')
+	shutil.copy(os.path.join(HERE, 'stage2.xml'), source)
+	cacheDir = str(tmp_path / 'cache')
+	loaded = excel_cache.openWorkbook(source, cacheDir=cacheDir)
+	cached = excel_cache.openWorkbook(source, cacheDir=cacheDir)
+	assert 'mapped' in cached.getData()
+	excel_lang.formulaCache.clear()
+	graph = excel_graph.CellGraph(cached)
+	assert excel_lang.formulaCache.stats()['misses'] == 0
+	expected = excel_grid.GridEvaluator(loaded)
+	for node, tree in enumerate(graph.trees):
+		if tree is not None:
+			address = graph.addresses[node]
+			text = cached.getCell(address).getFormula()
+			assert tree == withoutBrackets(excel_lang.parseFormula(text)[1][0])
+			assert np.array_equal(excel_grid.GridEvaluator(cached, graph).evaluate(address), expected.evaluate(address))
+
+
+def test_scenario_csv_with_a_short_row(tmp_path):
+	fileName = str(tmp_path / 'scenarios.csv')
+	with open(fileName, 'w') as f:
+		f.write("Sheet1!B2,Sheet1!B3\n1,2\n3\n")
+	with pytest.raises(Exception, match="scenario 2 of .* has 1 fields, the header names 2"):
+		excel_sweep.readScenarios(fileName)
+
+
+def test_sweep_with_a_kernel_builds_no_graph(monkeypatch):
+	wb = stage2()
+	outputs = ['Sheet1!D2', 'Sheet1!D6']
+	scenarios = excel_sweep.ScenarioSet([excel_sweep.parseInput('Sheet1!B2=1:4:1')])
+	kernel = excel_codegen.compileKernel(wb, outputs, scenarios.refs())
+
+	def noGraph(*args):
+		raise AssertionError("the kernel's graph is built already")
+	monkeypatch.setattr(excel_graph, 'CellGraph', noGraph)
+	report = excel_sweep.runSweep(wb, outputs, scenarios, kernel=kernel)
+	assert report['scenarios'] == 4
+	assert report['cone'] == len(kernel.nodes)
+
+
+def test_cache_is_hashed_once_after_a_touch(tmp_path, monkeypatch):
+	source = str(tmp_path / 'stage2.xml')
+	shutil.copy(os.path.join(HERE, 'stage2.xml'), source)
+	cacheDir = str(tmp_path / 'cache')
+	excel_cache.openWorkbook(source, cacheDir=cacheDir)
+	st = os.stat(source)
+	os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+	hashes = []
+	hashFile = excel_cache.hashFile
+	monkeypatch.setattr(excel_cache, 'hashFile', lambda fileName: hashes.append(fileName) or hashFile(fileName))
+	for i in range(3):
+		wb = excel_cache.openWorkbook(source, cacheDir=cacheDir)
+		assert 'mapped' in wb.getData()
+	assert len(hashes) == 1
+	header, base = excel_cache.readHeader(excel_cache.cachePath(source, cacheDir))
+	assert header['source']['mtime'] == os.stat(source).st_mtime_ns
+
+
+def test_wavefront_matches_serial(tmp_path):
+	fileName = str(tmp_path / 'synth.xml')
+	excel_synth.generateWorkbook(fileName, rows=200, cols=8, formulaDensity=0.8, depth=3, seed=3)
+	wb = excel_parse.loadWorkbook(fileName)
+	inputs = {'Sheet1!A1': np.linspace(0.0, 1.0, 16), 'Sheet1!A2': np.linspace(1.0, 2.0, 16)}
+	outputs = ['Out' + str(i) for i in range(1, 11)]
+	serial = excel_grid.GridEvaluator(wb)
+	wavefront = excel_grid.WavefrontEvaluator(wb, workers=4, minParallel=1)
+	for output in outputs:
+		expected = serial.evaluate(output, inputs)
+		assert np.array_equal(wavefront.evaluate(output, inputs), expected, equal_nan=True)
+	assert wavefront.parallelism()['maxWidth'] > 1
+
+
+def writeXlsx(fileName, sheets, names=()):
+	'''Writes a bare .xlsx package, sheets being (name, [(A1 ref, value)]) and
+	names (name, A1 RefersTo, localSheetId or None). A value is a number, an
+	=formula, text, which goes in the shared strings, or (si, formula) for a
+	cell of a shared formula, formula None in all but its first cell.'''
+	ns = ' xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"' \
+		' xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"'
+	relType = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/'
+	rels = ''.join('<Relationship Id="rId' + str(i) + '" Type="' + relType + 'worksheet"'
+		' Target="worksheets/sheet' + str(i) + '.xml"/>' for i in range(1, len(sheets) + 1))
+	rels += '<Relationship Id="rId0" Type="' + relType + 'sharedStrings" Target="sharedStrings.xml"/>'
+	defined = ''.join('<definedName name="' + name + '"' + ('' if local is None else ' localSheetId="' + str(local) + '"')
+		+ '>' + xml.sax.saxutils.escape(refersTo) + '</definedName>' for name, refersTo, local in names)
+	strings = []
+
+	def cell(ref, value):
+		if isinstance(value, tuple):
+			si, formula = value
+			return '<c r="' + ref + '"><f t="shared" si="' + str(si) + '">' + xml.sax.saxutils.escape(formula or '') + '</f></c>'
+		elif isinstance(value, str) and value.startswith('='):
+			return '<c r="' + ref + '"><f>' + xml.sax.saxutils.escape(value[1:]) + '</f></c>'
+		elif isinstance(value, str):
+			strings.append(value)
+			return '<c r="' + ref + '" t="s"><v>' + str(len(strings) - 1) + '</v></c>'
+		return '<c r="' + ref + '"><v>' + repr(value) + '</v></c>'
+	with zipfile.ZipFile(fileName, 'w') as archive:
+		archive.writestr('xl/workbook.xml', '<workbook' + ns + '><sheets>'
+			+ ''.join('<sheet name="' + xml.sax.saxutils.escape(name) + '" sheetId="' + str(i) + '" r:id="rId' + str(i) + '"/>'
+				for i, (name, cells) in enumerate(sheets, 1))
+			+ '</sheets><definedNames>' + defined + '</definedNames></workbook>')
+		archive.writestr('xl/_rels/workbook.xml.rels',
+			'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">' + rels + '</Relationships>')
+		for i, (name, cells) in enumerate(sheets, 1):
+			archive.writestr('xl/worksheets/sheet' + str(i) + '.xml', '<worksheet' + ns + '><sheetData>'
+				+ ''.join(cell(ref, value) for ref, value in cells) + '</sheetData></worksheet>')
+		archive.writestr('xl/sharedStrings.xml', '<sst' + ns + '>'
+			+ ''.join('<si><t>' + xml.sax.saxutils.escape(text) + '</t></si>' for text in strings) + '</sst>')
+
+
+def test_sheet_names_are_local_to_their_sheet(tmp_path):
+	fileName = str(tmp_path / 'local.xlsx')
+	writeXlsx(fileName, [('Sheet1', [('A1', 2), ('B1', '=Rate*10')]), ('Sheet2', [('A1', 3), ('B1', '=Rate*10')])],
+		[('Rate', 'Sheet1!$A$1', 0), ('Rate', 'Sheet2!$A$1', 1), ('_xlnm.Print_Area', 'Sheet2!$A$1:$B$1', 1)])
+	xml = str(tmp_path / 'local.xml')
+	with open(xml, 'w') as f:
+		f.write(excel_synth.HEADER)
+		for sheet, value in (('Sheet1', 2), ('Sheet2', 3)):
+			f.write(' <Worksheet ss:Name="' + sheet + '">\n  <Names><NamedRange ss:Name="Rate" ss:RefersTo="=' + sheet
+				+ '!R1C1"/></Names>\n  <Table><Row><Cell><Data ss:Type="Number">' + str(value) + '</Data><NamedCell ss:Name="Rate"/></Cell>'
+				+ '<Cell ss:Formula="=Rate*10"><Data ss:Type="Number">0</Data></Cell></Row></Table>\n </Worksheet>\n')
+		f.write('</Workbook>\n')
+	for wb in (excel_xlsx.loadWorkbook(fileName), excel_parse.loadWorkbook(xml)):
+		assert wb.getNamedRange('Rate') is None and wb.getNamedRange('Print_Area') is None
+		assert wb.getNamedRange('Sheet2!Rate') == ('Sheet2', 1, 0, 1, 0)
+		evaluator = excel_grid.GridEvaluator(wb)
+		assert evaluator.evaluate(('Sheet1', '1', 'B'))[0] == 20
+		assert evaluator.evaluate(('Sheet2', '1', 'B'))[0] == 30
+		kernel = excel_codegen.compileKernel(wb, [('Sheet2', '1', 'B')], ['Sheet2!Rate'])
+		assert kernel(np.array([4.0]))[0][0] == 40
+
+
+def test_graph_has_each_cell_once_in_topological_order():
+	wb = stage2()
+	setFormula(wb, 'E', 2, '=R2C2+R2C2*R3C2')
+	setFormula(wb, 'E', 3, '=R2C5+R2C2')
+	graph = excel_graph.CellGraph(wb)
+	assert len(set(graph.addresses)) == len(graph.addresses) == len(graph.index)
+	node = graph.index[('Sheet1', '2', 'E')]
+	assert sorted(graph.addresses[p] for p in graph.precedents[node]) == [('Sheet1', '2', 'B'), ('Sheet1', '3', 'B')]
+	order = graph.topologicalOrder()
+	assert sorted(order) == list(range(len(graph)))
+	place = dict((n, i) for i, n in enumerate(order))
+	assert all(place[p] < place[n] for n in order for p in graph.precedents[n])
+	cone = [graph.addresses[n] for n in graph.order([graph.index[('Sheet1', '3', 'E')]])]
+	assert sorted(cone) == [('Sheet1', '2', 'B'), ('Sheet1', '2', 'E'), ('Sheet1', '3', 'B'), ('Sheet1', '3', 'E')]
+	assert cone[-1] == ('Sheet1', '3', 'E')
+
+
+def test_parse_cache_shares_one_tree_per_formula_text():
+	cache = excel_lang.ParseCache(maxSize=2)
+	first = cache.parse('=R[-1]C+1')
+	assert cache.parse('=R[-1]C+1') is first
+	assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+	cache.parse('=R[-2]C*2')
+	cache.parse('=SUM(R1C1:R3C1)')
+	assert cache.stats()['evictions'] == 1 and cache.stats()['size'] == 2
+	assert cache.parse('=R[-1]C+1') is not first
+	assert cache.parse('=R[-1]C+1') == first
+
+
+def test_store_keeps_the_first_value_and_interns_repeats():
+	wb = excel_parse.ExcelWB()
+	for row in (1, 2, 3):
+		cell = excel_parse.ExcelCell('Sheet1', 'B', row, None)
+		wb.setCellData(cell, 'formula', '=R[-1]C+1')
+		wb.setCellData(cell, 'datatype', 'Number')
+		wb.setCellData(cell, 'content', '1.5')
+	cell = excel_parse.ExcelCell('Sheet1', 'B', 2, None)
+	wb.setCellData(cell, 'content', '9')
+	assert wb.getCell(('Sheet1', '2', 'B')).getData() == {'formula': '=R[-1]C+1', 'datatype': 'Number', 'content': '1.5'}
+	wb.setCellData(cell, 'content', '9', replace=True)
+	assert wb.getCell(('Sheet1', '2', 'B')).getData()['content'] == '9'
+	assert wb.popChanges() == {('Sheet1', '2', 'B')}
+	store = wb.getSheet('Sheet1')
+	assert len(store) == 3 and len(wb.getData()['formulas']) == 1
+	assert list(store.formulas) == [0, 0, 0]
+	assert not wb.hasCell(('Sheet1', '4', 'B'))
+
+	mapped = excel_store.SheetStore.fromBuffers('Sheet1', store.datatypeTable, store.stringTable,
+		store.formulaTable, store.sortedArrays())
+	assert mapped.getData(mapped.findSlot(2, 1)) == store.getData(store.findSlot(2, 1))
+	mapped.setField(4, 1, 'content', 'text')
+	assert mapped.index is not None and mapped.getContent(mapped.findSlot(4, 1)) == 'text'
+
+
+def test_fast_loader_matches_sax_loader():
+	handler = excel_parse.ExcelHandler()
+	with open(os.path.join(HERE, 'stage2.xml'), 'rb') as source:
+		xml.sax.parse(source, handler)
+	slow = handler.getWorkbook()
+	loader = excel_parse.FastExcelLoader()
+	fast = loader.load(os.path.join(HERE, 'stage2.xml'))
+	addresses = sorted(slow.getAddresses())
+	assert sorted(fast.getAddresses()) == addresses
+	for address in addresses:
+		assert fast.getCell(address).getData() == slow.getCell(address).getData()
+	assert fast.getData()['namedRanges'] == slow.getData()['namedRanges']
+	assert fast.getData()['names'] == slow.getData()['names']
+	assert loader.getStats()['cells'] == handler.cells
+
+
+def test_cache_round_trips_and_goes_stale(tmp_path):
+	source = str(tmp_path / 'stage2.xml')
+	shutil.copy(os.path.join(HERE, 'stage2.xml'), source)
+	cacheDir = str(tmp_path / 'cache')
+	loaded = excel_cache.openWorkbook(source, cacheDir=cacheDir)
+	cached = excel_cache.openWorkbook(source, cacheDir=cacheDir)
+	assert 'mapped' in cached.getData() and 'mapped' not in loaded.getData()
+	addresses = sorted(loaded.getAddresses())
+	assert sorted(cached.getAddresses()) == addresses
+	for address in addresses:
+		assert cached.getCell(address).getData() == loaded.getCell(address).getData()
+	assert cached.getData()['names'] == loaded.getData()['names']
+	assert cached.getData()['namedCells'] == loaded.getData()['namedCells']
+
+	with open(source, 'a') as f:
+		f.write('\n')
+	assert 'mapped' not in excel_cache.openWorkbook(source, cacheDir=cacheDir).getData()
+	cacheFileName = excel_cache.cachePath(source, cacheDir)
+	with open(cacheFileName, 'r+b') as f:
+		f.seek(len(excel_cache.MAGIC))
+		f.write(excel_cache.PREAMBLE.pack(excel_cache.VERSION - 1, 0))
+	assert excel_cache.readHeader(cacheFileName) is None
+	assert 'mapped' not in excel_cache.openWorkbook(source, cacheDir=cacheDir).getData()
+	assert 'mapped' in excel_cache.openWorkbook(source, cacheDir=cacheDir).getData()
+
+
+def test_synthetic_workbook_and_benchmark(tmp_path):
+	shape = dict(excel_synth.DEFAULTS, sheets=2, rows=40, cols=6)
+	described = excel_synth.generateWorkbook(str(tmp_path / 'synth.xml'), **shape)
+	wb = excel_parse.loadWorkbook(str(tmp_path / 'synth.xml'))
+	stores = wb.getData()['worksheets'].values()
+	assert described['cells'] == sum(len(store) for store in stores) == 2 * 40 * 6
+	assert described['formulas'] == sum(1 for store in stores for id in store.formulas if id >= 0)
+	assert len(wb.getData()['names']) == described['namedCells']
+
+	result = excel_bench.runBenchmark(shape, scenarios=8, phases=('load', 'cacheLoad', 'evaluate'), workDir=str(tmp_path))
+	assert set(result['seconds']) == {'load', 'cacheWrite', 'cacheLoad', 'parse', 'graph', 'optimize', 'evaluate'}
+	assert result['counts']['cells'] == described['cells'] and result['counts']['evaluated'] > 0
+
+
+def test_parallel_load_matches_serial_load(tmp_path):
+	fileName = str(tmp_path / 'synth.xml')
+	excel_synth.generateWorkbook(fileName, sheets=3, rows=60, cols=6, seed=1)
+	serial = excel_parse.loadWorkbook(fileName)
+	parallel = excel_parse.loadWorkbook(fileName, workers=2)
+	assert list(parallel.getData()['worksheets']) == list(serial.getData()['worksheets'])
+	addresses = sorted(serial.getAddresses())
+	assert sorted(parallel.getAddresses()) == addresses
+	for address in addresses:
+		assert parallel.getCell(address).getData() == serial.getCell(address).getData()
+	assert parallel.getData()['names'] == serial.getData()['names']
+	assert parallel.getData()['namedCells'] == serial.getData()['namedCells']
+
+
+def test_parser_is_built_lazily_from_current_tables():
+	check = ("import sys, excel_lang; assert excel_lang._parser is None and 'ply' not in sys.modules; "
+		"excel_lang.parseFormula('=R1C1+1'); assert excel_lang._parser is not None")
+	subprocess.run([sys.executable, '-c', check], cwd=HERE, check=True)
+	import ply.yacc
+	import excel_lang_tab
+	grammar = ply.yacc.ParserReflect(dict((name, getattr(excel_lang, name)) for name in dir(excel_lang)))
+	grammar.get_all()
+	# tables out of date are rebuilt in memory on every start, see writeTables
+	assert grammar.signature() == excel_lang_tab._lr_signature
+
+
+def test_optimizer_folds_literals_and_shares_subexpressions():
+	wb = stage2()
+	setFormula(wb, 'E', 2, '=0.5*R2C2*PI()*4+ROUND(2/3,2)')
+	setFormula(wb, 'E', 3, '=(R[-1]C[-3]+R3C2)*2')
+	setFormula(wb, 'F', 3, '=(R2C2+R[0]C[-4])*3')
+	outputs = [('Sheet1', '2', 'E'), ('Sheet1', '3', 'E'), ('Sheet1', '3', 'F')]
+	graph = excel_graph.CellGraph(wb, outputs)
+	report = excel_opt.optimizeGraph(graph)
+	assert report['folded'] >= 2 and report['shared'] == 1 and report['removed'] > 0
+	product, rounded = graph.trees[graph.index[outputs[0]]][2]
+	assert rounded == ('NUMBER', 0.67)
+	assert ('NUMBER', 2 * np.pi) in product[2]
+	shared = graph.trees[graph.index[outputs[1]]][2][0]
+	assert shared[0] == 'SHARED' and graph.trees[graph.index[outputs[2]]][2][0] == shared
+	inputs = {'Sheet1!B2': np.arange(3.0), 'Sheet1!B3': 5.0}
+	plain = excel_grid.GridEvaluator(wb)
+	optimized = excel_grid.GridEvaluator(wb, graph)
+	for output in outputs:
+		assert np.allclose(optimized.evaluate(output, inputs), plain.evaluate(output, inputs))
+
+
+def test_vlookup_exact_and_approximate_over_a_named_table():
+	wb = stage2()
+	for row, (key, value) in enumerate([(40, 4.5), (10, 1.5), (20, 2.5), (30, None)], 2):
+		for col, content in (('G', key), ('H', value)):
+			cell = excel_parse.ExcelCell('Sheet1', col, row, None)
+			setFormula(wb, col, row, None)
+			wb.setCellData(cell, 'datatype', 'Number', replace=True)
+			if content is not None:
+				wb.setCellData(cell, 'content', str(content), replace=True)
+	setFormula(wb, 'H', 5, '=R2C2*2')
+	wb.addNamedRange('prices', '=Sheet1!R2C7:R5C8')
+	setFormula(wb, 'E', 2, '=VLOOKUP(R2C2,prices,2,FALSE)')
+	setFormula(wb, 'E', 3, '=VLOOKUP(R2C2,R2C7:R5C8,2)')
+	inputs = {'Sheet1!B2': np.array([20.0, 25.0, 5.0, 40.0, 30.0])}
+	evaluator = excel_grid.GridEvaluator(wb)
+	exact = evaluator.evaluate(('Sheet1', '2', 'E'), inputs)
+	assert np.array_equal(exact, [2.5, np.nan, np.nan, 4.5, 60.0], equal_nan=True)
+	approximate = evaluator.evaluate(('Sheet1', '3', 'E'), inputs)
+	assert np.array_equal(approximate, [2.5, 2.5, np.nan, 4.5, 60.0], equal_nan=True)
+	assert isinstance(wb.getData()['lookups'][('Sheet1', 2, 6, 5, 7)], excel_lookup.LookupTable)
+
+
+def test_names_are_indexed_from_their_refers_to():
+	wb = stage2()
+	wb.addNamedRange('block', "='My Sheet'!R2C3:R4C1")
+	wb.addNamedRange('rate', '=Sheet1!$B$3')
+	wb.addNamedRange('formula', '=Sheet1!R2C2*2')
+	wb.setNamedCell('cells', excel_parse.ExcelCell('Sheet1', 'B', 2, None))
+	wb.setNamedCell('cells', excel_parse.ExcelCell('Sheet1', 'C', 4, None))
+	assert wb.getNamedRange('block') == ('My Sheet', 2, 0, 4, 2)
+	assert wb.getNamedRange('rate') == ('Sheet1', 3, 1, 3, 1)
+	assert wb.getNamedRange('formula') is None
+	assert wb.getNamedRange('cells') == ('Sheet1', 2, 1, 4, 2)
+	assert wb.resolveAddress('rate') == ('Sheet1', '3', 'B')
+	assert wb.getNamedCell(None, 'rate').getAddress() == wb.getCell(('Sheet1', '3', 'B')).getAddress()
+	assert np.array_equal(wb.getNamedValues('cells'), wb.getRange('Sheet1!B2', 'Sheet1!C4'), equal_nan=True)
+	names = dict(wb.getData()['names'])
+	wb.indexNames()
+	assert wb.getData()['names'] == names
+
+
+def test_instrumentation_counts_and_traces_a_quiet_run(capsys):
+	events = []
+	excel_lang.formulaCache.clear()
+	stats = excel_stats.enable(lambda event, info: events.append(event))
+	try:
+		wb = stage2()
+		evaluator = excel_grid.GridEvaluator(wb)
+		evaluator.evaluate(('Sheet1', '2', 'D'), {'Sheet1!B2': np.arange(3.0)})
+	finally:
+		assert excel_stats.disable() is stats
+	report = stats.report()
+	counters = report['counters']
+	assert counters['cellsLoaded'] > 0 and counters['parseMisses'] > 0 and counters['nodesEvaluated'] > 0
+	assert report['maxima']['expansionDepth'] > 0
+	assert report['seconds']['load'] > 0 and report['seconds']['evaluate'] > 0
+	assert report['rates']['cellsPerSecond'] > 0
+	assert {'load', 'worksheet', 'evaluate'} <= set(events)
+	assert capsys.readouterr().out == ''
+	assert excel_stats.current is None and excel_stats.phase('evaluate') is excel_stats.NOPHASE
+
+
+def test_circular_reference_is_reported_with_its_path():
+	wb = stage2()
+	setFormula(wb, 'E', 2, '=R2C6+1')
+	setFormula(wb, 'F', 2, '=R2C7*2')
+	setFormula(wb, 'G', 2, '=R2C5-R2C2')
+	graph = excel_graph.CellGraph(wb, [('Sheet1', '2', 'E')])
+	cycle, = graph.cycles()
+	assert sorted(graph.addresses[n] for n in cycle) == [('Sheet1', '2', 'E'), ('Sheet1', '2', 'F'), ('Sheet1', '2', 'G')]
+	with pytest.raises(Exception, match=r"Circular reference: Sheet1!E2 -> Sheet1!F2 -> Sheet1!G2 -> Sheet1!E2"):
+		excel_grid.GridEvaluator(wb, graph).evaluate(('Sheet1', '2', 'E'))
+
+
+def test_deep_chain_of_precedents():
+	wb = excel_parse.ExcelWB()
+	cell = excel_parse.ExcelCell('Sheet1', 'A', 1, None)
+	wb.setCellData(cell, 'datatype', 'Number')
+	wb.setCellData(cell, 'content', '1')
+	depth = 20000
+	for row in range(2, depth + 1):
+		wb.setCellData(excel_parse.ExcelCell('Sheet1', 'A', row, None), 'formula', '=R[-1]C+1')
+	assert excel_grid.GridEvaluator(wb).evaluate(('Sheet1', str(depth), 'A'))[0] == depth
+
+
+def test_cone_graph_reads_only_the_cells_of_the_cone(tmp_path):
+	fileName = str(tmp_path / 'synth.xml')
+	excel_synth.generateWorkbook(fileName, sheets=2, rows=200, cols=8, seed=2)
+	cacheDir = str(tmp_path / 'cache')
+	excel_cache.openWorkbook(fileName, cacheDir=cacheDir)
+	wb = excel_cache.openWorkbook(fileName, cacheDir=cacheDir)
+	whole = excel_graph.CellGraph(wb)
+	stats = excel_stats.enable()
+	try:
+		cone = excel_graph.CellGraph(wb, ['Out1'])
+	finally:
+		excel_stats.disable()
+	output = cone.outputs[0]
+	assert set(cone.addresses) == set(whole.addresses[n] for n in whole.order([whole.index[output]]))
+	assert len(cone) < len(whole) // 4
+	assert stats.counters['getCell'] <= len(cone)
+	assert np.array_equal(excel_grid.GridEvaluator(wb, cone).evaluate(output),
+		excel_grid.GridEvaluator(wb, whole).evaluate(output), equal_nan=True)
+
+
+def test_sweep_command_line_writes_every_scenario(tmp_path, monkeypatch):
+	# the workbook cache goes in the working directory
+	monkeypatch.chdir(tmp_path)
+	source = str(tmp_path / 'stage2.xml')
+	shutil.copy(os.path.join(HERE, 'stage2.xml'), source)
+	results = str(tmp_path / 'results.csv')
+	report = excel_sweep.main([source, '--input', 'Sheet1!B2=1:3:1', '--input', 'Sheet1!B3=10,20',
+		'--output', 'Sheet1!D2', '--results', results, '--batch', '4'])
+	assert report['scenarios'] == 6
+	with open(results) as f:
+		rows = list(csv.DictReader(f))
+	assert [(float(r['Sheet1!B2']), float(r['Sheet1!B3'])) for r in rows] == [(b2, b3) for b2 in (1, 2, 3) for b3 in (10, 20)]
+	expected = excel_grid.GridEvaluator(stage2()).evaluate(('Sheet1', '2', 'D'),
+		{'Sheet1!B2': np.repeat([1.0, 2.0, 3.0], 2), 'Sheet1!B3': np.tile([10.0, 20.0], 3)})
+	assert np.allclose([float(r['Sheet1!D2']) for r in rows], expected)
+
+	report = excel_sweep.main([source, '--input', 'Sheet1!B2=normal(5,1)', '--samples', '7', '--output', 'Sheet1!D2'])
+	assert report['scenarios'] == 7
+
+
+def test_streamed_chunks_match_one_kernel_call(tmp_path):
+	wb = stage2()
+	output = ('Sheet1', '2', 'D')
+	kernel = excel_codegen.compileKernel(wb, [output], ['Sheet1!B2'])
+	values = np.linspace(0.0, 10.0, 250)
+	expected, = kernel(values)
+	chunks = [{'Sheet1!B2': values[:100]}, {'Sheet1!B2': values[100:]}]
+	for count in (None, len(values)):
+		fileName = str(tmp_path / ('results' + str(count) + '.npy'))
+		results = excel_stream.evaluateToFile(kernel, iter(chunks), fileName, count, chunkSize=32)
+		assert results.shape == (250, 1)
+		assert np.array_equal(results[:, 0], expected)
+		assert np.array_equal(np.load(fileName), results)
+	with pytest.raises(Exception, match="100 scenarios streamed into .*, 250 expected"):
+		excel_stream.evaluateToFile(kernel, iter(chunks[:1]), str(tmp_path / 'short.npy'), 250)
+
+
+def test_shard_pool_matches_the_kernel(tmp_path):
+	source = str(tmp_path / 'stage2.xml')
+	shutil.copy(os.path.join(HERE, 'stage2.xml'), source)
+	output = ('Sheet1', '2', 'D')
+	kernel = excel_codegen.compileKernel(stage2(), [output], ['Sheet1!B2'])
+	with excel_shard.ShardPool(source, [output], ['Sheet1!B2'], workers=2, cacheDir=str(tmp_path / 'cache')) as pool:
+		assert pool.coneSize() == kernel.coneSize()
+		# a call small enough for one shard, then one that grows the blocks
+		for n in (10, 3 * excel_shard.MINSHARD + 5):
+			values = np.linspace(-5.0, 5.0, n)
+			result, = pool.call({'Sheet1!B2': values})
+			assert np.array_equal(result, kernel(values)[0], equal_nan=True)
+
+
+def test_xlsx_loads_as_the_same_workbook_saved_as_xml(tmp_path):
+	fileName = str(tmp_path / 'book.xlsx')
+	writeXlsx(fileName, [
+		('Data', [('A1', 'Item'), ('D1', '=IF(A2>1,"A1","no")'), ('E1', "='My Sheet'!A1*2"), ('F1', '=SUM(items)'),
+			('A2', 1), ('B2', (0, 'A2*2')), ('C2', '=SUM(B2:B4)'), ('A3', 2), ('B3', (0, None)), ('A4', 3.5), ('B4', (0, None))]),
+		('My Sheet', [('A1', 5)]),
+	], [('items', 'Data!$A$2:$A$4', None)])
+	xmlName = str(tmp_path / 'book.xml')
+	with open(xmlName, 'w') as f:
+		f.write(excel_synth.HEADER + ' <Names><NamedRange ss:Name="items" ss:RefersTo="=Data!R2C1:R4C1"/></Names>\n'
+			+ ' <Worksheet ss:Name="Data"><Table>\n'
+			+ '  <Row><Cell><Data ss:Type="String">Item</Data></Cell><Cell ss:Index="4" ss:Formula="=IF(R[1]C[-3]&gt;1,&quot;A1&quot;,&quot;no&quot;)"/>'
+			+ '<Cell ss:Formula="=\'My Sheet\'!RC[-4]*2"/><Cell ss:Formula="=SUM(items)"/></Row>\n'
+			+ '  <Row><Cell><Data ss:Type="Number">1</Data></Cell><Cell ss:Formula="=RC[-1]*2"/><Cell ss:Formula="=SUM(RC[-1]:R[2]C[-1])"/></Row>\n'
+			+ '  <Row><Cell><Data ss:Type="Number">2</Data></Cell><Cell ss:Formula="=RC[-1]*2"/></Row>\n'
+			+ '  <Row><Cell><Data ss:Type="Number">3.5</Data></Cell><Cell ss:Formula="=RC[-1]*2"/></Row>\n'
+			+ ' </Table></Worksheet>\n <Worksheet ss:Name="My Sheet"><Table><Row><Cell><Data ss:Type="Number">5</Data></Cell></Row></Table></Worksheet>\n'
+			+ '</Workbook>\n')
+	loaded = excel_parse.loadWorkbook(fileName)
+	saved = excel_parse.loadWorkbook(xmlName)
+	addresses = sorted(saved.getAddresses())
+	assert sorted(loaded.getAddresses()) == addresses
+	for address in addresses:
+		assert loaded.getCell(address).getData() == saved.getCell(address).getData()
+	assert loaded.getData()['names'] == saved.getData()['names']
+	evaluator = excel_grid.GridEvaluator(loaded)
+	assert evaluator.evaluate(('Data', '2', 'C'))[0] == 13
+	assert evaluator.evaluate(('Data', '1', 'D'))[0] == 'no'
+	assert evaluator.evaluate(('Data', '1', 'E'))[0] == 10
+	assert evaluator.evaluate(('Data', '1', 'F'))[0] == 6.5
+
+
+def test_vector_evaluation_matches_one_scenario_at_a_time():
+	wb = stage2()
+	setFormula(wb, 'E', 2, '=ROUND(R2C2/3,2)+MAX(R2C2:R3C2)-(R2C2^2)')
+	setFormula(wb, 'E', 3, '=IF(R2C2>2,"big"&R2C2,R2C2*PI())')
+	values = np.array([0.5, 2.0, 3.0, 7.25])
+	evaluator = excel_grid.GridEvaluator(wb)
+	for output in [('Sheet1', '2', 'D'), ('Sheet1', '2', 'E'), ('Sheet1', '3', 'E')]:
+		vector = evaluator.evaluate(output, {'Sheet1!B2': values})
+		assert len(vector) == len(values)
+		for i, value in enumerate(values):
+			assert vector[i] == evaluator.evaluate(output, {'Sheet1!B2': value})[0]